@@ -0,0 +1,138 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""Benchmarks of the hot paths, on the synthetic cluster from conftest.py"""
+
+import tracemalloc
+
+from benchmarks.conftest import METRIC_NAMES, METRICS_TO_CHECK
+from openshift_metrics import utils
+
+
+def record_throughput_and_memory(benchmark, function, items):
+    """
+    Adds the items processed per second and the peak memory to the benchmark's results
+
+    The peak memory is measured on a separate call, since tracing allocations slows
+    everything down.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    benchmark.extra_info["items"] = items
+    benchmark.extra_info["peak_memory_mb"] = round(peak / 2**20, 2)
+    if benchmark.stats:
+        benchmark.extra_info["items_per_second"] = round(items / benchmark.stats.stats.mean)
+
+
+def count_samples(query_results):
+    return sum(
+        len(series["values"])
+        for metrics_dict in query_results
+        for key in METRIC_NAMES
+        for series in metrics_dict[key]
+    )
+
+
+def count_intervals(condensed_metrics):
+    return sum(len(pod_dict["metrics"]) for pod_dict in condensed_metrics.values())
+
+
+def test_merge_metrics(benchmark, query_results):
+    def merge(output_dict=None):
+        if output_dict is None:
+            output_dict = {}
+        for metrics_dict in query_results:
+            for key, metric_name in METRIC_NAMES.items():
+                utils.merge_metrics(metric_name, metrics_dict[key], output_dict)
+        return output_dict
+
+    benchmark(merge)
+    record_throughput_and_memory(benchmark, merge, count_samples(query_results))
+
+
+def test_merge_metrics_store(benchmark, query_results):
+    def merge():
+        store = utils.PodMetricsStore()
+        for metrics_dict in query_results:
+            for key, metric_name in METRIC_NAMES.items():
+                utils.merge_metrics(metric_name, metrics_dict[key], store)
+        return store
+
+    benchmark(merge)
+    record_throughput_and_memory(benchmark, merge, count_samples(query_results))
+
+
+def test_merge_runs_store(benchmark, query_results, run_results):
+    def merge_and_condense():
+        store = utils.PodMetricsStore()
+        for metrics_dict in run_results:
+            for key, metric_name in METRIC_NAMES.items():
+                utils.merge_metrics(metric_name, metrics_dict[key], store)
+        return store.condense(METRICS_TO_CHECK)
+
+    benchmark(merge_and_condense)
+    record_throughput_and_memory(benchmark, merge_and_condense, count_samples(query_results))
+
+
+def test_condense_metrics(benchmark, query_results, merged_metrics):
+    def condense():
+        return utils.condense_metrics(merged_metrics, METRICS_TO_CHECK)
+
+    benchmark(condense)
+    record_throughput_and_memory(benchmark, condense, count_samples(query_results))
+
+
+def test_get_service_unit(benchmark, condensed_metrics):
+    pod_sizes = [
+        (
+            float(metric_dict.get("cpu_request", 0)),
+            float(metric_dict.get("memory_request", 0)) / 2**30,
+            float(metric_dict.get("gpu_request", 0)),
+            pod_dict["gpu_type"],
+        )
+        for pod_dict in condensed_metrics.values()
+        for metric_dict in pod_dict["metrics"].values()
+    ]
+
+    def get_service_units():
+        # start every round from an empty cache, like a fresh merge.py run
+        utils.get_service_unit.cache_clear()
+        return [utils.get_service_unit(*pod_size) for pod_size in pod_sizes]
+
+    benchmark(get_service_units)
+    record_throughput_and_memory(benchmark, get_service_units, len(pod_sizes))
+
+
+def test_write_metrics_by_namespace(benchmark, condensed_metrics, tmp_path):
+    file_name = str(tmp_path / "namespace.csv")
+
+    def write():
+        utils.write_metrics_by_namespace(condensed_metrics, file_name, "2023-03", {})
+
+    benchmark(write)
+    record_throughput_and_memory(benchmark, write, count_intervals(condensed_metrics))
+
+
+def test_write_metrics_by_pod(benchmark, condensed_metrics, tmp_path):
+    file_name = str(tmp_path / "pod.csv")
+
+    def write():
+        utils.format_timestamp.cache_clear()
+        utils.write_metrics_by_pod(condensed_metrics, file_name, {})
+
+    benchmark(write)
+    record_throughput_and_memory(benchmark, write, count_intervals(condensed_metrics))
@@ -0,0 +1,81 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""Fixtures holding the synthetic cluster the benchmarks run on"""
+
+import pytest
+
+from benchmarks import synthetic
+from openshift_metrics import utils
+
+
+METRIC_NAMES = {
+    "cpu_metrics": "cpu_request",
+    "memory_metrics": "memory_request",
+    "gpu_metrics": "gpu_request",
+}
+METRICS_TO_CHECK = ["cpu_request", "memory_request", "gpu_request"]
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("synthetic cluster")
+    group.addoption("--bench-pods", type=int, default=500, help="pods running at any time")
+    group.addoption("--bench-days", type=int, default=3, help="days of metrics")
+    group.addoption(
+        "--bench-churn-rate", type=float, default=0.1, help="fraction of pods replaced daily"
+    )
+    group.addoption(
+        "--bench-gpu-fraction",
+        type=float,
+        default=sum(synthetic.DEFAULT_GPU_MIX.values()),
+        help="fraction of pods requesting a GPU",
+    )
+
+
+@pytest.fixture(scope="session")
+def query_results(pytestconfig):
+    """The synthetic metrics files, one dict per day"""
+    return synthetic.generate_query_results(
+        pods=pytestconfig.getoption("bench_pods"),
+        days=pytestconfig.getoption("bench_days"),
+        churn_rate=pytestconfig.getoption("bench_churn_rate"),
+        gpu_mix=synthetic.scale_gpu_mix(pytestconfig.getoption("bench_gpu_fraction")),
+    )
+
+
+@pytest.fixture(scope="session")
+def run_results(query_results):
+    """The synthetic metrics files, with the series encoded as runs"""
+    return [
+        {
+            key: list(utils.condense_series(value)) if key in METRIC_NAMES else value
+            for key, value in metrics_dict.items()
+        }
+        for metrics_dict in query_results
+    ]
+
+
+@pytest.fixture(scope="session")
+def merged_metrics(query_results):
+    """The synthetic metrics merged by pod, like merge.py does"""
+    merged_dictionary = {}
+    for metrics_dict in query_results:
+        for key, metric_name in METRIC_NAMES.items():
+            utils.merge_metrics(metric_name, metrics_dict[key], merged_dictionary)
+    return merged_dictionary
+
+
+@pytest.fixture(scope="session")
+def condensed_metrics(merged_metrics):
+    """The merged synthetic metrics, condensed"""
+    return utils.condense_metrics(merged_metrics, METRICS_TO_CHECK)
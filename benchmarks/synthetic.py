@@ -0,0 +1,198 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+"""Generates synthetic prometheus query results shaped like a real cluster's"""
+
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timezone
+
+from openshift_metrics import utils
+
+
+CPU_CHOICES = ["0.1", "0.25", "0.5", "1", "2", "4", "8", "24"]
+MEMORY_CHOICES = [str(gib * 2**30) for gib in (0.5, 1, 2, 4, 8, 16, 64, 96)]
+GPU_CHOICES = ["1", "1", "1", "2", "4"]
+
+# fraction of pods requesting each GPU type, the rest don't request any
+DEFAULT_GPU_MIX = {
+    utils.GPU_A100: 0.02,
+    utils.GPU_A2: 0.02,
+    utils.GPU_V100: 0.01,
+}
+
+# chance that a pod gets resized at any given step, which ends a run when condensing
+RESIZE_RATE = 0.001
+
+
+def generate_pods(pods, days, churn_rate, gpu_mix, start_time, seed=0):
+    """
+    Generates the pods of a cluster and when each of them runs
+
+    `pods` are running at any time. Every day `churn_rate` of them get replaced by
+    new ones, at random times during the day.
+    """
+    rng = random.Random(seed)
+    end_time = start_time + days * 24 * 3600
+    namespaces = [f"namespace-{i}" for i in range(max(1, pods // 10))]
+    gpu_types = list(gpu_mix)
+    gpu_weights = list(gpu_mix.values())
+    no_gpu_weight = max(0, 1 - sum(gpu_weights))
+
+    def new_pod(index, started):
+        gpu_type = rng.choices(gpu_types + [None], gpu_weights + [no_gpu_weight])[0]
+        return {
+            "pod": f"pod-{index}",
+            "namespace": rng.choice(namespaces),
+            "gpu_type": gpu_type,
+            "start": started,
+            "end": end_time,
+        }
+
+    running = [new_pod(i, start_time) for i in range(pods)]
+    all_pods = list(running)
+    replaced_per_day = round(pods * churn_rate)
+    for day in range(days):
+        day_start = start_time + day * 24 * 3600
+        for _ in range(replaced_per_day):
+            slot = rng.randrange(pods)
+            replaced_at = rng.randrange(day_start, day_start + 24 * 3600)
+            if replaced_at <= running[slot]["start"]:
+                continue
+            running[slot]["end"] = replaced_at
+            running[slot] = new_pod(len(all_pods), replaced_at)
+            all_pods.append(running[slot])
+    return all_pods
+
+
+def generate_query_results(
+    pods=100,
+    days=1,
+    churn_rate=0.1,
+    gpu_mix=None,
+    start_date="2023-03-01",
+    step=utils.STEP_MIN * 60,
+    seed=0,
+):
+    """
+    Returns synthetic results of the cpu, memory and gpu queries, one dict per day
+
+    Each dict is shaped like the metrics files written by
+    openshift_prometheus_metrics.py, with the series as `query_range` returns them.
+    """
+    if gpu_mix is None:
+        gpu_mix = DEFAULT_GPU_MIX
+    rng = random.Random(seed)
+    start_time = int(
+        datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+    )
+    all_pods = generate_pods(pods, days, churn_rate, gpu_mix, start_time, seed)
+
+    # the samples of every pod, as (epoch_time, cpu, memory, gpu) tuples
+    pod_samples = []
+    for pod in all_pods:
+        first_sample = -(-pod["start"] // step) * step
+        cpu = rng.choice(CPU_CHOICES)
+        memory = rng.choice(MEMORY_CHOICES)
+        gpu = rng.choice(GPU_CHOICES) if pod["gpu_type"] else None
+        samples = []
+        for epoch_time in range(first_sample, pod["end"], step):
+            if rng.random() < RESIZE_RATE:
+                cpu = rng.choice(CPU_CHOICES)
+                memory = rng.choice(MEMORY_CHOICES)
+            samples.append((epoch_time, cpu, memory, gpu))
+        pod_samples.append(samples)
+
+    results = []
+    for day in range(days):
+        day_start = start_time + day * 24 * 3600
+        day_end = day_start + 24 * 3600
+        date = datetime.fromtimestamp(day_start, timezone.utc).strftime("%Y-%m-%d")
+        metrics_dict = {
+            "start_date": date,
+            "end_date": date,
+            "cpu_metrics": [],
+            "memory_metrics": [],
+            "gpu_metrics": [],
+        }
+        for pod, samples in zip(all_pods, pod_samples):
+            day_samples = [sample for sample in samples if day_start <= sample[0] < day_end]
+            if not day_samples:
+                continue
+            labels = {"pod": pod["pod"], "namespace": pod["namespace"]}
+            metrics_dict["cpu_metrics"].append(
+                {
+                    "metric": dict(labels, resource="cpu"),
+                    "values": [[sample[0], sample[1]] for sample in day_samples],
+                }
+            )
+            metrics_dict["memory_metrics"].append(
+                {
+                    "metric": dict(labels, resource="memory"),
+                    "values": [[sample[0], sample[2]] for sample in day_samples],
+                }
+            )
+            if pod["gpu_type"]:
+                metrics_dict["gpu_metrics"].append(
+                    {
+                        "metric": dict(labels, resource=pod["gpu_type"]),
+                        "values": [[sample[0], sample[3]] for sample in day_samples],
+                    }
+                )
+        results.append(metrics_dict)
+    return results
+
+
+def scale_gpu_mix(gpu_fraction):
+    """Returns DEFAULT_GPU_MIX scaled so that gpu_fraction of the pods request a GPU"""
+    total = sum(DEFAULT_GPU_MIX.values())
+    return {gpu_type: share / total * gpu_fraction for gpu_type, share in DEFAULT_GPU_MIX.items()}
+
+
+def main():
+    """Writes synthetic metrics files that merge.py can be run on"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pods", type=int, default=1000)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--churn-rate", type=float, default=0.1)
+    parser.add_argument(
+        "--gpu-fraction",
+        help="fraction of pods requesting a GPU, split between the GPU types",
+        type=float,
+        default=sum(DEFAULT_GPU_MIX.values()),
+    )
+    parser.add_argument("--start-date", default="2023-03-01")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default=".")
+    args = parser.parse_args()
+
+    results = generate_query_results(
+        pods=args.pods,
+        days=args.days,
+        churn_rate=args.churn_rate,
+        gpu_mix=scale_gpu_mix(args.gpu_fraction),
+        start_date=args.start_date,
+        seed=args.seed,
+    )
+    os.makedirs(args.output_dir, exist_ok=True)
+    for metrics_dict in results:
+        output_file = os.path.join(args.output_dir, f"metrics-{metrics_dict['start_date']}.json")
+        print(f"Writing {output_file}")
+        with open(output_file, "w") as file:
+            json.dump(metrics_dict, file)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,20 @@ Merges metrics from files and produces reports by pod and by namespace
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import copy
 from datetime import datetime
 import json
+import math
+import os
+import sys
 
 import utils
 
 
+METRICS_TO_CHECK = ["cpu_request", "memory_request", "gpu_request"]
+
+
 def compare_dates(date_str1, date_str2):
     """Returns true is date1 is earlier than date2"""
     date1 = datetime.strptime(date_str1, "%Y-%m-%d")
@@ -16,38 +24,371 @@ def compare_dates(date_str1, date_str2):
     return date1 < date2
 
 
+def read_metrics_file(file):
+    """Reads a metrics file written by the collector, as JSON or as a snapshot"""
+    if file.endswith(utils.SNAPSHOT_EXTENSION):
+        return utils.read_snapshot(file)
+    with open(file, "r") as jsonfile:
+        return json.load(jsonfile)
+
+
+def load_metrics_files(files, run_summary=None):
+    """
+    Reads and merges the metrics from files
+
+    Returns the merged PodMetricsStore and the earliest start date and latest
+    end date found in the files. The time spent reading and merging is recorded
+    in run_summary, if one is given.
+    """
+    if run_summary is None:
+        run_summary = utils.RunSummary("merge")
+    merged_dictionary = utils.PodMetricsStore()
+
+    report_start_date = None
+    report_end_date = None
+
+    for file in files:
+        with run_summary.stage("read_files"):
+            metrics_from_file = read_metrics_file(file)
+        run_summary.count("files")
+        if metrics_from_file.get("format_version", 1) > utils.FORMAT_VERSION:
+            sys.exit(f"{file} was written in a newer format than this script can read")
+        # files collected with --clusters are tagged with their cluster
+        cluster = metrics_from_file.get("cluster")
+        cpu_request_metrics = run_summary.count_series(metrics_from_file["cpu_metrics"])
+        memory_request_metrics = run_summary.count_series(metrics_from_file["memory_metrics"])
+        gpu_request_metrics = metrics_from_file.get("gpu_metrics", None)
+        with run_summary.stage("merge_metrics"):
+            utils.merge_metrics("cpu_request", cpu_request_metrics, merged_dictionary, cluster)
+            utils.merge_metrics(
+                "memory_request", memory_request_metrics, merged_dictionary, cluster
+            )
+            if gpu_request_metrics is not None:
+                utils.merge_metrics(
+                    "gpu_request",
+                    run_summary.count_series(gpu_request_metrics),
+                    merged_dictionary,
+                    cluster,
+                )
+
+        # files collected with --aggregated have the usage of non-gpu pods summed up
+        namespace_usage = metrics_from_file.get("namespace_usage", {})
+        utils.add_namespace_usage(merged_dictionary.namespace_usage, namespace_usage)
+        if cluster is not None:
+            utils.add_namespace_usage(
+                merged_dictionary.cluster_namespace_usage.setdefault(cluster, {}), namespace_usage
+            )
+
+        if report_start_date is None:
+            report_start_date = metrics_from_file["start_date"]
+        elif compare_dates(metrics_from_file["start_date"], report_start_date):
+            report_start_date = metrics_from_file["start_date"]
+
+        if report_end_date is None:
+            report_end_date = metrics_from_file["end_date"]
+        elif compare_dates(report_end_date, metrics_from_file["end_date"]):
+            report_end_date = metrics_from_file["end_date"]
+
+    return merged_dictionary, report_start_date, report_end_date
+
+
+def load_metrics_files_counted(files):
+    """Runs `load_metrics_files` in a worker process, returning its counts as well"""
+    run_summary = utils.RunSummary("merge")
+    return (*load_metrics_files(files, run_summary), run_summary.counts)
+
+
+def load_metrics_files_parallel(files, workers, run_summary=None):
+    """
+    Reads and merges the metrics from files using a pool of worker processes
+
+    Each worker merges a contiguous slice of the files, and the partial results are
+    then merged in file order, so the result is the same as `load_metrics_files`.
+    The files, series and samples counted by the workers are added to run_summary,
+    if one is given.
+    """
+    chunk_size = math.ceil(len(files) / workers)
+    chunks = [files[i : i + chunk_size] for i in range(0, len(files), chunk_size)]
+
+    merged_dictionary = utils.PodMetricsStore()
+    report_start_date = None
+    report_end_date = None
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial_dictionary, start_date, end_date, counts in executor.map(
+            load_metrics_files_counted, chunks
+        ):
+            merged_dictionary.update(partial_dictionary)
+            if run_summary is not None:
+                for name, value in counts.items():
+                    run_summary.count(name, value)
+            if report_start_date is None or compare_dates(start_date, report_start_date):
+                report_start_date = start_date
+            if report_end_date is None or compare_dates(report_end_date, end_date):
+                report_end_date = end_date
+
+    return merged_dictionary, report_start_date, report_end_date
+
+
+def load_merge_state(state_file):
+    """
+    Loads the state saved by an incremental merge
+
+    The state holds the files merged so far with their size and modification time,
+    their report dates, the condensed runs of every pod and the namespace usage of
+    the runs that are closed.
+    """
+    if not os.path.exists(state_file):
+        return {
+            "files": {},
+            "start_date": None,
+            "end_date": None,
+            "pods": {},
+            "namespaces": {},
+            "namespace_usage": {},
+            "cluster_namespace_usage": {},
+        }
+    with open(state_file, "r") as file:
+        state = json.load(file)
+    state.setdefault("namespace_usage", {})
+    state.setdefault("cluster_namespace_usage", {})
+    if isinstance(state["files"], list):
+        # older states only kept the paths of the files
+        state["files"] = dict.fromkeys(state["files"])
+    pods = {}
+    for pod, pod_dict in state["pods"].items():
+        # JSON object keys are always strings
+        pod_dict["metrics"] = {
+            int(epoch_time): metric_dict for epoch_time, metric_dict in pod_dict["metrics"].items()
+        }
+        # older states keyed the pods by their name alone
+        pod_dict.setdefault("pod", pod)
+        pods[utils.get_pod_key(pod_dict["namespace"], pod_dict["pod"], pod_dict.get("cluster"))] = pod_dict
+    state["pods"] = pods
+    return state
+
+
+def get_file_signature(file):
+    """Returns what tells whether a file changed since it was merged"""
+    stat = os.stat(file)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def save_merge_state(state, state_file):
+    """Saves the state of an incremental merge"""
+    temp_state_file = f"{state_file}.tmp"
+    with open(temp_state_file, "w") as file:
+        json.dump(state, file)
+    os.replace(temp_state_file, state_file)
+
+
+def split_metrics_dict(condensed_metrics_dict):
+    """Splits condensed metrics into the closed runs and the open last run of each pod"""
+    closed_metrics_dict = {}
+    open_metrics_dict = {}
+    for pod, pod_dict in condensed_metrics_dict.items():
+        runs = list(pod_dict["metrics"].items())
+        closed_metrics_dict[pod] = dict(pod_dict, metrics=dict(runs[:-1]))
+        open_metrics_dict[pod] = dict(pod_dict, metrics=dict(runs[-1:]))
+    return closed_metrics_dict, open_metrics_dict
+
+
+def merge_incrementally(files, state_file, workers, run_summary=None):
+    """
+    Folds the files that haven't been merged yet into the saved state
+
+    Only the new files are read and condensed. Their runs extend the ones that were
+    still open, and the runs that get closed are added to the namespace usage, so
+    that earlier files never have to be processed again. A file that changed after it
+    was merged, like the file of a day the daemon still adds to or a day collected
+    again, can't be folded in again and stops the merge.
+
+    Returns the condensed metrics, the namespace usage, the usage summed up in
+    prometheus for each cluster, and the report dates, all in the same order as a
+    full merge of the files would give them.
+    """
+    if run_summary is None:
+        run_summary = utils.RunSummary("merge")
+    with run_summary.stage("load_state"):
+        state = load_merge_state(state_file)
+    # taken before reading the files, so that a change while they are read shows next time
+    signatures = {os.path.abspath(file): get_file_signature(file) for file in files}
+    new_files = []
+    changed_files = []
+    unsigned_files = []
+    for file in files:
+        path = os.path.abspath(file)
+        if path not in state["files"]:
+            new_files.append(file)
+        elif state["files"][path] is None:
+            # merged before the state kept signatures, so only checked from now on
+            unsigned_files.append(file)
+        elif state["files"][path] != signatures[path]:
+            changed_files.append(file)
+    if changed_files:
+        sys.exit(
+            f"{', '.join(changed_files)} changed since they were merged into {state_file}, "
+            "merge all the files again with a new state file"
+        )
+    if new_files:
+        if workers > 1:
+            with run_summary.stage("load_files"):
+                merged_dictionary, start_date, end_date = load_metrics_files_parallel(
+                    new_files, workers, run_summary
+                )
+        else:
+            merged_dictionary, start_date, end_date = load_metrics_files(new_files, run_summary)
+        if state["start_date"] is None or compare_dates(start_date, state["start_date"]):
+            state["start_date"] = start_date
+        if state["end_date"] is None or compare_dates(state["end_date"], end_date):
+            state["end_date"] = end_date
+
+        with run_summary.stage("condense_metrics"):
+            new_condensed_metrics_dict = utils.condense_metrics(merged_dictionary, METRICS_TO_CHECK)
+        gpu_type_changed = any(
+            pod in state["pods"] and state["pods"][pod]["gpu_type"] != pod_dict["gpu_type"]
+            for pod, pod_dict in new_condensed_metrics_dict.items()
+        )
+        with run_summary.stage("fold_metrics"):
+            closed_metrics_dict = utils.fold_condensed_metrics(
+                state["pods"], new_condensed_metrics_dict, METRICS_TO_CHECK
+            )
+            if gpu_type_changed:
+                # the usage of a pod depends on its latest GPU type, so the closed
+                # runs have to be summed up again
+                closed_metrics_dict = split_metrics_dict(state["pods"])[0]
+                state["namespaces"] = {}
+            utils.aggregate_metrics_by_namespace(closed_metrics_dict, state["namespaces"])
+        utils.add_namespace_usage(state["namespace_usage"], merged_dictionary.namespace_usage)
+        for cluster, namespace_usage in merged_dictionary.cluster_namespace_usage.items():
+            utils.add_namespace_usage(
+                state["cluster_namespace_usage"].setdefault(cluster, {}), namespace_usage
+            )
+    if new_files or unsigned_files:
+        for file in new_files + unsigned_files:
+            state["files"][os.path.abspath(file)] = signatures[os.path.abspath(file)]
+        with run_summary.stage("save_state"):
+            save_merge_state(state, state_file)
+
+    if not state["files"]:
+        sys.exit("No metrics have been merged yet")
+
+    # the last run of each pod is still open, so it isn't part of the saved usage
+    with run_summary.stage("aggregate_metrics"):
+        open_metrics_dict = split_metrics_dict(state["pods"])[1]
+        namespace_totals = utils.aggregate_metrics_by_namespace(
+            open_metrics_dict, copy.deepcopy(state["namespaces"])
+        )
+        utils.add_namespace_usage(namespace_totals, state["namespace_usage"])
+        # in the order of a full merge, by the first pod of each namespace and then
+        # the namespaces only summed up in prometheus
+        namespaces = dict.fromkeys(pod_dict["namespace"] for pod_dict in state["pods"].values())
+        namespaces.update(dict.fromkeys(namespace_totals))
+        metrics_by_namespace = {namespace: namespace_totals[namespace] for namespace in namespaces}
+    return (
+        state["pods"],
+        metrics_by_namespace,
+        state["cluster_namespace_usage"],
+        state["start_date"],
+        state["end_date"],
+    )
+
+
 def main():
     """Reads the metrics from files and generates the reports"""
     parser = argparse.ArgumentParser()
     parser.add_argument("files", nargs="+")
+    parser.add_argument(
+        "--workers",
+        help="number of processes to read the files with",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--annotations-cache",
+        help="file to save namespace annotations to and reuse them from",
+    )
+    parser.add_argument(
+        "--annotations-cache-ttl",
+        help="seconds for which saved namespace annotations are reused",
+        type=int,
+        default=utils.ANNOTATIONS_CACHE_TTL,
+    )
+    parser.add_argument(
+        "--offline",
+        help="only use the namespace annotations saved in --annotations-cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--state",
+        help="merge incrementally, keeping what was merged so far in this file",
+    )
+    parser.add_argument(
+        "--compress",
+        help="write the reports gzip-compressed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--per-cluster",
+        help="also write a namespace and a pod report for each cluster the files come from",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--run-summary",
+        help="write the timings, memory use and counts of the run to this JSON file",
+    )
+    parser.add_argument(
+        "--profile",
+        help="profile the run with cProfile and write the stats to this file",
+    )
     args = parser.parse_args()
-    files = args.files
-    merged_dictionary = {}
-    output_file = f"{datetime.today().strftime('%Y-%m-%d')}.csv"
+    if args.offline and not args.annotations_cache:
+        parser.error("--offline requires --annotations-cache")
 
-    report_start_date = None
-    report_end_date = None
+    run_summary = utils.RunSummary("merge")
+    try:
+        with utils.profiled(args.profile):
+            merge_files(args, run_summary)
+    finally:
+        if args.run_summary:
+            run_summary.write(args.run_summary)
 
-    for file in files:
-        with open(file, "r") as jsonfile:
-            metrics_from_file = json.load(jsonfile)
-            cpu_request_metrics = metrics_from_file["cpu_metrics"]
-            memory_request_metrics = metrics_from_file["memory_metrics"]
-            gpu_request_metrics = metrics_from_file.get("gpu_metrics", None)
-            utils.merge_metrics("cpu_request", cpu_request_metrics, merged_dictionary)
-            utils.merge_metrics("memory_request", memory_request_metrics, merged_dictionary)
-            if gpu_request_metrics is not None:
-                utils.merge_metrics("gpu_request", gpu_request_metrics, merged_dictionary)
 
-            if report_start_date is None:
-                report_start_date = metrics_from_file["start_date"]
-            elif compare_dates(metrics_from_file["start_date"], report_start_date):
-                report_start_date = metrics_from_file["start_date"]
+def merge_files(args, run_summary):
+    """Merges the metrics files and writes the namespace and pod reports"""
+    files = args.files
+    output_file = f"{datetime.today().strftime('%Y-%m-%d')}.csv"
+    if args.compress:
+        output_file += ".gz"
 
-            if report_end_date is None:
-                report_end_date = metrics_from_file["end_date"]
-            elif compare_dates(report_end_date, metrics_from_file["end_date"]):
-                report_end_date = metrics_from_file["end_date"]
+    if args.state:
+        (
+            condensed_metrics_dict,
+            metrics_by_namespace,
+            cluster_namespace_usage,
+            report_start_date,
+            report_end_date,
+        ) = merge_incrementally(files, args.state, args.workers, run_summary)
+    else:
+        if args.workers > 1:
+            with run_summary.stage("load_files"):
+                merged_dictionary, report_start_date, report_end_date = (
+                    load_metrics_files_parallel(files, args.workers, run_summary)
+                )
+        else:
+            merged_dictionary, report_start_date, report_end_date = load_metrics_files(
+                files, run_summary
+            )
+        with run_summary.stage("condense_metrics"):
+            condensed_metrics_dict = utils.condense_metrics(merged_dictionary, METRICS_TO_CHECK)
+        with run_summary.stage("aggregate_metrics"):
+            metrics_by_namespace = utils.aggregate_metrics_by_namespace(condensed_metrics_dict)
+            utils.add_namespace_usage(metrics_by_namespace, merged_dictionary.namespace_usage)
+        cluster_namespace_usage = merged_dictionary.cluster_namespace_usage
+    run_summary.count("pods", len(condensed_metrics_dict))
+    run_summary.count(
+        "intervals", sum(len(pod_dict["metrics"]) for pod_dict in condensed_metrics_dict.values())
+    )
 
     print(report_start_date)
     print(report_end_date)
@@ -60,15 +401,51 @@ def main():
         print("Warning: The report spans multiple months")
         report_month += " to " + datetime.strftime(report_end_date, "%Y-%m")
 
-    condensed_metrics_dict = utils.condense_metrics(
-        merged_dictionary, ["cpu_request", "memory_request", "gpu_request"]
-    )
-    utils.write_metrics_by_namespace(
-        condensed_metrics_dict,
-        "namespace-" + output_file,
-        report_month
-    )
-    utils.write_metrics_by_pod(condensed_metrics_dict, "pod-" + output_file)
+    with run_summary.stage("namespace_annotations"):
+        namespace_annotations = utils.load_namespace_annotations(
+            args.annotations_cache, args.annotations_cache_ttl, args.offline
+        )
+    with run_summary.stage("write_namespace_report"):
+        utils.write_namespace_report(
+            metrics_by_namespace,
+            "namespace-" + output_file,
+            report_month,
+            namespace_annotations,
+        )
+    with run_summary.stage("write_pod_report"):
+        utils.write_metrics_by_pod(
+            condensed_metrics_dict, "pod-" + output_file, namespace_annotations
+        )
+
+    if args.per_cluster:
+        with run_summary.stage("write_cluster_reports"):
+            write_cluster_reports(
+                condensed_metrics_dict,
+                cluster_namespace_usage,
+                output_file,
+                report_month,
+                namespace_annotations,
+            )
+
+
+def write_cluster_reports(
+    condensed_metrics_dict, cluster_namespace_usage, output_file, report_month, namespace_annotations
+):
+    """Writes a namespace and a pod report for each cluster the metrics were collected from"""
+    metrics_by_cluster = utils.split_by_cluster(condensed_metrics_dict)
+    for cluster in sorted(set(metrics_by_cluster) | set(cluster_namespace_usage)):
+        cluster_metrics_dict = metrics_by_cluster.get(cluster, {})
+        metrics_by_namespace = utils.aggregate_metrics_by_namespace(cluster_metrics_dict)
+        utils.add_namespace_usage(metrics_by_namespace, cluster_namespace_usage.get(cluster, {}))
+        utils.write_namespace_report(
+            metrics_by_namespace,
+            f"namespace-{cluster}-{output_file}",
+            report_month,
+            namespace_annotations,
+        )
+        utils.write_metrics_by_pod(
+            cluster_metrics_dict, f"pod-{cluster}-{output_file}", namespace_annotations
+        )
 
 
 if __name__ == "__main__":
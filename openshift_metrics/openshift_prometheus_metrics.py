@@ -14,12 +14,18 @@
 """Collect and save metrics from prometheus"""
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import itertools
 import os
+import signal
 import sys
 import json
+import threading
+import time
 
 import openshift
+import requests
 
 import utils
 
@@ -28,6 +34,21 @@ CPU_REQUEST = 'kube_pod_resource_request{unit="cores"} unless on(pod, namespace)
 MEMORY_REQUEST = 'kube_pod_resource_request{unit="bytes"} unless on(pod, namespace) kube_pod_status_unschedulable'
 GPU_REQUEST = 'kube_pod_resource_request{resource=~".*gpu.*"} unless on(pod, namespace) kube_pod_status_unschedulable'
 
+METRICS = {
+    "cpu_metrics": CPU_REQUEST,
+    "memory_metrics": MEMORY_REQUEST,
+    "gpu_metrics": GPU_REQUEST,
+}
+# because if nobody requests a GPU then we will get an empty set
+OPTIONAL_METRICS = ("gpu_metrics",)
+
+# with --aggregated, only the pods requesting a GPU are collected one by one
+GPU_POD_METRICS = {
+    "cpu_metrics": f"({CPU_REQUEST}) and on(pod, namespace) ({GPU_REQUEST})",
+    "memory_metrics": f"({MEMORY_REQUEST}) and on(pod, namespace) ({GPU_REQUEST})",
+    "gpu_metrics": GPU_REQUEST,
+}
+
 
 def main():
     """This method kick starts the process of collecting and saving the metrics"""
@@ -49,11 +70,187 @@ def main():
         default=(datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
     )
     parser.add_argument("--output-file")
+    parser.add_argument(
+        "--concurrency",
+        help="maximum number of metric queries to run at the same time",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--shard",
+        help="split each query into day or hour long chunks",
+        choices=sorted(utils.SHARD_SECONDS),
+    )
+    parser.add_argument(
+        "--shard-concurrency",
+        help="maximum number of chunks of a sharded query to fetch at the same time",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--stream",
+        help="parse and write each query response one series at a time to keep memory use low",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--condense",
+        help="store each series as runs of identical samples instead of every sample",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--output-format",
+        help="write the metrics as JSON or as a binary snapshot",
+        choices=["json", "snapshot"],
+        default="json",
+    )
+    parser.add_argument(
+        "--snapshot-compression",
+        help="compression of the snapshot columns, uncompressed snapshots can be memory-mapped",
+        choices=["zlib", "none"],
+        default="zlib",
+    )
+    parser.add_argument(
+        "--query-timeout",
+        help="seconds to wait for a query to respond",
+        type=float,
+        default=300,
+    )
+    parser.add_argument(
+        "--retry-budget",
+        help="total number of retries allowed across all queries",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "--run-summary",
+        help="write the timings, memory use, counts and queries of the run to this JSON file",
+    )
+    parser.add_argument(
+        "--profile",
+        help="profile the run with cProfile and write the stats to this file",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        help="write metrics about the run to this file for the node exporter's textfile collector",
+    )
+    parser.add_argument(
+        "--pushgateway-url",
+        help="push metrics about the run to this Pushgateway",
+        default=os.getenv("OPENSHIFT_METRICS_PUSHGATEWAY_URL"),
+    )
+    parser.add_argument(
+        "--pushgateway-job",
+        help="job the run metrics are pushed under",
+        default="openshift_metrics_collector",
+    )
+    parser.add_argument(
+        "--aggregated",
+        help="sum up the usage of the non-gpu pods by namespace in prometheus, "
+        "and only collect the pods requesting a GPU one by one",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--clusters",
+        help="JSON inventory of the clusters to collect from at the same time, "
+        "in place of --openshift-url",
+    )
+    parser.add_argument(
+        "--cluster-concurrency",
+        help="maximum number of clusters to collect from at the same time",
+        type=int,
+    )
+    parser.add_argument(
+        "--daemon",
+        help="keep running, querying the metrics since the last query every --interval minutes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--interval",
+        help="minutes between the queries of --daemon",
+        type=int,
+        default=utils.STEP_MIN,
+    )
+    parser.add_argument(
+        "--daemon-state",
+        help="file --daemon keeps its watermark in, to resume from after a restart",
+        default="collector-state.json",
+    )
+    parser.add_argument(
+        "--lag",
+        help="seconds --daemon stays behind the current time, for prometheus to catch up",
+        type=int,
+        default=300,
+    )
+    parser.add_argument(
+        "--backfill",
+        help="collect each day of the report range into its own file, skipping the days "
+        "that already have one, so that a failed run can be resumed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--backfill-concurrency",
+        help="maximum number of days to collect at the same time with --backfill",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--keep-labels",
+        help="comma separated labels the queried series keep, the others are dropped "
+        "in prometheus to cut the size of the responses and files",
+        default=",".join(utils.PROJECTED_LABELS),
+    )
+    parser.add_argument(
+        "--keep-all-labels",
+        help="query the series with all of their labels",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--adaptive",
+        help="only fetch the samples of the pods that change during the report window, "
+        "at --fine-step, and get the stable pods as a single value each",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--fine-step",
+        help="seconds between the samples of the pods that change with --adaptive",
+        type=int,
+        default=60,
+    )
 
     args = parser.parse_args()
-    if not args.openshift_url:
+    if args.stream and args.shard:
+        parser.error("--stream can't be combined with --shard")
+    if args.stream and args.output_format == "snapshot":
+        parser.error("--stream can only write JSON")
+    if args.condense and args.output_format == "snapshot":
+        parser.error("--condense can only write JSON")
+    if args.aggregated and (args.stream or args.daemon):
+        parser.error("--aggregated can't be combined with --stream or --daemon")
+    if args.daemon and (
+        args.stream or args.shard or args.condense or args.output_format != "json"
+    ):
+        parser.error("--daemon can't be combined with --stream, --shard, --condense or snapshots")
+    if args.clusters and (args.daemon or args.output_file):
+        parser.error("--clusters can't be combined with --daemon or --output-file")
+    if args.backfill and (args.daemon or args.clusters or args.output_file):
+        parser.error("--backfill can't be combined with --daemon, --clusters or --output-file")
+    args.keep_labels = [label.strip() for label in args.keep_labels.split(",") if label.strip()]
+    if args.adaptive and (
+        args.stream or args.shard or args.daemon or args.aggregated or args.output_format != "json"
+    ):
+        parser.error(
+            "--adaptive can't be combined with --stream, --shard, --daemon, --aggregated or snapshots"
+        )
+    if args.fine_step <= 0 or utils.STEP_MIN * 60 % args.fine_step:
+        parser.error(f"--fine-step must divide {utils.STEP_MIN * 60} seconds")
+    if not set(utils.PROJECTED_LABELS).issubset(args.keep_labels):
+        parser.error(f"--keep-labels must include {', '.join(utils.PROJECTED_LABELS)}")
+    if not args.openshift_url and not args.clusters:
         sys.exit("Must specify --openshift-url or set OPENSHIFT_PROMETHEUS_URL in your environment")
-    openshift_url = args.openshift_url
+
+    if args.daemon:
+        run_daemon(args)
+        return
 
     report_start_date = args.report_start_date
     report_end_date = args.report_end_date
@@ -61,53 +258,410 @@ def main():
     report_length = (datetime.strptime(report_end_date, "%Y-%m-%d") - datetime.strptime(report_start_date, "%Y-%m-%d"))
     assert report_length.days >= 0, "report_start_date cannot be after report_end_date"
 
+    extension = utils.SNAPSHOT_EXTENSION if args.output_format == "snapshot" else ".json"
     if args.output_file:
         output_file = args.output_file
     elif report_start_date == report_end_date:
-        output_file = f"metrics-{report_start_date}.json"
+        output_file = f"metrics-{report_start_date}{extension}"
     else:
-        output_file = f"metrics-{report_start_date}-to-{report_end_date}.json"
+        output_file = f"metrics-{report_start_date}-to-{report_end_date}{extension}"
 
-    print(f"Generating report starting {report_start_date} and ending {report_end_date} in {output_file}")
+    if args.backfill:
+        print(f"Backfilling {report_start_date} to {report_end_date} a day at a time")
+    else:
+        print(f"Generating report starting {report_start_date} and ending {report_end_date} in {output_file}")
 
+    if args.clusters:
+        with utils.profiled(args.profile):
+            failed_clusters = collect_clusters(args, output_file)
+        if failed_clusters:
+            sys.exit(f"Collecting from {', '.join(failed_clusters)} failed")
+        return
 
-    token = os.environ.get("OPENSHIFT_TOKEN")
+    failed_days = []
+    run_summary = utils.RunSummary("openshift_prometheus_metrics")
+    try:
+        with utils.profiled(args.profile):
+            if args.backfill:
+                failed_days = backfill(args, extension, run_summary)
+            else:
+                collect_metrics(args, output_file, run_summary)
+        run_summary.succeeded = not failed_days
+    finally:
+        if args.run_summary:
+            run_summary.write(args.run_summary)
+        if args.metrics_textfile:
+            utils.write_metrics_textfile(run_summary, args.metrics_textfile)
+        if args.pushgateway_url:
+            utils.push_run_metrics(run_summary, args.pushgateway_url, args.pushgateway_job)
+    if failed_days:
+        sys.exit(f"Collecting {', '.join(failed_days)} failed, run again to resume")
 
-    if token is None:
-        token = openshift.get_auth_token()
 
-    metrics_dict = {}
-    metrics_dict["start_date"] = report_start_date
-    metrics_dict["end_date"] = report_end_date
+def backfill(args, extension, run_summary):
+    """
+    Collects each day of the report range into its own file, a few days at a time
 
-    cpu_request_metrics = utils.query_metric(
-        openshift_url, token, CPU_REQUEST, report_start_date, report_end_date
-    )
-    memory_request_metrics = utils.query_metric(
-        openshift_url, token, MEMORY_REQUEST, report_start_date, report_end_date
-    )
-    metrics_dict["cpu_metrics"] = cpu_request_metrics
-    metrics_dict["memory_metrics"] = memory_request_metrics
+    Days whose file already exists are skipped, and a day's file only appears once
+    all of its queries have succeeded, so running the backfill again after a failure
+    only collects the days that are missing. The days that failed are returned.
+    """
+    token = get_token()
 
-    # because if nobody requests a GPU then we will get an empty set
-    try:
-        gpu_request_metrics = utils.query_metric(
-            openshift_url, token, GPU_REQUEST, report_start_date, report_end_date
+    def collect_day(day):
+        day_file = get_day_file(day, extension)
+        if os.path.exists(day_file):
+            print(f"Skipping {day}, it was already collected in {day_file}")
+            run_summary.count("days_skipped")
+            return True
+        day_args = argparse.Namespace(**vars(args))
+        day_args.report_start_date = day
+        day_args.report_end_date = day
+        try:
+            collect_metrics(day_args, os.path.basename(day_file), run_summary, token=token)
+        except Exception as e:
+            print(f"Collecting {day} failed: {e}")
+            run_summary.count("days_failed")
+            return False
+        print(f"Collected {day} in {day_file}")
+        run_summary.count("days_collected")
+        return True
+
+    days = utils.get_report_days(args.report_start_date, args.report_end_date)
+    with ThreadPoolExecutor(max_workers=args.backfill_concurrency) as executor:
+        succeeded = list(executor.map(collect_day, days))
+    return [day for day, ok in zip(days, succeeded) if not ok]
+
+
+def collect_clusters(args, output_file):
+    """
+    Collects the metrics of every cluster in the --clusters inventory at the same time
+
+    Each cluster's metrics, run summary and run metrics are tagged with its name, and
+    its queries use the token from its own token source in the inventory. A cluster
+    failing doesn't stop the others, and the names of the ones that failed are returned.
+    """
+    clusters = utils.load_cluster_inventory(args.clusters)
+
+    def collect_cluster(cluster):
+        cluster_args = argparse.Namespace(**vars(args))
+        cluster_args.openshift_url = cluster["url"]
+        cluster_args.concurrency = cluster.get("concurrency", args.concurrency)
+        run_summary = utils.RunSummary(
+            "openshift_prometheus_metrics", labels={"cluster": cluster["name"]}
         )
-        metrics_dict["gpu_metrics"] = gpu_request_metrics
-    except utils.EmptyResultError:
-        pass
+        try:
+            collect_metrics(
+                cluster_args,
+                utils.cluster_file_name(output_file, cluster["name"]),
+                run_summary,
+                token=utils.get_cluster_token(cluster),
+                cluster=cluster["name"],
+            )
+            run_summary.succeeded = True
+        except Exception as e:
+            print(f"Collecting from {cluster['name']} failed: {e}")
+        finally:
+            if args.run_summary:
+                run_summary.write(utils.cluster_file_name(args.run_summary, cluster["name"]))
+            if args.metrics_textfile:
+                utils.write_metrics_textfile(
+                    run_summary, utils.cluster_file_name(args.metrics_textfile, cluster["name"])
+                )
+            if args.pushgateway_url:
+                utils.push_run_metrics(run_summary, args.pushgateway_url, args.pushgateway_job)
+        return run_summary.succeeded
+
+    with ThreadPoolExecutor(max_workers=args.cluster_concurrency or len(clusters)) as executor:
+        succeeded = list(executor.map(collect_cluster, clusters))
+    return [cluster["name"] for cluster, ok in zip(clusters, succeeded) if not ok]
+
+
+def collect_metrics(args, output_file, run_summary, token=None, cluster=None):
+    """
+    Queries the metrics and writes them to output_file in the month's directory
+
+    Without a `token`, the one from the environment or of the logged in user is used.
+    The metrics are tagged with the `cluster` they come from, if one is given.
+    """
+    openshift_url = args.openshift_url
+    report_start_date = args.report_start_date
+    report_end_date = args.report_end_date
+
+    if token is None:
+        token = os.environ.get("OPENSHIFT_TOKEN")
+
+    if token is None:
+        with run_summary.stage("auth_token"):
+            token = openshift.get_auth_token()
+
+    session = utils.PrometheusSession(
+        token,
+        timeout=(10, args.query_timeout),
+        retry_budget=args.retry_budget,
+        pool_size=max(10, args.concurrency),
+        run_summary=run_summary,
+    )
 
     month_year = datetime.strptime(report_start_date, "%Y-%m-%d").strftime("%Y-%m")
     directory_name = f"data_{month_year}"
 
-    if not os.path.exists(directory_name):
-        os.makedirs(directory_name)
+    os.makedirs(directory_name, exist_ok=True)
 
     output_file = os.path.join(directory_name, output_file)
 
-    with open(output_file, "w") as file:
+    metrics_dict = {}
+    metrics_dict["start_date"] = report_start_date
+    metrics_dict["end_date"] = report_end_date
+    if cluster is not None:
+        metrics_dict["cluster"] = cluster
+    if args.condense or args.adaptive:
+        metrics_dict["format_version"] = utils.FORMAT_VERSION
+
+    if args.stream:
+        # the queries are sent one by one as the file is written, so the
+        # file is only moved into place once all of them have succeeded
+        temp_output_file = f"{output_file}.tmp"
+        metric_items = utils.iter_query_metrics(
+            openshift_url,
+            token,
+            get_queries(args, METRICS),
+            report_start_date,
+            report_end_date,
+            optional=OPTIONAL_METRICS,
+            session=session,
+        )
+        metric_items = (
+            (name, run_summary.count_series(metric_list)) for name, metric_list in metric_items
+        )
+        if args.condense:
+            metric_items = (
+                (name, utils.condense_series(metric_list)) for name, metric_list in metric_items
+            )
+        with run_summary.stage("query_and_write"):
+            try:
+                with open(temp_output_file, "w") as file:
+                    utils.dump_metrics(itertools.chain(metrics_dict.items(), metric_items), file)
+            except BaseException:
+                # a query failing halfway leaves nothing behind
+                if os.path.exists(temp_output_file):
+                    os.remove(temp_output_file)
+                raise
+            os.replace(temp_output_file, output_file)
+        run_summary.count("output_bytes", os.path.getsize(output_file))
+        return
+
+    metrics = get_queries(args, METRICS)
+    optional_metrics = OPTIONAL_METRICS
+    if args.aggregated:
+        metrics = get_queries(args, GPU_POD_METRICS)
+        # there may well be no pods requesting a GPU
+        optional_metrics = tuple(GPU_POD_METRICS)
+        with run_summary.stage("query_namespace_usage"):
+            metrics_dict["namespace_usage"] = utils.query_namespace_usage(
+                openshift_url,
+                token,
+                CPU_REQUEST,
+                MEMORY_REQUEST,
+                GPU_REQUEST,
+                report_start_date,
+                report_end_date,
+                session=session,
+            )
+
+    with run_summary.stage("query"):
+        if args.adaptive:
+            # the series come back as runs already
+            query_results = utils.query_metrics_adaptive(
+                openshift_url,
+                token,
+                metrics,
+                report_start_date,
+                report_end_date,
+                fine_step=args.fine_step,
+                optional=optional_metrics,
+                session=session,
+            )
+        else:
+            query_results = utils.query_metrics(
+                openshift_url,
+                token,
+                metrics,
+                report_start_date,
+                report_end_date,
+                max_workers=args.concurrency,
+                optional=optional_metrics,
+                shard=args.shard,
+                shard_workers=args.shard_concurrency,
+                session=session,
+            )
+    for metric_list in query_results.values():
+        run_summary.count("series", len(metric_list))
+        run_summary.count("samples", sum(map(utils.count_series_samples, metric_list)))
+    metrics_dict.update(query_results)
+    metrics_dict.setdefault("cpu_metrics", [])
+    metrics_dict.setdefault("memory_metrics", [])
+
+    if args.condense and not args.adaptive:
+        with run_summary.stage("condense"):
+            for name in METRICS:
+                if name in metrics_dict:
+                    metrics_dict[name] = list(utils.condense_series(metrics_dict[name]))
+
+    # written under a temporary name first, so that an interrupted
+    # write doesn't leave a partial file behind for merge.py or --backfill
+    temp_output_file = f"{output_file}.tmp"
+    with run_summary.stage("write"):
+        try:
+            if args.output_format == "snapshot":
+                utils.write_snapshot(metrics_dict, temp_output_file, compression=args.snapshot_compression)
+            else:
+                with open(temp_output_file, "w") as file:
+                    json.dump(metrics_dict, file)
+        except BaseException:
+            if os.path.exists(temp_output_file):
+                os.remove(temp_output_file)
+            raise
+        os.replace(temp_output_file, output_file)
+    run_summary.count("output_bytes", os.path.getsize(output_file))
+
+
+def get_queries(args, metrics):
+    """Returns the queries of the metrics, projected onto the --keep-labels"""
+    if args.keep_all_labels:
+        return metrics
+    return {name: utils.project_labels(query, args.keep_labels) for name, query in metrics.items()}
+
+
+def get_token():
+    """Returns the token from the environment or else from the logged in user"""
+    token = os.environ.get("OPENSHIFT_TOKEN")
+    if token is None:
+        token = openshift.get_auth_token()
+    return token
+
+
+def load_day_metrics(day):
+    """Loads what was collected so far of a day, as the metrics dict of its file"""
+    output_file = get_day_file(day)
+    if os.path.exists(output_file):
+        with open(output_file, "r") as file:
+            return json.load(file)
+    return {"start_date": day, "end_date": day}
+
+
+def get_day_file(day, extension=".json"):
+    """Returns the path of the file a day's metrics are collected in"""
+    month_year = datetime.strptime(day, "%Y-%m-%d").strftime("%Y-%m")
+    return os.path.join(f"data_{month_year}", f"metrics-{day}{extension}")
+
+
+def save_day_metrics(metrics_dict):
+    """Writes a day's metrics, replacing its file atomically"""
+    output_file = get_day_file(metrics_dict["start_date"])
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    temp_output_file = f"{output_file}.tmp"
+    with open(temp_output_file, "w") as file:
         json.dump(metrics_dict, file)
+    os.replace(temp_output_file, output_file)
+    return output_file
+
+
+def load_watermark(state_file):
+    """Returns the first sample time not collected yet, which is today's midnight at first"""
+    if os.path.exists(state_file):
+        with open(state_file, "r") as file:
+            return json.load(file)["watermark"]
+    now = int(time.time())
+    return now // (24 * 3600) * (24 * 3600)
+
+
+def save_watermark(watermark, state_file):
+    temp_state_file = f"{state_file}.tmp"
+    with open(temp_state_file, "w") as file:
+        json.dump({"watermark": watermark}, file)
+    os.replace(temp_state_file, state_file)
+
+
+def scrape(args, session, token, watermark, day_metrics, run_summary):
+    """
+    Queries the windows from the watermark up to now and appends them to the day files
+
+    Each day's file is written before the watermark moves past it, so a crash at worst
+    queries a window again, and stitching the series drops the repeated samples.
+    Returns the new watermark and the metrics of the last day collected.
+    """
+    for day, start_time, end_time in utils.get_scrape_windows(
+        watermark, int(time.time()), lag=args.lag
+    ):
+        if day_metrics is None or day_metrics["start_date"] != day:
+            day_metrics = load_day_metrics(day)
+        with run_summary.stage("query"):
+            results = utils.query_metrics_window(
+                args.openshift_url,
+                token,
+                get_queries(args, METRICS),
+                start_time,
+                end_time,
+                optional=OPTIONAL_METRICS,
+                session=session,
+            )
+        for name, metric_list in results.items():
+            run_summary.count("series", len(metric_list))
+            run_summary.count("samples", sum(map(utils.count_series_samples, metric_list)))
+            if not metric_list and name not in day_metrics:
+                # left out like an empty optional metric is in a one-shot run
+                continue
+            day_metrics[name] = utils.stitch_series([day_metrics.get(name, []), metric_list])
+        with run_summary.stage("write"):
+            output_file = save_day_metrics(day_metrics)
+        run_summary.count("output_bytes", os.path.getsize(output_file))
+        watermark = end_time + utils.STEP_MIN * 60
+        save_watermark(watermark, args.daemon_state)
+        print(f"Collected {day} up to {utils.epoch_to_rfc3339(end_time)} in {output_file}")
+    return watermark, day_metrics
+
+
+def run_daemon(args):
+    """
+    Keeps collecting the metrics every --interval minutes until terminated
+
+    The session and the token are kept between the queries. When a query fails, the
+    watermark stays where it was, so the next one covers the missed window as well,
+    and the token is fetched again unless it came from the environment.
+    """
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    token = get_token()
+    session = utils.PrometheusSession(
+        token, timeout=(10, args.query_timeout), retry_budget=args.retry_budget
+    )
+    watermark = load_watermark(args.daemon_state)
+    day_metrics = None
+    print(f"Collecting from {utils.epoch_to_rfc3339(watermark)} every {args.interval} minutes")
+
+    while not stop.is_set():
+        run_summary = utils.RunSummary("openshift_prometheus_metrics")
+        session.run_summary = run_summary
+        # the retries are budgeted per interval
+        session.retry_budget = args.retry_budget
+        try:
+            watermark, day_metrics = scrape(
+                args, session, token, watermark, day_metrics, run_summary
+            )
+            run_summary.succeeded = True
+        except (utils.EmptyResultError, requests.RequestException) as e:
+            print(f"Collection failed, retrying at the next interval: {e}")
+            if "OPENSHIFT_TOKEN" not in os.environ:
+                token = get_token()
+                session.set_token(token)
+        if args.metrics_textfile:
+            utils.write_metrics_textfile(run_summary, args.metrics_textfile)
+        if args.pushgateway_url:
+            utils.push_run_metrics(run_summary, args.pushgateway_url, args.pushgateway_job)
+        stop.wait(args.interval * 60)
+    print("Stopped")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,259 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import datetime
+import json
+import mock
+import os
+import sys
+import tempfile
+from unittest import TestCase
+
+from openshift_metrics import utils
+
+# merge.py is run as a script, importing utils from its own directory
+sys.path.insert(0, os.path.dirname(utils.__file__))
+import merge  # noqa: E402
+
+
+DAY = 24 * 3600
+# 2023-03-06
+FIRST_DAY = 1678060800
+
+
+def get_day_metrics(day):
+    """Returns the metrics file of a day, with pods that change in different ways"""
+    day_start = FIRST_DAY + day * DAY
+    date = datetime.datetime.fromtimestamp(day_start, datetime.timezone.utc).strftime("%Y-%m-%d")
+
+    def series(pod, namespace, resource, values):
+        return {
+            "metric": {"pod": pod, "namespace": namespace, "resource": resource},
+            "values": [[day_start + 900 * i, value] for i, value in enumerate(values)],
+        }
+
+    metrics_dict = {
+        "start_date": date,
+        "end_date": date,
+        "cpu_metrics": [
+            # never changes, so its only run stays open
+            series("pod1", "namespace1", "cpu", ["1"] * 4),
+            # resized every day
+            series("pod2", "namespace2", "cpu", [str(day + 1)] * 2 + [str(day + 2)] * 2),
+        ],
+        "memory_metrics": [
+            series("pod1", "namespace1", "memory", ["1073741824"] * 4),
+            series("pod2", "namespace2", "memory", ["2147483648"] * 4),
+        ],
+        "gpu_metrics": [],
+    }
+    if day == 0:
+        metrics_dict["namespace_usage"] = {"namespace0": {"_cpu_hours": 10, "_memory_hours": 20}}
+    if day == 1:
+        # gets a GPU the second day only
+        metrics_dict["gpu_metrics"].append(series("pod2", "namespace2", utils.GPU_A100, ["1"] * 4))
+    if day == 2:
+        metrics_dict["cpu_metrics"].append(series("pod3", "namespace3", "cpu", ["4"] * 4))
+    return metrics_dict
+
+
+class TestLoadMetricsFiles(TestCase):
+
+    def test_load_metrics_files_parallel(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = []
+            for day in range(3):
+                file_name = os.path.join(tmp_dir, f"metrics-{day}.json")
+                with open(file_name, "w") as file:
+                    json.dump(get_day_metrics(day), file)
+                files.append(file_name)
+
+            run_summary = utils.RunSummary("merge")
+            merged_dictionary, start_date, end_date = merge.load_metrics_files(files, run_summary)
+            parallel_run_summary = utils.RunSummary("merge")
+            parallel_merged_dictionary, parallel_start_date, parallel_end_date = (
+                merge.load_metrics_files_parallel(files, 2, parallel_run_summary)
+            )
+        self.assertEqual(
+            parallel_merged_dictionary.condense(merge.METRICS_TO_CHECK),
+            merged_dictionary.condense(merge.METRICS_TO_CHECK),
+        )
+        self.assertEqual((parallel_start_date, parallel_end_date), (start_date, end_date))
+        # the counts of the workers make it to the summary of the run
+        self.assertEqual(parallel_run_summary.counts, {"files": 3, "series": 14, "samples": 56})
+        self.assertEqual(parallel_run_summary.counts, run_summary.counts)
+
+
+class TestIncrementalMerge(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.files = []
+        for day in range(3):
+            file_name = os.path.join(self.tmp_dir.name, f"metrics-{day}.json")
+            with open(file_name, "w") as file:
+                json.dump(get_day_metrics(day), file)
+            self.files.append(file_name)
+        self.state_file = os.path.join(self.tmp_dir.name, "state.json")
+
+    def merge_fully(self, files):
+        merged_dictionary, start_date, end_date = merge.load_metrics_files(files)
+        condensed_metrics_dict = merge.utils.condense_metrics(merged_dictionary, merge.METRICS_TO_CHECK)
+        metrics_by_namespace = merge.utils.aggregate_metrics_by_namespace(condensed_metrics_dict)
+        merge.utils.add_namespace_usage(metrics_by_namespace, merged_dictionary.namespace_usage)
+        return condensed_metrics_dict, metrics_by_namespace, start_date, end_date
+
+    def assert_same_merge(self, incremental, full):
+        condensed_metrics_dict, metrics_by_namespace, _, start_date, end_date = incremental
+        expected_condensed_metrics_dict, expected_metrics_by_namespace, expected_start_date, expected_end_date = full
+        self.assertEqual(condensed_metrics_dict, expected_condensed_metrics_dict)
+        self.assertEqual(list(condensed_metrics_dict), list(expected_condensed_metrics_dict))
+        self.assertEqual(metrics_by_namespace, expected_metrics_by_namespace)
+        # the rows of the namespace report come in the same order too
+        self.assertEqual(list(metrics_by_namespace), list(expected_metrics_by_namespace))
+        self.assertEqual((start_date, end_date), (expected_start_date, expected_end_date))
+
+    def test_merge_incrementally_matches_full_merge(self):
+        for day in range(1, 4):
+            incremental = merge.merge_incrementally(self.files[:day], self.state_file, 1)
+            self.assert_same_merge(incremental, self.merge_fully(self.files[:day]))
+        self.assertEqual(list(incremental[1]), ["namespace1", "namespace2", "namespace3", "namespace0"])
+
+    def test_merge_incrementally_all_at_once(self):
+        merge.merge_incrementally(self.files[:1], self.state_file, 1)
+        incremental = merge.merge_incrementally(self.files, self.state_file, 1)
+        self.assert_same_merge(incremental, self.merge_fully(self.files))
+
+    def test_merge_incrementally_gpu_type_change(self):
+        merge.merge_incrementally(self.files[:1], self.state_file, 1)
+        with mock.patch.object(merge, "split_metrics_dict", wraps=merge.split_metrics_dict) as split:
+            incremental = merge.merge_incrementally(self.files[:2], self.state_file, 1)
+        # the closed runs are split off again to be summed up under the new GPU type
+        self.assertEqual(split.call_count, 2)
+        self.assertEqual(incremental[0]["namespace2/pod2"]["gpu_type"], utils.GPU_A100)
+        self.assertEqual(incremental[1]["namespace2"]["_cpu_hours"], 0)
+        self.assertGreater(incremental[1]["namespace2"]["SU_A100_GPU_HOURS"], 0)
+        self.assert_same_merge(incremental, self.merge_fully(self.files[:2]))
+
+    def test_merge_incrementally_skips_merged_files(self):
+        expected = merge.merge_incrementally(self.files[:2], self.state_file, 1)
+        with mock.patch.object(merge, "load_metrics_files", wraps=merge.load_metrics_files) as load:
+            self.assertEqual(merge.merge_incrementally(self.files[:2], self.state_file, 1), expected)
+            load.assert_not_called()
+            merge.merge_incrementally(self.files, self.state_file, 1)
+            load.assert_called_once_with(self.files[2:], mock.ANY)
+
+    def test_merge_incrementally_changed_file(self):
+        merge.merge_incrementally(self.files[:2], self.state_file, 1)
+        with open(self.state_file) as file:
+            state = file.read()
+        # more samples added to a day that was merged already
+        metrics_dict = get_day_metrics(1)
+        metrics_dict["cpu_metrics"][0]["values"].append([FIRST_DAY + DAY + 3600, "1"])
+        with open(self.files[1], "w") as file:
+            json.dump(metrics_dict, file)
+
+        with self.assertRaisesRegex(SystemExit, "metrics-1.json changed"):
+            merge.merge_incrementally(self.files, self.state_file, 1)
+        with open(self.state_file) as file:
+            self.assertEqual(file.read(), state)
+
+    def test_merge_incrementally_legacy_files(self):
+        merge.merge_incrementally(self.files[:2], self.state_file, 1)
+        with open(self.state_file) as file:
+            state = json.load(file)
+        state["files"] = list(state["files"])
+        with open(self.state_file, "w") as file:
+            json.dump(state, file)
+
+        # the files merged before get their signatures, without being merged again
+        with mock.patch.object(merge, "load_metrics_files", wraps=merge.load_metrics_files) as load:
+            merge.merge_incrementally(self.files[:2], self.state_file, 1)
+            load.assert_not_called()
+        self.assertEqual(merge.load_merge_state(self.state_file)["files"], {
+            os.path.abspath(file): merge.get_file_signature(file) for file in self.files[:2]
+        })
+
+    def test_merge_incrementally_nothing_merged(self):
+        self.assertRaises(SystemExit, merge.merge_incrementally, [], self.state_file, 1)
+
+    def test_merge_state_round_trip(self):
+        merge.merge_incrementally(self.files, self.state_file, 1)
+        state = merge.load_merge_state(self.state_file)
+        self.assertEqual(state["files"], {
+            os.path.abspath(file): merge.get_file_signature(file) for file in self.files
+        })
+        self.assertEqual((state["start_date"], state["end_date"]), ("2023-03-06", "2023-03-08"))
+        # the epoch times are integers again once loaded
+        self.assertEqual(state["pods"], self.merge_fully(self.files)[0])
+        self.assertEqual(list(state["namespace_usage"]), ["namespace0"])
+        self.assertEqual(state["namespace_usage"]["namespace0"]["_cpu_hours"], 10)
+
+        merge.save_merge_state(state, self.state_file)
+        self.assertEqual(merge.load_merge_state(self.state_file), state)
+        self.assertFalse(os.path.exists(f"{self.state_file}.tmp"))
+
+    def test_load_merge_state_missing(self):
+        state = merge.load_merge_state(self.state_file)
+        self.assertEqual(state["files"], {})
+        self.assertEqual(state["pods"], {})
+        self.assertIsNone(state["start_date"])
+
+    def test_load_merge_state_legacy_keys(self):
+        metrics = {"0": {"cpu_request": "1", "duration": 900}}
+        with open(self.state_file, "w") as file:
+            json.dump({
+                "files": [],
+                "start_date": "2023-03-06",
+                "end_date": "2023-03-06",
+                "pods": {
+                    "pod1": {"namespace": "namespace1", "gpu_type": utils.NO_GPU, "metrics": metrics},
+                    "pod2": {"namespace": "namespace2", "gpu_type": utils.NO_GPU, "metrics": metrics,
+                             "cluster": "east"},
+                },
+                "namespaces": {},
+            }, file)
+        state = merge.load_merge_state(self.state_file)
+        self.assertEqual(list(state["pods"]), ["namespace1/pod1", "east/namespace2/pod2"])
+        self.assertEqual(state["pods"]["namespace1/pod1"]["pod"], "pod1")
+        self.assertEqual(state["pods"]["namespace1/pod1"]["metrics"], {0: {"cpu_request": "1", "duration": 900}})
+        self.assertEqual(state["namespace_usage"], {})
+        self.assertEqual(state["cluster_namespace_usage"], {})
+
+    def test_split_metrics_dict(self):
+        condensed_metrics_dict = {
+            "namespace1/pod1": {
+                "namespace": "namespace1",
+                "pod": "pod1",
+                "gpu_type": utils.NO_GPU,
+                "metrics": {
+                    0: {"cpu_request": "1", "duration": 900},
+                    900: {"cpu_request": "2", "duration": 900},
+                },
+            },
+            "namespace2/pod2": {
+                "namespace": "namespace2",
+                "pod": "pod2",
+                "gpu_type": utils.NO_GPU,
+                "metrics": {0: {"cpu_request": "1", "duration": 900}},
+            },
+        }
+        closed_metrics_dict, open_metrics_dict = merge.split_metrics_dict(condensed_metrics_dict)
+        self.assertEqual(closed_metrics_dict["namespace1/pod1"]["metrics"], {0: {"cpu_request": "1", "duration": 900}})
+        self.assertEqual(open_metrics_dict["namespace1/pod1"]["metrics"], {900: {"cpu_request": "2", "duration": 900}})
+        self.assertEqual(closed_metrics_dict["namespace2/pod2"]["metrics"], {})
+        self.assertEqual(open_metrics_dict["namespace2/pod2"]["metrics"], {0: {"cpu_request": "1", "duration": 900}})
+        self.assertEqual(open_metrics_dict["namespace2/pod2"]["namespace"], "namespace2")
+        # the input is left as it was
+        self.assertEqual(len(condensed_metrics_dict["namespace1/pod1"]["metrics"]), 2)
@@ -0,0 +1,182 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import argparse
+import json
+import mock
+import os
+import requests
+import sys
+import tempfile
+from unittest import TestCase
+
+from openshift_metrics import utils
+
+# the collector is run as a script, importing utils from its own directory
+sys.path.insert(0, os.path.dirname(utils.__file__))
+import openshift_prometheus_metrics  # noqa: E402
+
+
+DAYS = ["2023-03-30", "2023-03-31", "2023-04-01"]
+FAILING_DAY = "2023-03-31"
+
+
+def get_args(**kwargs):
+    """Returns the arguments of a --backfill run over DAYS"""
+    args = argparse.Namespace(
+        openshift_url="https://prometheus.example.com",
+        report_start_date=DAYS[0],
+        report_end_date=DAYS[-1],
+        concurrency=1,
+        shard=None,
+        shard_concurrency=1,
+        stream=False,
+        condense=False,
+        adaptive=False,
+        fine_step=60,
+        aggregated=False,
+        output_format="json",
+        snapshot_compression="zlib",
+        query_timeout=10,
+        retry_budget=0,
+        keep_labels=list(utils.PROJECTED_LABELS),
+        keep_all_labels=False,
+        backfill_concurrency=2,
+    )
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+
+def fake_query_metric(openshift_url, token, metric, report_start_date, report_end_date, stream=False, **kwargs):
+    """Returns a series for every query, except for the memory of FAILING_DAY"""
+    if report_start_date == FAILING_DAY and 'unit="bytes"' in metric:
+        raise requests.exceptions.ConnectionError("connection reset")
+    series = [{"metric": {"pod": "pod1", "namespace": "namespace1"}, "values": [[0, "1"]]}]
+    return iter(series) if stream else series
+
+
+class TestBackfill(TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        # the day files are written relative to the working directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp_dir.name)
+        patcher = mock.patch.dict(os.environ, {"OPENSHIFT_TOKEN": "fake-token"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_written_files(self):
+        return sorted(
+            os.path.join(directory, file_name)
+            for directory, _, file_names in os.walk(".")
+            for file_name in file_names
+        )
+
+    def test_backfill_resumes(self):
+        collected_days = []
+        failing_days = {FAILING_DAY}
+
+        def fake_collect_metrics(args, output_file, run_summary, token=None, cluster=None):
+            self.assertEqual(args.report_start_date, args.report_end_date)
+            self.assertEqual(token, "fake-token")
+            if args.report_start_date in failing_days:
+                raise requests.exceptions.ConnectionError("connection reset")
+            collected_days.append(args.report_start_date)
+            with open(openshift_prometheus_metrics.get_day_file(args.report_start_date), "w") as file:
+                json.dump({"start_date": args.report_start_date}, file)
+
+        for directory in ("data_2023-03", "data_2023-04"):
+            os.makedirs(directory)
+        args = get_args()
+        run_summary = utils.RunSummary("openshift_prometheus_metrics")
+        with mock.patch.object(openshift_prometheus_metrics, "collect_metrics", side_effect=fake_collect_metrics):
+            failed_days = openshift_prometheus_metrics.backfill(args, ".json", run_summary)
+            self.assertEqual(failed_days, [FAILING_DAY])
+            self.assertEqual(sorted(collected_days), ["2023-03-30", "2023-04-01"])
+            self.assertEqual(run_summary.counts["days_failed"], 1)
+            self.assertEqual(run_summary.counts["days_collected"], 2)
+
+            # only the day that failed is collected again
+            collected_days.clear()
+            failing_days.clear()
+            run_summary = utils.RunSummary("openshift_prometheus_metrics")
+            failed_days = openshift_prometheus_metrics.backfill(args, ".json", run_summary)
+        self.assertEqual(failed_days, [])
+        self.assertEqual(collected_days, [FAILING_DAY])
+        self.assertEqual(run_summary.counts["days_skipped"], 2)
+        self.assertEqual(self.get_written_files(), [
+            "./data_2023-03/metrics-2023-03-30.json",
+            "./data_2023-03/metrics-2023-03-31.json",
+            "./data_2023-04/metrics-2023-04-01.json",
+        ])
+
+    def test_backfill_leaves_no_partial_file(self):
+        for stream in (False, True):
+            with self.subTest(stream=stream):
+                args = get_args(stream=stream)
+                run_summary = utils.RunSummary("openshift_prometheus_metrics")
+                with mock.patch.object(openshift_prometheus_metrics.utils, "query_metric",
+                                       side_effect=fake_query_metric):
+                    failed_days = openshift_prometheus_metrics.backfill(args, ".json", run_summary)
+                self.assertEqual(failed_days, [FAILING_DAY])
+                # the day that failed has neither a file nor a temporary one
+                self.assertEqual(self.get_written_files(), [
+                    "./data_2023-03/metrics-2023-03-30.json",
+                    "./data_2023-04/metrics-2023-04-01.json",
+                ])
+                with open("data_2023-04/metrics-2023-04-01.json") as file:
+                    self.assertEqual(json.load(file)["cpu_metrics"][0]["values"], [[0, "1"]])
+                for file_name in self.get_written_files():
+                    os.remove(file_name)
+
+
+class TestCollectClusters(TestCase):
+
+    def write_inventory(self, directory, clusters):
+        file_name = os.path.join(directory, "clusters.json")
+        with open(file_name, "w") as file:
+            json.dump({"clusters": clusters}, file)
+        return file_name
+
+    @mock.patch("openshift.get_auth_token", side_effect=AssertionError)
+    @mock.patch.object(openshift_prometheus_metrics, "collect_metrics")
+    def test_collect_clusters_tokens(self, mock_collect_metrics, mock_get_auth_token):
+        with tempfile.TemporaryDirectory() as directory:
+            token_file = os.path.join(directory, "west.token")
+            with open(token_file, "w") as file:
+                file.write("west-token\n")
+            args = get_args(
+                clusters=self.write_inventory(directory, [
+                    {"name": "east", "url": "https://east.example.com", "token_env": "EAST_TOKEN"},
+                    {"name": "west", "url": "https://west.example.com", "token_file": token_file},
+                ]),
+                cluster_concurrency=None,
+                run_summary=None,
+                metrics_textfile=None,
+                pushgateway_url=None,
+            )
+            with mock.patch.dict(os.environ, {"EAST_TOKEN": "east-token", "OPENSHIFT_TOKEN": "fake-token"}):
+                failed_clusters = openshift_prometheus_metrics.collect_clusters(args, "metrics.json")
+        self.assertEqual(failed_clusters, [])
+        tokens = {
+            call.kwargs["cluster"]: (call.args[0].openshift_url, call.kwargs["token"])
+            for call in mock_collect_metrics.call_args_list
+        }
+        self.assertEqual(tokens, {
+            "east": ("https://east.example.com", "east-token"),
+            "west": ("https://west.example.com", "west-token"),
+        })
+        mock_get_auth_token.assert_not_called()
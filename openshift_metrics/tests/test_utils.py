@@ -11,19 +11,26 @@
 #   under the License.
 #
 
+import datetime
+import gzip
+import http.server
+import itertools
+import json
+import math
 import mock
 import requests
 import tempfile
+import threading
 import time
+import types
 from unittest import TestCase
 
 from openshift_metrics import utils
-import openshift as oc
 
 
 class TestQueryMetric(TestCase):
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_query_metric(self, mock_get):
         mock_response = mock.Mock(status_code=200)
         mock_response.json.return_value = {"data": {
@@ -35,40 +42,580 @@ class TestQueryMetric(TestCase):
         self.assertEqual(metrics, "this is data")
         self.assertEqual(mock_get.call_count, 1)
 
-    @mock.patch('requests.get')
-    def test_query_metric_exception(self, mock_get):
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.get')
+    def test_query_metric_exception(self, mock_get, mock_sleep):
         mock_get.return_value = mock.Mock(status_code=404)
 
         self.assertRaises(Exception, utils.query_metric, 'fake-url', 'fake-token',
                           'fake-metric', '2022-03-14', '2022-03-14')
         self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
 
-class TestGetNamespaceAnnotations(TestCase):
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.get')
+    def test_query_metric_retry_after(self, mock_get, mock_sleep):
+        mock_busy_response = mock.Mock(status_code=429, headers={"Retry-After": "7"})
+        mock_response = mock.Mock(status_code=200)
+        mock_response.json.return_value = {"data": {
+            "result": "this is data"
+        }}
+        mock_get.side_effect = [mock_busy_response, mock_response]
 
-    @mock.patch('openshift.selector')
-    def test_get_namespace_annotations(self, mock_selector):
-        mock_namespaces = mock.Mock()
-        mock_namespaces.objects.return_value = [
-            oc.apiobject.APIObject({
-                'metadata': {
-                    'name': 'namespace1',
-                    'annotations': {
-                        'anno1': 'value1',
-                        'anno2': 'value2'
-                    }
-                }
-            }),
-            oc.apiobject.APIObject({
-                'metadata': {
-                    'name': 'namespace2',
-                    'annotations': {
-                        'anno3': 'value3',
-                        'anno4': 'value4'
-                    }
-                }
-            })
+        metrics = utils.query_metric('fake-url', 'fake-token', 'fake-metric', '2022-03-14', '2022-03-14')
+        self.assertEqual(metrics, "this is data")
+        mock_sleep.assert_called_once_with(7)
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.get')
+    def test_query_metric_retry_after_capped(self, mock_get, mock_sleep):
+        mock_busy_response = mock.Mock(status_code=429, headers={"Retry-After": "86400"})
+        mock_response = mock.Mock(status_code=200)
+        mock_response.json.return_value = {"data": {
+            "result": "this is data"
+        }}
+        mock_get.side_effect = [mock_busy_response, mock_response]
+        session = utils.PrometheusSession('fake-token', max_backoff=60)
+
+        utils.query_metric('fake-url', 'fake-token', 'fake-metric', '2022-03-14', '2022-03-14',
+                           session=session)
+        mock_sleep.assert_called_once_with(60)
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.get')
+    def test_query_metric_retry_budget(self, mock_get, mock_sleep):
+        mock_get.return_value = mock.Mock(status_code=500)
+        session = utils.PrometheusSession('fake-token', retry_budget=3)
+
+        for _ in range(2):
+            self.assertRaises(utils.EmptyResultError, utils.query_metric, 'fake-url', 'fake-token',
+                              'fake-metric', '2022-03-14', '2022-03-14', session=session)
+        # 2 retries for the first query, 1 left for the second one
+        self.assertEqual(mock_get.call_count, 5)
+        self.assertEqual(mock_sleep.call_count, 3)
+
+    @mock.patch('requests.Session.get')
+    def test_query_metric_sharded(self, mock_get):
+        def fake_get(url, params, **kwargs):
+            if params['start'] == '2022-03-14T00:00:00Z':
+                result = [{"metric": {"pod": "pod1"}, "values": [[0, "1"], [900, "1"]]}]
+            else:
+                result = [{"metric": {"pod": "pod1"}, "values": [[900, "1"], [1800, "2"]]},
+                          {"metric": {"pod": "pod2"}, "values": [[1800, "3"]]}]
+            mock_response = mock.Mock(status_code=200)
+            mock_response.json.return_value = {"data": {"result": result}}
+            return mock_response
+        mock_get.side_effect = fake_get
+
+        metrics = utils.query_metric('fake-url', 'fake-token', 'fake-metric',
+                                     '2022-03-14', '2022-03-15', shard='day', shard_workers=2)
+        expected_metrics = [
+            {"metric": {"pod": "pod1"}, "values": [[0, "1"], [900, "1"], [1800, "2"]]},
+            {"metric": {"pod": "pod2"}, "values": [[1800, "3"]]},
+        ]
+        self.assertEqual(metrics, expected_metrics)
+        self.assertEqual(mock_get.call_count, 2)
+
+    @mock.patch('requests.Session.get')
+    def test_query_metric_sharded_empty(self, mock_get):
+        mock_response = mock.Mock(status_code=200)
+        mock_response.json.return_value = {"data": {"result": []}}
+        mock_get.return_value = mock_response
+
+        self.assertRaises(utils.EmptyResultError, utils.query_metric, 'fake-url', 'fake-token',
+                          'fake-metric', '2022-03-14', '2022-03-14', shard='hour')
+        self.assertEqual(mock_get.call_count, 24)
+
+
+    @mock.patch('requests.Session.get')
+    def test_query_metric_stream(self, mock_get):
+        mock_response = mock.MagicMock(status_code=200)
+        mock_response.iter_content.return_value = [
+            b'{"status":"success","data":{"resultType":"matrix","result":[{"metric":{"pod":"po',
+            b'd1"},"values":[[0,"1"]]},{"metric":{"pod":"pod2"},"values":[[0,"2"]]}]}}',
+        ]
+        mock_get.return_value = mock_response
+
+        metrics = utils.query_metric('fake-url', 'fake-token', 'fake-metric',
+                                     '2022-03-14', '2022-03-14', stream=True)
+        self.assertEqual(list(metrics), [
+            {"metric": {"pod": "pod1"}, "values": [[0, "1"]]},
+            {"metric": {"pod": "pod2"}, "values": [[0, "2"]]},
+        ])
+        self.assertEqual(mock_get.call_args.kwargs['stream'], True)
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.get')
+    def test_query_metric_stream_empty(self, mock_get, mock_sleep):
+        mock_response = mock.MagicMock(status_code=200)
+        mock_response.iter_content.return_value = [b'{"status":"success","data":{"result":[]}}']
+        mock_get.return_value = mock_response
+
+        self.assertRaises(utils.EmptyResultError, utils.query_metric, 'fake-url', 'fake-token',
+                          'fake-metric', '2022-03-14', '2022-03-14', stream=True)
+        self.assertEqual(mock_get.call_count, 3)
+
+
+class TestRunSummary(TestCase):
+
+    def test_stage(self):
+        run_summary = utils.RunSummary("test")
+        for _ in range(2):
+            with run_summary.stage("merge"):
+                pass
+        with self.assertRaises(ValueError):
+            with run_summary.stage("write"):
+                raise ValueError()
+
+        stages = run_summary.as_dict()["stages"]
+        self.assertEqual(list(stages), ["merge", "write"])
+        self.assertEqual(stages["merge"]["calls"], 2)
+        self.assertEqual(stages["write"]["calls"], 1)
+
+    def test_count_series(self):
+        run_summary = utils.RunSummary("test")
+        metric_list = [
+            {"metric": {"pod": "pod1"}, "values": [[0, "1"], [900, "1"]]},
+            {"metric": {"pod": "pod2"}, "step": 900, "runs": [[0, 2700, "1"]]},
         ]
-        mock_selector.return_value = mock_namespaces
+        self.assertEqual(list(run_summary.count_series(metric_list)), metric_list)
+        self.assertEqual(run_summary.counts, {"series": 2, "samples": 5})
+
+    @mock.patch('requests.Session.get')
+    def test_record_queries(self, mock_get):
+        mock_response = mock.Mock(status_code=200, content=b'{"data": {"result": "this is data"}}')
+        mock_response.json.return_value = {"data": {
+            "result": "this is data"
+        }}
+        mock_get.return_value = mock_response
+        run_summary = utils.RunSummary("test")
+        session = utils.PrometheusSession('fake-token', run_summary=run_summary)
+
+        utils.query_metric('fake-url', 'fake-token', 'fake-metric', '2022-03-14', '2022-03-14',
+                           session=session)
+        self.assertEqual(len(run_summary.queries), 1)
+        query = run_summary.queries[0]
+        self.assertEqual(query["query"], "fake-metric")
+        self.assertEqual(query["status"], 200)
+        self.assertEqual(query["bytes"], len(mock_response.content))
+
+        with tempfile.NamedTemporaryFile(mode="r", suffix=".json") as file:
+            run_summary.write(file.name)
+            summary = json.load(file)
+        self.assertEqual(summary["command"], "test")
+        self.assertEqual(summary["queries"], run_summary.queries)
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.get')
+    def test_count_retries(self, mock_get, mock_sleep):
+        mock_get.return_value = mock.Mock(status_code=500, content=b"")
+        run_summary = utils.RunSummary("test")
+        session = utils.PrometheusSession('fake-token', run_summary=run_summary)
+
+        self.assertRaises(utils.EmptyResultError, utils.query_metric, 'fake-url', 'fake-token',
+                          'fake-metric', '2022-03-14', '2022-03-14', session=session)
+        self.assertEqual(run_summary.counts, {"retries": 2, "empty_results": 1})
+        self.assertEqual([query["status"] for query in run_summary.queries], [500] * 3)
+
+
+class TestRunMetrics(TestCase):
+
+    def make_run_summary(self, succeeded):
+        run_summary = utils.RunSummary("collector")
+        with run_summary.stage("query"):
+            pass
+        run_summary.count("series", 3)
+        run_summary.count("retries", 2)
+        run_summary.count("empty_results")
+        run_summary.record_query("fake-url", {"query": "fake-metric"}, 1.5, 200, 100)
+        run_summary.record_query("fake-url", {"query": "fake-metric"}, 0.5, 503, 10)
+        run_summary.succeeded = succeeded
+        return run_summary
+
+    def test_format_run_metrics(self):
+        text = utils.format_run_metrics(self.make_run_summary(True))
+        lines = text.splitlines()
+        self.assertIn('openshift_metrics_run_success{command="collector"} 1', lines)
+        self.assertIn('openshift_metrics_query_duration_seconds_sum{command="collector"} 2.0', lines)
+        self.assertIn('openshift_metrics_query_duration_seconds_count{command="collector"} 2', lines)
+        self.assertIn('openshift_metrics_query_max_duration_seconds{command="collector"} 1.5', lines)
+        self.assertIn('openshift_metrics_query_failures{command="collector"} 1', lines)
+        self.assertIn('openshift_metrics_query_retries{command="collector"} 2', lines)
+        self.assertIn('openshift_metrics_query_empty_results{command="collector"} 1', lines)
+        self.assertIn('openshift_metrics_series{command="collector"} 3', lines)
+        self.assertTrue(any(
+            line.startswith('openshift_metrics_run_stage_duration_seconds{command="collector",stage="query"} ')
+            for line in lines
+        ))
+        self.assertTrue(any(
+            line.startswith('openshift_metrics_last_success_timestamp_seconds{command="collector"} ')
+            for line in lines
+        ))
+
+    def test_format_run_metrics_labels(self):
+        run_summary = utils.RunSummary("collector", labels={"cluster": "east"})
+        lines = utils.format_run_metrics(run_summary).splitlines()
+        self.assertIn('openshift_metrics_run_success{command="collector",cluster="east"} 0', lines)
+
+    def test_write_metrics_textfile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = f"{directory}/collector.prom"
+            utils.write_metrics_textfile(self.make_run_summary(True), file_name)
+            last_success = utils.read_last_success(file_name)
+            self.assertIsNotNone(last_success)
+
+            # a failed run keeps the last success
+            utils.write_metrics_textfile(self.make_run_summary(False), file_name)
+            self.assertEqual(utils.read_last_success(file_name), last_success)
+            with open(file_name) as file:
+                self.assertIn('openshift_metrics_run_success{command="collector"} 0\n', file.read())
+
+    def test_push_run_metrics(self):
+        requests_received = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                requests_received.append((self.path, body.decode()))
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = f"http://127.0.0.1:{server.server_port}/"
+            self.assertTrue(utils.push_run_metrics(self.make_run_summary(False), url, "collector"))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        path, body = requests_received[0]
+        self.assertEqual(path, "/metrics/job/collector")
+        self.assertIn('openshift_metrics_run_success{command="collector"} 0\n', body)
+        self.assertNotIn("last_success_timestamp_seconds", body)
+
+    @mock.patch('requests.post')
+    def test_push_run_metrics_grouping_key(self, mock_post):
+        mock_post.return_value = mock.Mock(status_code=200)
+        run_summary = utils.RunSummary("collector", labels={"cluster": "east"})
+        self.assertTrue(utils.push_run_metrics(run_summary, "http://pushgateway/", "collector"))
+        self.assertEqual(mock_post.call_args.args[0], "http://pushgateway/metrics/job/collector/cluster/east")
+
+        # values that would break the path are base64-encoded
+        run_summary = utils.RunSummary("collector", labels={"cluster": "us/east", "zone": ""})
+        utils.push_run_metrics(run_summary, "http://pushgateway", "openshift metrics")
+        self.assertEqual(
+            mock_post.call_args.args[0],
+            "http://pushgateway/metrics/job@base64/b3BlbnNoaWZ0IG1ldHJpY3M="
+            "/cluster@base64/dXMvZWFzdA==/zone@base64/=",
+        )
+
+    def test_push_run_metrics_failure(self):
+        # nothing listens on the port, which shouldn't fail the run
+        self.assertFalse(utils.push_run_metrics(self.make_run_summary(True), "http://127.0.0.1:9", "collector"))
+
+
+class TestIterResultSeries(TestCase):
+
+    def test_iter_result_series(self):
+        response = ('{"status": "success", "data": {"resultType": "matrix", "result": [\n'
+                    '  {"metric": {"pod": "pod1", "note": "]"}, "values": [[0, "10"], [60, "15"]]},\n'
+                    '  {"metric": {"pod": "pod2"}, "values": [[0, "30"]]}\n'
+                    ']}}')
+        expected_series = [
+            {"metric": {"pod": "pod1", "note": "]"}, "values": [[0, "10"], [60, "15"]]},
+            {"metric": {"pod": "pod2"}, "values": [[0, "30"]]},
+        ]
+        for chunk_size in (1, 7, len(response)):
+            chunks = [response[i:i + chunk_size] for i in range(0, len(response), chunk_size)]
+            self.assertEqual(list(utils.iter_result_series(chunks)), expected_series)
+
+    def test_iter_result_series_empty(self):
+        self.assertEqual(list(utils.iter_result_series(['{"data": {"result": []}}'])), [])
+
+    def test_iter_result_series_truncated(self):
+        series = utils.iter_result_series(['{"data": {"result": [{"metric": {"pod": "po'])
+        self.assertRaises(ValueError, list, series)
+
+
+class TestDumpMetrics(TestCase):
+
+    def test_dump_metrics(self):
+        metrics_dict = {
+            "start_date": "2022-03-14",
+            "cpu_metrics": [{"metric": {"pod": "pod1"}, "values": [[0, "1"]]}],
+        }
+        streamed_items = [
+            ("start_date", "2022-03-14"),
+            ("cpu_metrics", iter([{"metric": {"pod": "pod1"}, "values": [[0, "1"]]}])),
+        ]
+        with tempfile.TemporaryFile("w+") as file:
+            utils.dump_metrics(streamed_items, file)
+            file.seek(0)
+            self.assertEqual(file.read(), json.dumps(metrics_dict))
+
+
+class TestGetShardWindows(TestCase):
+
+    def test_get_shard_windows(self):
+        windows = utils.get_shard_windows('2022-03-14T00:00:00Z', '2022-03-16T23:59:59Z', 86400)
+        self.assertEqual(windows, [
+            ('2022-03-14T00:00:00Z', '2022-03-15T00:00:00Z'),
+            ('2022-03-15T00:00:00Z', '2022-03-16T00:00:00Z'),
+            ('2022-03-16T00:00:00Z', '2022-03-16T23:59:59Z'),
+        ])
+
+    def test_get_shard_windows_single(self):
+        windows = utils.get_shard_windows('2022-03-14T00:00:00Z', '2022-03-14T00:30:00Z', 3600)
+        self.assertEqual(windows, [('2022-03-14T00:00:00Z', '2022-03-14T00:30:00Z')])
+
+
+class TestGetScrapeWindows(TestCase):
+
+    def test_get_scrape_windows(self):
+        midnight = 1678060800  # 2023-03-06T00:00:00Z
+        windows = utils.get_scrape_windows(midnight, midnight + 3600 + 100)
+        self.assertEqual(windows, [("2023-03-06", midnight, midnight + 3600)])
+
+    def test_get_scrape_windows_lag(self):
+        midnight = 1678060800
+        windows = utils.get_scrape_windows(midnight + 900, midnight + 3600 + 100, lag=300)
+        self.assertEqual(windows, [("2023-03-06", midnight + 900, midnight + 2700)])
+        self.assertEqual(utils.get_scrape_windows(midnight + 900, midnight + 1000, lag=300), [])
+
+    def test_get_scrape_windows_across_days(self):
+        midnight = 1678060800
+        windows = utils.get_scrape_windows(midnight - 1800, midnight + 1800)
+        self.assertEqual(windows, [
+            ("2023-03-05", midnight - 1800, midnight - 900),
+            ("2023-03-06", midnight, midnight + 1800),
+        ])
+
+
+class TestProjectLabels(TestCase):
+
+    def test_project_labels(self):
+        query = 'kube_pod_resource_request{unit="cores"} unless on(pod, namespace) kube_pod_status_unschedulable'
+        self.assertEqual(
+            utils.project_labels(query),
+            f"max by (namespace, pod, resource) ({query})",
+        )
+        self.assertEqual(
+            utils.project_labels("up", ["namespace", "pod", "resource", "node"]),
+            "max by (namespace, pod, resource, node) (up)",
+        )
+
+    def test_project_labels_required(self):
+        self.assertRaises(ValueError, utils.project_labels, "up", ["namespace", "pod"])
+
+
+class TestGetReportDays(TestCase):
+
+    def test_get_report_days(self):
+        self.assertEqual(utils.get_report_days("2023-02-27", "2023-03-02"),
+                         ["2023-02-27", "2023-02-28", "2023-03-01", "2023-03-02"])
+        self.assertEqual(utils.get_report_days("2023-03-01", "2023-03-01"), ["2023-03-01"])
+        self.assertEqual(utils.get_report_days("2023-03-02", "2023-03-01"), [])
+
+
+class TestQueryMetricsWindow(TestCase):
+
+    @mock.patch('requests.Session.get')
+    def test_query_metrics_window(self, mock_get):
+        def fake_get(url, params, **kwargs):
+            result = [] if params["query"] == "gpu" else [{"metric": {"pod": params["query"]}}]
+            response = mock.Mock(status_code=200)
+            response.json.return_value = {"data": {"result": result}}
+            return response
+        mock_get.side_effect = fake_get
+
+        metrics = utils.query_metrics_window(
+            'fake-url', 'fake-token', {"cpu_metrics": "cpu", "gpu_metrics": "gpu"},
+            1678060800, 1678064400, optional=("gpu_metrics",))
+        self.assertEqual(metrics, {"cpu_metrics": [{"metric": {"pod": "cpu"}}], "gpu_metrics": []})
+        self.assertEqual(mock_get.call_args_list[0].kwargs["params"]["start"], "2023-03-06T00:00:00Z")
+        self.assertEqual(mock_get.call_args_list[0].kwargs["params"]["end"], "2023-03-06T01:00:00Z")
+
+
+class TestQueryMetrics(TestCase):
+
+    @mock.patch('openshift_metrics.utils.query_metric')
+    def test_query_metrics(self, mock_query_metric):
+        mock_query_metric.side_effect = lambda url, token, metric, start, end, **kwargs: f"data for {metric}"
+
+        metrics = utils.query_metrics('fake-url', 'fake-token',
+                                      {'cpu': 'cpu-metric', 'memory': 'memory-metric'},
+                                      '2022-03-14', '2022-03-14', max_workers=2)
+        self.assertEqual(metrics, {'cpu': 'data for cpu-metric', 'memory': 'data for memory-metric'})
+        self.assertEqual(mock_query_metric.call_count, 2)
+
+    @mock.patch('openshift_metrics.utils.query_metric')
+    def test_query_metrics_optional_empty(self, mock_query_metric):
+        def fake_query_metric(url, token, metric, start, end, **kwargs):
+            if metric == 'gpu-metric':
+                raise utils.EmptyResultError()
+            return f"data for {metric}"
+        mock_query_metric.side_effect = fake_query_metric
+
+        metrics = utils.query_metrics('fake-url', 'fake-token',
+                                      {'cpu': 'cpu-metric', 'gpu': 'gpu-metric'},
+                                      '2022-03-14', '2022-03-14', optional=('gpu',))
+        self.assertEqual(metrics, {'cpu': 'data for cpu-metric'})
+        self.assertRaises(utils.EmptyResultError, utils.query_metrics, 'fake-url', 'fake-token',
+                          {'cpu': 'cpu-metric', 'gpu': 'gpu-metric'}, '2022-03-14', '2022-03-14')
+
+
+class TestQueryNamespaceUsage(TestCase):
+
+    @mock.patch('requests.Session.get')
+    def test_query_namespace_usage(self, mock_get):
+        def fake_get(url, params, **kwargs):
+            self.assertTrue(url.endswith("/api/v1/query"))
+            self.assertEqual(params["time"], "2023-03-02T23:59:59Z")
+            self.assertIn("[2d:15m]", params["query"])
+            if params["query"].startswith(
+                    "sum by (namespace) (sum_over_time((max by (namespace, pod) (cpu unless"):
+                result = [{"metric": {"namespace": "namespace1"}, "value": [0, "8"]}]
+            else:
+                result = [{"metric": {"namespace": "namespace1"}, "value": [0, str(16 * 2**30)]},
+                          {"metric": {"namespace": "namespace2"}, "value": [0, str(4 * 2**30)]}]
+            response = mock.Mock(status_code=200)
+            response.json.return_value = {"data": {"result": result}}
+            return response
+        mock_get.side_effect = fake_get
+
+        usage = utils.query_namespace_usage(
+            'fake-url', 'fake-token', 'cpu', 'memory', 'gpu', '2023-03-01', '2023-03-02')
+        # every sample counts for a 15 minute step
+        self.assertEqual(usage, {
+            "namespace1": {"_cpu_hours": 2, "_memory_hours": 4},
+            "namespace2": {"_cpu_hours": 0, "_memory_hours": 1},
+        })
+
+    def test_add_namespace_usage(self):
+        metrics_by_namespace = utils.aggregate_metrics_by_namespace({
+            "pod1": {
+                "namespace": "namespace1",
+                "gpu_type": utils.NO_GPU,
+                "metrics": {0: {"cpu_request": "2", "memory_request": str(2**30), "duration": 3600}},
+            },
+        })
+        utils.add_namespace_usage(metrics_by_namespace, {
+            "namespace1": {"_cpu_hours": 2, "_memory_hours": 4},
+            "namespace2": {"_cpu_hours": 1, "_memory_hours": 0},
+        })
+        self.assertEqual(metrics_by_namespace["namespace1"]["_cpu_hours"], 4)
+        self.assertEqual(metrics_by_namespace["namespace1"]["_memory_hours"], 5)
+        self.assertEqual(metrics_by_namespace["namespace2"],
+                         dict(utils.new_namespace_metrics(), _cpu_hours=1))
+
+    def test_store_update_namespace_usage(self):
+        store = utils.PodMetricsStore()
+        other_store = utils.PodMetricsStore()
+        utils.add_namespace_usage(store.namespace_usage, {"namespace1": {"_cpu_hours": 1}})
+        utils.add_namespace_usage(other_store.namespace_usage, {"namespace1": {"_cpu_hours": 2}})
+        store.update(other_store)
+        self.assertEqual(store.namespace_usage["namespace1"]["_cpu_hours"], 3)
+
+
+class TestQueryMetricsAdaptive(TestCase):
+
+    def test_get_adaptive_queries(self):
+        stable_queries, fine_queries = utils.get_adaptive_queries(
+            {"cpu_metrics": "cpu", "memory_metrics": "memory"}, "2023-03-01", "2023-03-02")
+        # pinned to 2023-03-02T23:59:59Z, with 2 days of 15 minute steps
+        self.assertIn("(last_over_time((cpu)[2d:15m] @ 1677801599)", stable_queries["cpu_metrics"])
+        self.assertIn("(count_over_time((cpu)[2d:15m] @ 1677801599) == 192)", stable_queries["cpu_metrics"])
+        self.assertTrue(fine_queries["memory_metrics"].startswith("(memory) and on(namespace, pod) ("))
+        # a pod is only stable if none of its series change
+        for query in [*stable_queries.values(), *fine_queries.values()]:
+            self.assertIn("(count_over_time((cpu)[2d:15m] @ 1677801599) unless", query)
+            self.assertIn("(count_over_time((memory)[2d:15m] @ 1677801599) unless", query)
+
+    @mock.patch('requests.Session.get')
+    def test_query_metrics_adaptive(self, mock_get):
+        def fake_get(url, params, **kwargs):
+            if url.endswith("/api/v1/query"):
+                result = [{"metric": {"pod": "pod1", "namespace": "namespace1"}, "value": [0, "2"]}]
+            else:
+                self.assertEqual(params["step"], "60s")
+                result = [{"metric": {"pod": "pod2", "namespace": "namespace1"},
+                           "values": [[1677628800, "1"], [1677628860, "1"], [1677628920, "4"]]}]
+            if params["query"].startswith("(last_over_time((gpu)") or params["query"].startswith("(gpu)"):
+                result = []
+            response = mock.Mock(status_code=200)
+            response.json.return_value = {"data": {"result": result}}
+            return response
+        mock_get.side_effect = fake_get
+
+        results = utils.query_metrics_adaptive(
+            'fake-url', 'fake-token', {"cpu_metrics": "cpu", "gpu_metrics": "gpu"},
+            '2023-03-01', '2023-03-01', optional=("gpu_metrics",))
+        self.assertEqual(results, {
+            "cpu_metrics": [
+                {"metric": {"pod": "pod1", "namespace": "namespace1"}, "step": 900,
+                 "runs": [[1677628800, 24 * 3600, "2"]]},
+                {"metric": {"pod": "pod2", "namespace": "namespace1"}, "step": 60,
+                 "runs": [[1677628800, 120, "1"], [1677628920, 60, "4"]]},
+            ],
+        })
+
+        mock_get.side_effect = lambda url, params, **kwargs: fake_get(url, dict(params, query="(gpu)"))
+        self.assertRaises(utils.EmptyResultError, utils.query_metrics_adaptive,
+                          'fake-url', 'fake-token', {"cpu_metrics": "cpu"}, '2023-03-01', '2023-03-01')
+
+    @mock.patch('requests.Session.get')
+    def test_query_metrics_adaptive_days(self, mock_get):
+        windows = []
+
+        def fake_get(url, params, **kwargs):
+            if url.endswith("/api/v1/query"):
+                result = []
+            else:
+                start = int(datetime.datetime.strptime(params["start"], utils.RFC3339_FORMAT)
+                            .replace(tzinfo=datetime.timezone.utc).timestamp())
+                end = int(datetime.datetime.strptime(params["end"], utils.RFC3339_FORMAT)
+                          .replace(tzinfo=datetime.timezone.utc).timestamp())
+                windows.append((start, end))
+                # every sample of the window, at most 11,000 of them
+                self.assertLessEqual((end - start) // 60 + 1, 11000)
+                result = [{"metric": {"pod": "pod1", "namespace": "namespace1"},
+                           "values": [[epoch_time, "2" if epoch_time >= 1677715200 else "1"]
+                                      for epoch_time in range(start, end + 1, 60)]}]
+            response = mock.Mock(status_code=200)
+            response.json.return_value = {"data": {"result": result}}
+            return response
+        mock_get.side_effect = fake_get
+
+        # a month of samples a minute apart, which is too many for a single query
+        results = utils.query_metrics_adaptive(
+            'fake-url', 'fake-token', {"cpu_metrics": "cpu"}, '2023-03-01', '2023-03-31')
+        self.assertEqual(len(windows), 31)
+        self.assertEqual(windows[0][0], 1677628800)
+        self.assertEqual(windows[-1][1], 1680307199)
+        # stitched back into the runs of a single query over the month
+        self.assertEqual(results, {
+            "cpu_metrics": [
+                {"metric": {"pod": "pod1", "namespace": "namespace1"}, "step": 60,
+                 "runs": [[1677628800, 24 * 3600, "1"], [1677715200, 30 * 24 * 3600, "2"]]},
+            ],
+        })
+
+
+class TestGetNamespaceAnnotations(TestCase):
+
+    @mock.patch('openshift.invoke')
+    def test_get_namespace_annotations(self, mock_invoke):
+        mock_invoke.return_value.out.return_value = (
+            'namespace1\t{"anno1":"value1","anno2":"value2"}\n'
+            'namespace2\t{"anno3":"value3","anno4":"value4"}\n'
+            'namespace3\t\n'
+        )
 
         namespaces_dict = utils.get_namespace_annotations()
         expected_namespaces_dict = {
@@ -79,9 +626,104 @@ class TestGetNamespaceAnnotations(TestCase):
             'namespace2': {
                 'anno3': 'value3',
                 'anno4': 'value4'
-            }
+            },
+            'namespace3': {}
         }
         self.assertEqual(namespaces_dict, expected_namespaces_dict)
+        self.assertEqual(mock_invoke.call_args.args[0], 'get')
+        self.assertEqual(mock_invoke.call_args.args[1][0], 'namespaces')
+
+
+class TestLoadNamespaceAnnotations(TestCase):
+
+    annotations = {'namespace1': {'cf_pi': 'PI1'}}
+
+    @mock.patch('openshift_metrics.utils.get_namespace_annotations')
+    def test_load_namespace_annotations_no_cache(self, mock_gna):
+        mock_gna.return_value = self.annotations
+        self.assertEqual(utils.load_namespace_annotations(), self.annotations)
+        self.assertEqual(mock_gna.call_count, 1)
+
+    @mock.patch('openshift_metrics.utils.get_namespace_annotations')
+    def test_load_namespace_annotations_cache(self, mock_gna):
+        mock_gna.return_value = self.annotations
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = f"{tmp_dir}/annotations.json"
+            self.assertEqual(utils.load_namespace_annotations(cache_file), self.annotations)
+            self.assertEqual(utils.load_namespace_annotations(cache_file), self.annotations)
+            self.assertEqual(mock_gna.call_count, 1)
+
+            # expired
+            self.assertEqual(utils.load_namespace_annotations(cache_file, cache_ttl=0), self.annotations)
+            self.assertEqual(mock_gna.call_count, 2)
+
+    @mock.patch('openshift_metrics.utils.get_namespace_annotations')
+    def test_load_namespace_annotations_offline(self, mock_gna):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = f"{tmp_dir}/annotations.json"
+            self.assertRaises(FileNotFoundError, utils.load_namespace_annotations,
+                              cache_file, offline=True)
+            with open(cache_file, "w") as file:
+                json.dump({"fetched_at": 0, "annotations": self.annotations}, file)
+            self.assertEqual(utils.load_namespace_annotations(cache_file, offline=True),
+                             self.annotations)
+        self.assertEqual(mock_gna.call_count, 0)
+
+
+class TestClusterInventory(TestCase):
+
+    def write_inventory(self, directory, clusters):
+        file_name = f"{directory}/clusters.json"
+        with open(file_name, "w") as file:
+            json.dump({"clusters": clusters}, file)
+        return file_name
+
+    def test_load_cluster_inventory(self):
+        clusters = [
+            {"name": "east", "url": "https://east.example.com", "token_env": "EAST_TOKEN"},
+            {"name": "west", "url": "https://west.example.com", "token_file": "west.token", "concurrency": 2},
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = self.write_inventory(directory, clusters)
+            self.assertEqual(utils.load_cluster_inventory(file_name), clusters)
+
+    def test_load_cluster_inventory_invalid(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = self.write_inventory(directory, [{"name": "east"}])
+            self.assertRaises(ValueError, utils.load_cluster_inventory, file_name)
+
+            file_name = self.write_inventory(directory, [
+                {"name": "east", "url": "https://east.example.com", "token_env": "EAST_TOKEN"},
+                {"name": "east", "url": "https://west.example.com", "token_env": "WEST_TOKEN"},
+            ])
+            self.assertRaises(ValueError, utils.load_cluster_inventory, file_name)
+
+    def test_load_cluster_inventory_no_token_source(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = self.write_inventory(directory, [
+                {"name": "east", "url": "https://east.example.com", "token_env": "EAST_TOKEN"},
+                {"name": "west", "url": "https://west.example.com"},
+            ])
+            with self.assertRaisesRegex(ValueError, "west"):
+                utils.load_cluster_inventory(file_name)
+
+    def test_load_cluster_inventory_empty(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = self.write_inventory(directory, [])
+            self.assertRaises(ValueError, utils.load_cluster_inventory, file_name)
+
+    def test_get_cluster_token(self):
+        with mock.patch.dict("os.environ", {"EAST_TOKEN": "token1"}):
+            self.assertEqual(utils.get_cluster_token({"token_env": "EAST_TOKEN"}), "token1")
+        with tempfile.NamedTemporaryFile("w") as file:
+            file.write("token2\n")
+            file.flush()
+            self.assertEqual(utils.get_cluster_token({"token_file": file.name}), "token2")
+
+    def test_cluster_file_name(self):
+        self.assertEqual(utils.cluster_file_name("metrics-2023-03-01.json", "east"),
+                         "metrics-2023-03-01-east.json")
+        self.assertEqual(utils.cluster_file_name("out/collector.prom", "west"), "out/collector-west.prom")
 
 
 class TestMergeMetrics(TestCase):
@@ -114,8 +756,9 @@ class TestMergeMetrics(TestCase):
             }
         ]
         expected_output_dict = {
-            "pod1": {
+            "namespace1/pod1": {
                 "namespace": "namespace1",
+                "pod": "pod1",
                 "gpu_type": utils.NO_GPU,
                 "metrics": {
                     0: {
@@ -129,8 +772,9 @@ class TestMergeMetrics(TestCase):
                     },
                 }
             },
-            "pod2": {
+            "namespace1/pod2": {
                 "namespace": "namespace1",
+                "pod": "pod2",
                 "gpu_type": utils.NO_GPU,
                 "metrics": {
                     0: {
@@ -173,8 +817,9 @@ class TestMergeMetrics(TestCase):
             }
         ]
         output_dict = {
-            "pod1": {
+            "namespace1/pod1": {
                 "namespace": "namespace1",
+                "pod": "pod1",
                 "gpu_type": utils.NO_GPU,
                 "metrics": {
                     0: {
@@ -188,8 +833,9 @@ class TestMergeMetrics(TestCase):
                     },
                 }
             },
-            "pod2": {
+            "namespace1/pod2": {
                 "namespace": "namespace1",
+                "pod": "pod2",
                 "gpu_type": utils.NO_GPU,
                 "metrics": {
                     0: {
@@ -205,8 +851,9 @@ class TestMergeMetrics(TestCase):
             }
         }
         expected_output_dict = {
-            "pod1": {
+            "namespace1/pod1": {
                 "namespace": "namespace1",
+                "pod": "pod1",
                 "gpu_type": utils.NO_GPU,
                 "metrics": {
                     0: {
@@ -223,8 +870,9 @@ class TestMergeMetrics(TestCase):
                     },
                 }
             },
-            "pod2": {
+            "namespace1/pod2": {
                 "namespace": "namespace1",
+                "pod": "pod2",
                 "gpu_type": utils.NO_GPU,
                 "metrics": {
                     0: {
@@ -243,6 +891,21 @@ class TestMergeMetrics(TestCase):
         utils.merge_metrics('mem', test_metric_list, output_dict)
         self.assertEqual(output_dict, expected_output_dict)
 
+    def test_merge_metrics_same_pod_name(self):
+        test_metric_list = [
+            {
+                "metric": {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"},
+                "values": [[0, 10]],
+            },
+            {
+                "metric": {"pod": "pod1", "namespace": "namespace2", "resource": "cpu"},
+                "values": [[0, 20]],
+            },
+        ]
+        output_dict = utils.merge_metrics('cpu', test_metric_list, {})
+        self.assertEqual(output_dict["namespace1/pod1"]["metrics"], {0: {"cpu": 10}})
+        self.assertEqual(output_dict["namespace2/pod1"]["metrics"], {0: {"cpu": 20}})
+
 
 class TestCondenseMetrics(TestCase):
 
@@ -401,6 +1064,391 @@ class TestCondenseMetrics(TestCase):
         condensed_dict = utils.condense_metrics(test_input_dict,['cpu','mem'])
         self.assertEqual(condensed_dict, expected_condensed_dict)
 
+class TestPodMetricsStore(TestCase):
+
+    cpu_metrics = [
+        {
+            "metric": {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"},
+            "values": [[0, "1"], [900, "1"], [1800, "0.5"], [2700, "0.5"]],
+        },
+        {
+            "metric": {"pod": "pod2", "namespace": "namespace2", "resource": "cpu"},
+            "values": [[900, "2"]],
+        },
+    ]
+    memory_metrics = [
+        {
+            "metric": {"pod": "pod1", "namespace": "namespace1", "resource": "memory"},
+            "values": [[0, "1073741824"], [900, "2147483648"], [2700, "2147483648"]],
+        },
+    ]
+    gpu_metrics = [
+        {
+            "metric": {"pod": "pod2", "namespace": "namespace2", "resource": utils.GPU_A100},
+            "values": [[900, "1"]],
+        },
+    ]
+    later_cpu_metrics = [
+        {
+            "metric": {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"},
+            "values": [[3600, "0.5"], [4500, "0.0000001"]],
+        },
+        {
+            "metric": {"pod": "pod2", "namespace": "namespace2", "resource": "cpu"},
+            "values": [[0, "2"], [1800, "2"]],
+        },
+    ]
+
+    def merge_all(self, output_dict):
+        utils.merge_metrics("cpu_request", self.cpu_metrics, output_dict)
+        utils.merge_metrics("memory_request", self.memory_metrics, output_dict)
+        utils.merge_metrics("gpu_request", self.gpu_metrics, output_dict)
+        utils.merge_metrics("cpu_request", self.later_cpu_metrics, output_dict)
+        return output_dict
+
+    def test_merge_metrics(self):
+        store = self.merge_all(utils.PodMetricsStore())
+        self.assertEqual(len(store), 2)
+        pod1 = store.pods[store.index.get_id("namespace1", "pod1")]
+        self.assertEqual(list(pod1["timestamps"]), [0, 900, 1800, 2700, 3600, 4500])
+        self.assertEqual(list(pod1["metrics"]["cpu_request"]), [1, 1, 0.5, 0.5, 0.5, 1e-7])
+        self.assertTrue(math.isnan(pod1["metrics"]["memory_request"][2]))
+        self.assertEqual(pod1["metrics"]["memory_request"][3], 2**31)
+        pod2 = store.pods[store.index.get_id("namespace2", "pod2")]
+        self.assertEqual(pod2["gpu_type"], utils.NO_GPU)
+        self.assertEqual(list(pod2["timestamps"]), [0, 900, 1800])
+        self.assertEqual(list(pod2["metrics"]["cpu_request"]), [2, 2, 2])
+
+    def test_merge_days_in_order(self):
+        metrics_to_check = ["cpu_request", "memory_request"]
+        days = []
+        for day in range(3):
+            values = [[day * 86400 + 900 * i, str(day + 1)] for i in range(4)]
+            days.append([
+                ("cpu_request", [{"metric": {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"},
+                                  "values": values}]),
+                ("memory_request", [{"metric": {"pod": "pod1", "namespace": "namespace1", "resource": "memory"},
+                                     "values": values[1:]}]),
+            ])
+        output_dict = {}
+        for metric_name, metric_list in itertools.chain(*days):
+            utils.merge_metrics(metric_name, metric_list, output_dict)
+
+        store = utils.PodMetricsStore()
+        # every metric of a day goes at the end or overlaps it, never in the middle
+        with mock.patch("openshift_metrics.utils.sorted", create=True, side_effect=AssertionError):
+            for metric_name, metric_list in itertools.chain(*days):
+                utils.merge_metrics(metric_name, metric_list, store)
+        self.assertEqual(len(store.pods[0]["timestamps"]), 12)
+        self.assertEqual(store.condense(metrics_to_check),
+                         utils.condense_metrics(output_dict, metrics_to_check))
+
+    def test_condense_metrics_matches_dict(self):
+        metrics_to_check = ["cpu_request", "memory_request", "gpu_request"]
+        expected_condensed_dict = utils.condense_metrics(self.merge_all({}), metrics_to_check)
+        condensed_dict = utils.condense_metrics(self.merge_all(utils.PodMetricsStore()), metrics_to_check)
+        self.assertEqual(condensed_dict, expected_condensed_dict)
+
+    def test_update(self):
+        metrics_to_check = ["cpu_request", "memory_request", "gpu_request"]
+        expected_store = self.merge_all(utils.PodMetricsStore())
+
+        store = utils.PodMetricsStore()
+        utils.merge_metrics("cpu_request", self.cpu_metrics, store)
+        utils.merge_metrics("memory_request", self.memory_metrics, store)
+        other_store = utils.PodMetricsStore()
+        utils.merge_metrics("gpu_request", self.gpu_metrics, other_store)
+        utils.merge_metrics("cpu_request", self.later_cpu_metrics, other_store)
+        store.update(other_store)
+
+        self.assertEqual(store.index.keys, expected_store.index.keys)
+        self.assertEqual(store.condense(metrics_to_check), expected_store.condense(metrics_to_check))
+
+    def test_merge_snapshot(self):
+        metrics_to_check = ["cpu_request", "memory_request", "gpu_request"]
+        expected_condensed_dict = self.merge_all(utils.PodMetricsStore()).condense(metrics_to_check)
+        metrics_dict = {
+            "start_date": "2022-03-14",
+            "end_date": "2022-03-14",
+            "cpu_metrics": self.cpu_metrics,
+            "memory_metrics": self.memory_metrics,
+            "gpu_metrics": self.gpu_metrics,
+            "later_cpu_metrics": self.later_cpu_metrics,
+        }
+        for compression in ("zlib", "none"):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                file_name = f"{tmp_dir}/metrics.snap"
+                utils.write_snapshot(metrics_dict, file_name, compression=compression)
+                snapshot = utils.read_snapshot(file_name)
+
+                self.assertEqual(snapshot["start_date"], "2022-03-14")
+                self.assertEqual(snapshot["cpu_metrics"][0]["metric"], self.cpu_metrics[0]["metric"])
+                self.assertEqual(list(snapshot["cpu_metrics"][0]["timestamps"]), [0, 900, 1800, 2700])
+                self.assertEqual(list(snapshot["cpu_metrics"][0]["values"]), [1, 1, 0.5, 0.5])
+
+                store = utils.PodMetricsStore()
+                utils.merge_metrics("cpu_request", snapshot["cpu_metrics"], store)
+                utils.merge_metrics("memory_request", snapshot["memory_metrics"], store)
+                utils.merge_metrics("gpu_request", snapshot["gpu_metrics"], store)
+                utils.merge_metrics("cpu_request", snapshot["later_cpu_metrics"], store)
+                self.assertEqual(store.condense(metrics_to_check), expected_condensed_dict)
+                del snapshot
+
+    def test_read_snapshot_not_snapshot(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".snap") as file:
+            file.write('{"cpu_metrics": []}')
+            file.flush()
+            self.assertRaises(ValueError, utils.read_snapshot, file.name)
+
+    def test_merge_runs(self):
+        metrics_to_check = ["cpu_request", "memory_request", "gpu_request"]
+        expected_condensed_dict = self.merge_all(utils.PodMetricsStore()).condense(metrics_to_check)
+
+        store = utils.PodMetricsStore()
+        utils.merge_metrics("cpu_request", utils.condense_series(self.cpu_metrics, 900), store)
+        utils.merge_metrics("memory_request", utils.condense_series(self.memory_metrics, 900), store)
+        utils.merge_metrics("gpu_request", utils.condense_series(self.gpu_metrics, 900), store)
+        utils.merge_metrics("cpu_request", utils.condense_series(self.later_cpu_metrics, 900), store)
+        # condensed from the runs, without expanding them into samples
+        self.assertTrue(all("runs" in pod_dict and not pod_dict["timestamps"] for pod_dict in store.pods))
+        self.assertEqual(store.condense(metrics_to_check), expected_condensed_dict)
+
+    def test_merge_runs_with_samples(self):
+        metrics_to_check = ["cpu_request", "memory_request", "gpu_request"]
+        expected_condensed_dict = self.merge_all(utils.PodMetricsStore()).condense(metrics_to_check)
+
+        store = utils.PodMetricsStore()
+        utils.merge_metrics("cpu_request", utils.condense_series(self.cpu_metrics, 900), store)
+        utils.merge_metrics("memory_request", self.memory_metrics, store)
+        utils.merge_metrics("gpu_request", utils.condense_series(self.gpu_metrics, 900), store)
+        utils.merge_metrics("cpu_request", self.later_cpu_metrics, store)
+        self.assertFalse(any("runs" in pod_dict for pod_dict in store.pods))
+        self.assertEqual(store.condense(metrics_to_check), expected_condensed_dict)
+
+    def test_merge_runs_overlapping(self):
+        metrics_to_check = ["cpu_request"]
+        rerun_cpu_metrics = [
+            {
+                "metric": {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"},
+                "values": [[1800, "4"], [2700, "4"]],
+            },
+        ]
+        expected_condensed_dict = utils.merge_metrics(
+            "cpu_request", rerun_cpu_metrics,
+            utils.merge_metrics("cpu_request", self.cpu_metrics, utils.PodMetricsStore()),
+        ).condense(metrics_to_check)
+
+        # the later runs replace the samples they overlap, like the samples would
+        store = utils.PodMetricsStore()
+        utils.merge_metrics("cpu_request", utils.condense_series(self.cpu_metrics, 900), store)
+        utils.merge_metrics("cpu_request", utils.condense_series(rerun_cpu_metrics, 900), store)
+        condensed_dict = store.condense(metrics_to_check)
+        self.assertEqual(condensed_dict["namespace1/pod1"]["metrics"], {
+            0: {"cpu_request": "1", "duration": 1800},
+            1800: {"cpu_request": "4", "duration": 1800},
+        })
+        self.assertEqual(condensed_dict, expected_condensed_dict)
+
+    def test_update_runs(self):
+        metrics_to_check = ["cpu_request", "memory_request", "gpu_request"]
+        expected_condensed_dict = self.merge_all(utils.PodMetricsStore()).condense(metrics_to_check)
+
+        store = utils.PodMetricsStore()
+        utils.merge_metrics("cpu_request", utils.condense_series(self.cpu_metrics, 900), store)
+        utils.merge_metrics("memory_request", utils.condense_series(self.memory_metrics, 900), store)
+        other_store = utils.PodMetricsStore()
+        utils.merge_metrics("gpu_request", utils.condense_series(self.gpu_metrics, 900), other_store)
+        utils.merge_metrics("cpu_request", utils.condense_series(self.later_cpu_metrics, 900), other_store)
+        store.update(other_store)
+        self.assertTrue(all("runs" in pod_dict for pod_dict in store.pods))
+        self.assertEqual(store.condense(metrics_to_check), expected_condensed_dict)
+
+    def test_merge_clusters(self):
+        metrics_to_check = ["cpu_request", "memory_request", "gpu_request"]
+        store = utils.PodMetricsStore()
+        utils.merge_metrics("cpu_request", self.cpu_metrics, store, cluster="east")
+        utils.merge_metrics("cpu_request", self.cpu_metrics[:1], store, cluster="west")
+        self.assertEqual(len(store), 3)
+
+        condensed_dict = store.condense(metrics_to_check)
+        west_pod1 = condensed_dict["west/namespace1/pod1"]
+        self.assertEqual(west_pod1["pod"], "pod1")
+        self.assertEqual(west_pod1["cluster"], "west")
+        self.assertEqual(west_pod1["metrics"], condensed_dict["east/namespace1/pod1"]["metrics"])
+
+        clusters = utils.split_by_cluster(condensed_dict)
+        self.assertEqual(sorted(clusters["east"]), ["east/namespace1/pod1", "east/namespace2/pod2"])
+        self.assertEqual(sorted(clusters["west"]), ["west/namespace1/pod1"])
+
+    def test_merge_same_pod_name(self):
+        metrics_to_check = ["cpu_request"]
+        other_namespace_metrics = [
+            {
+                "metric": {"pod": "pod1", "namespace": "namespace2", "resource": "cpu"},
+                "values": [[0, "4"], [900, "4"]],
+            },
+        ]
+        store = utils.PodMetricsStore()
+        utils.merge_metrics("cpu_request", self.cpu_metrics, store)
+        utils.merge_metrics("cpu_request", other_namespace_metrics, store)
+        self.assertEqual(len(store), 3)
+        condensed_dict = store.condense(metrics_to_check)
+        self.assertEqual(condensed_dict["namespace1/pod1"]["metrics"][0]["cpu_request"], "1")
+        self.assertEqual(condensed_dict["namespace2/pod1"]["metrics"][0]["cpu_request"], "4")
+        self.assertEqual(
+            condensed_dict, utils.condense_metrics(
+                utils.merge_metrics("cpu_request", other_namespace_metrics,
+                                    utils.merge_metrics("cpu_request", self.cpu_metrics, {})),
+                metrics_to_check,
+            )
+        )
+
+    def test_merge_single_fine_sample(self):
+        store = utils.PodMetricsStore()
+        utils.merge_metrics("cpu_request", [
+            {"metric": {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"},
+             "step": 60, "runs": [[600, 60, "1"]]},
+        ], store)
+        condensed_dict = store.condense(["cpu_request"])
+        self.assertEqual(condensed_dict["namespace1/pod1"]["metrics"], {600: {"cpu_request": "1", "duration": 60}})
+
+    def test_merge_fine_then_coarse_step(self):
+        day = 24 * 3600
+        store = utils.PodMetricsStore()
+        # changing on the first day, collected every minute, and stable the next day
+        utils.merge_metrics("cpu_request", [
+            {"metric": {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"},
+             "step": 60, "runs": [[day - 120, 60, "1"], [day - 60, 60, "2"]]},
+        ], store)
+        utils.merge_metrics("cpu_request", [
+            {"metric": {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"},
+             "step": 900, "runs": [[day, day, "2"]]},
+        ], store)
+        condensed_dict = store.condense(["cpu_request"])
+        self.assertEqual(condensed_dict["namespace1/pod1"]["metrics"], {
+            day - 120: {"cpu_request": "1", "duration": 60},
+            day - 60: {"cpu_request": "2", "duration": day + 60},
+        })
+
+        other_store = utils.PodMetricsStore()
+        utils.merge_metrics("cpu_request", [
+            {"metric": {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"},
+             "step": 60, "runs": [[day - 120, 60, "1"], [day - 60, 60, "2"]]},
+        ], other_store)
+        later_store = utils.PodMetricsStore()
+        utils.merge_metrics("cpu_request", [
+            {"metric": {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"},
+             "step": 900, "runs": [[day, day, "2"]]},
+        ], later_store)
+        other_store.update(later_store)
+        self.assertEqual(other_store.condense(["cpu_request"]), condensed_dict)
+
+    def test_format_sample_value(self):
+        for value in ["0", "1", "0.5", "1073741824", "0.0000001", "12.345", "1000000000000000000000"]:
+            self.assertEqual(utils.format_sample_value(float(value)), value)
+
+
+class TestSeriesIndex(TestCase):
+
+    def test_get_id(self):
+        index = utils.SeriesIndex()
+        self.assertEqual(index.get_id("namespace1", "pod1"), 0)
+        self.assertEqual(index.get_id("namespace2", "pod1"), 1)
+        self.assertEqual(index.get_id("namespace1", "pod1", "east"), 2)
+        self.assertEqual(index.get_id("namespace1", "pod1"), 0)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.keys[2], ("namespace1", "pod1", "east"))
+
+
+class TestCondenseSeries(TestCase):
+
+    def test_condense_series(self):
+        metric_list = [
+            {
+                "metric": {"pod": "pod1"},
+                "values": [[0, "1"], [60, "1"], [120, "2"], [300, "2"], [360, "2"]],
+            },
+        ]
+        expected_series = [
+            {
+                "metric": {"pod": "pod1"},
+                "step": 60,
+                "runs": [[0, 120, "1"], [120, 60, "2"], [300, 120, "2"]],
+            },
+        ]
+        condensed_series = list(utils.condense_series(metric_list, 60))
+        self.assertEqual(condensed_series, expected_series)
+
+        timestamps, values = utils.expand_runs(condensed_series[0]["runs"], 60)
+        self.assertEqual(list(timestamps), [0, 60, 120, 300, 360])
+        self.assertEqual(list(values), [1, 1, 2, 2, 2])
+
+
+class TestFoldCondensedMetrics(TestCase):
+
+    metrics_to_check = ["cpu_request", "memory_request"]
+
+    def condense(self, samples):
+        metrics_dict = {
+            epoch_time: {"cpu_request": cpu, "memory_request": "1024"}
+            for epoch_time, cpu in samples
+        }
+        return utils.condense_metrics(
+            {"pod1": {"namespace": "namespace1", "gpu_type": utils.NO_GPU, "metrics": metrics_dict}},
+            self.metrics_to_check,
+        )
+
+    def test_fold_extends_open_run(self):
+        day1 = [(0, "1"), (900, "1"), (1800, "2")]
+        day2 = [(2700, "2"), (3600, "2"), (4500, "3")]
+        condensed_dict = self.condense(day1)
+        closed_dict = utils.fold_condensed_metrics(condensed_dict, self.condense(day2),
+                                                   self.metrics_to_check)
+        self.assertEqual(condensed_dict, self.condense(day1 + day2))
+        self.assertEqual(list(closed_dict["pod1"]["metrics"]), [1800])
+        self.assertEqual(closed_dict["pod1"]["metrics"][1800]["duration"], 2700)
+
+    def test_fold_closes_open_run(self):
+        day1 = [(0, "1"), (900, "1")]
+        day2 = [(3600, "2"), (4500, "2")]
+        condensed_dict = self.condense(day1)
+        closed_dict = utils.fold_condensed_metrics(condensed_dict, self.condense(day2),
+                                                   self.metrics_to_check)
+        self.assertEqual(condensed_dict, self.condense(day1 + day2))
+        self.assertEqual(closed_dict["pod1"]["metrics"], {0: condensed_dict["pod1"]["metrics"][0]})
+
+    def test_fold_new_pod(self):
+        condensed_dict = {}
+        closed_dict = utils.fold_condensed_metrics(condensed_dict, self.condense([(0, "1"), (900, "2")]),
+                                                   self.metrics_to_check)
+        self.assertEqual(condensed_dict, self.condense([(0, "1"), (900, "2")]))
+        self.assertEqual(list(closed_dict["pod1"]["metrics"]), [0])
+
+    def test_fold_overlap(self):
+        condensed_dict = self.condense([(0, "1"), (900, "1")])
+        self.assertRaises(ValueError, utils.fold_condensed_metrics, condensed_dict,
+                          self.condense([(900, "1")]), self.metrics_to_check)
+
+
+class TestFindRuns(TestCase):
+
+    def test_find_runs(self):
+        timestamps = [0, 60, 120, 180, 300]
+        columns = [[1, 1, 2, 2, 2], [5, 5, 5, 6, 6]]
+        self.assertEqual(utils.find_runs(timestamps, columns), [(0, 120), (2, 60), (3, 180)])
+
+    def test_find_runs_single_column(self):
+        self.assertEqual(utils.find_runs([0, 60, 120], [[1, 1, 1]]), [(0, 180)])
+
+    def test_find_runs_no_columns(self):
+        self.assertEqual(utils.find_runs([0, 60, 120], []), [(0, 180)])
+
+    def test_find_runs_single_sample(self):
+        self.assertEqual(utils.find_runs([60], [[1]]), [(0, utils.STEP_MIN * 60)])
+        self.assertEqual(utils.find_runs([60], [[1]], 60), [(0, 60)])
+        self.assertEqual(utils.find_runs([0, 60, 900], [[1, 1, 1]], 900), [(0, 1800)])
+
+
 class TestWriteMetricsByPod(TestCase):
 
     @mock.patch('openshift_metrics.utils.get_namespace_annotations')
@@ -480,6 +1528,39 @@ class TestWriteMetricsByPod(TestCase):
         self.assertEqual(f.read(), expected_output)
         f.close()
 
+    def test_write_metrics_gzip(self):
+        test_metrics_dict = {
+            "pod1": {
+                "namespace": "namespace1",
+                "gpu_type": utils.NO_GPU,
+                "metrics": {
+                    0: {
+                        "cpu_request": 10,
+                        "memory_request": 1048576,
+                        "duration": 120
+                    },
+                }
+            },
+        }
+        rows = utils.pod_report_rows(test_metrics_dict, {})
+        self.assertIsInstance(rows, types.GeneratorType)
+
+        tmp_file_name = "%s/test-metrics-%s.log" % (tempfile.gettempdir(), time.time())
+        utils.write_metrics_by_pod(test_metrics_dict, tmp_file_name, {})
+        utils.write_metrics_by_pod(test_metrics_dict, tmp_file_name + ".gz", {})
+        with open(tmp_file_name, "rb") as f, gzip.open(tmp_file_name + ".gz", "rb") as gz:
+            self.assertEqual(gz.read(), f.read())
+
+
+class TestFormatTimestamp(TestCase):
+
+    def test_format_timestamp(self):
+        self.assertEqual(utils.format_timestamp(0), "1970-01-01T00:00:00")
+        self.assertEqual(utils.format_timestamp(1677629700), "2023-03-01T00:15:00")
+        self.assertEqual(utils.format_timestamp(1677629700.5), "2023-03-01T00:15:00")
+        self.assertEqual(utils.format_timestamp("1677629700"), "2023-03-01T00:15:00")
+
+
 class TestWriteMetricsByNamespace(TestCase):
 
     @mock.patch('openshift_metrics.utils.get_namespace_annotations')
@@ -576,6 +1657,37 @@ class TestWriteMetricsByNamespace(TestCase):
         self.assertEqual(f.read(), expected_output)
         f.close()
 
+    def test_write_metrics_v100(self):
+        test_metrics_dict = {
+            "pod1": {
+                "namespace": "namespace1",
+                "gpu_type": utils.GPU_V100,
+                "metrics": {
+                    0: {
+                        "cpu_request": "24",
+                        "memory_request": str(96 * 2**30),
+                        "gpu_request": "1",
+                        "duration": 43200
+                    },
+                    43200: {
+                        "cpu_request": "48",
+                        "memory_request": str(96 * 2**30),
+                        "gpu_request": "2",
+                        "duration": 43200
+                    }
+                }
+            },
+        }
+
+        expected_output = ("Invoice Month,Project - Allocation,Project - Allocation ID,Manager (PI),Invoice Email,Invoice Address,Institution,Institution - Specific Code,SU Hours (GBhr or SUhr),SU Type,Rate,Cost\n"
+                            "2023-01,namespace1,namespace1,namespace1,,,,,36,OpenShift GPUV100,0.902,32.472\n")
+
+        tmp_file_name = "%s/test-metrics-%s.log" % (tempfile.gettempdir(), time.time())
+        utils.write_metrics_by_namespace(test_metrics_dict, tmp_file_name, "2023-01", {})
+        f = open(tmp_file_name, "r")
+        self.assertEqual(f.read(), expected_output)
+        f.close()
+
 
 class TestGetServiceUnit(TestCase):
 
@@ -632,3 +1744,39 @@ class TestGetServiceUnit(TestCase):
         self.assertEqual(su_type, utils.SU_CPU)
         self.assertEqual(su_count, 16)
         self.assertEqual(determining_resource, "RAM")
+
+
+class TestGetServiceUnits(TestCase):
+
+    def test_get_service_units(self):
+        cpu_counts = [4, 24, 50, 8, 1, 8]
+        memory_counts = [16, 96, 96, 64, 0, 64]
+        gpu_counts = [0, 1, 1, 1, 0, 0]
+        gpu_types = [None, utils.GPU_A100, utils.GPU_A100, "Unknown_GPU_Type", None, utils.NO_GPU]
+        expected = [utils.get_service_unit(*pod)
+                    for pod in zip(cpu_counts, memory_counts, gpu_counts, gpu_types)]
+
+        su_types, su_counts, determining_resources = utils.get_service_units(
+            cpu_counts, memory_counts, gpu_counts, gpu_types)
+        self.assertEqual(list(zip(su_types, su_counts, determining_resources)), expected)
+
+    def test_get_service_units_single_gpu_type(self):
+        su_types, su_counts, determining_resources = utils.get_service_units(
+            [24, 50], [96, 96], [1, 1], utils.GPU_A100)
+        self.assertEqual(su_types, [utils.SU_A100_GPU, utils.SU_A100_GPU])
+        self.assertEqual(su_counts, [1, 3])
+        self.assertEqual(determining_resources, ["GPU", "CPU"])
+
+    def test_get_service_units_empty(self):
+        self.assertEqual(utils.get_service_units([], [], [], []), ([], [], []))
+
+    def test_configure_service_units(self):
+        su_config = dict(utils.SU_CONFIG)
+        self.assertEqual(utils.get_service_unit(4, 16, 0, None), (utils.SU_CPU, 4, "CPU"))
+        try:
+            utils.configure_service_units(
+                su_config=dict(su_config, **{utils.SU_CPU: {"gpu": -1, "cpu": 2, "ram": 8}}))
+            self.assertEqual(utils.get_service_unit(4, 16, 0, None), (utils.SU_CPU, 2, "CPU"))
+        finally:
+            utils.configure_service_units(su_config=su_config)
+        self.assertEqual(utils.get_service_unit(4, 16, 0, None), (utils.SU_CPU, 4, "CPU"))
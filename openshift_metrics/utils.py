@@ -14,12 +14,37 @@
 """Holds bunch of utility functions"""
 
 import os
+import base64
+import bisect
+import codecs
+import contextlib
+import cProfile
 import datetime
+import decimal
+import email.utils
+import functools
+import gzip
+import itertools
+import json
 import time
 import math
+import mmap
 import csv
+import operator
+import random
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
 import openshift
 
 
@@ -46,39 +71,1159 @@ RATE = {
     SU_UNKNOWN_GPU: 0,
 }
 
+KNOWN_GPU_SU = {
+    GPU_A100: SU_A100_GPU,
+    GPU_A2: SU_A2_GPU,
+    GPU_V100: SU_V100_GPU,
+    GPU_GENERIC: SU_UNKNOWN_GPU,
+}
+
+# GPU count for some configs is -1 for math reasons, in reality it is 0
+SU_CONFIG = {
+    SU_CPU: {"gpu": -1, "cpu": 1, "ram": 4},
+    SU_A100_GPU: {"gpu": 1, "cpu": 24, "ram": 96},
+    SU_V100_GPU: {"gpu": 1, "cpu": 24, "ram": 96},
+    SU_A2_GPU: {"gpu": 1, "cpu": 8, "ram": 64},
+    SU_UNKNOWN_GPU: {"gpu": 1, "cpu": 8, "ram": 64},
+    SU_UNKNOWN: {"gpu": -1, "cpu": 1, "ram": 1},
+}
+
+# the column of the namespace report each GPU type's SU hours are summed up in
+GPU_SU_HOURS = {
+    GPU_A100: "SU_A100_GPU_HOURS",
+    GPU_A2: "SU_A2_GPU_HOURS",
+    GPU_V100: "SU_V100_GPU_HOURS",
+    GPU_GENERIC: "SU_UNKNOWN_GPU_HOURS",
+}
+
+# GPU rows of the namespace report, in order
+GPU_SU_HOURS_TYPES = (
+    ("SU_A100_GPU_HOURS", SU_A100_GPU),
+    ("SU_A2_GPU_HOURS", SU_A2_GPU),
+    ("SU_V100_GPU_HOURS", SU_V100_GPU),
+    ("SU_UNKNOWN_GPU_HOURS", SU_UNKNOWN_GPU),
+)
+
 STEP_MIN = 15
 
+# the labels merge_metrics reads, which the queries are projected onto
+PROJECTED_LABELS = ("namespace", "pod", "resource")
+
+SHARD_SECONDS = {
+    "day": 24 * 3600,
+    "hour": 3600,
+}
+
+RFC3339_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+REPORT_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+CSV_BUFFER_SIZE = 1024 * 1024
+
+# metrics files with series stored as runs instead of samples are version 2
+FORMAT_VERSION = 2
+
+ANNOTATIONS_JSONPATH = '{range .items[*]}{.metadata.name}{"\\t"}{.metadata.annotations}{"\\n"}{end}'
+ANNOTATIONS_CACHE_TTL = 24 * 3600
+
+SNAPSHOT_MAGIC = b"OSMSNAP1"
+SNAPSHOT_EXTENSION = ".snap"
+
+RUN_METRICS_PREFIX = "openshift_metrics_"
+
 
 class EmptyResultError(Exception):
     """Raise when no results are retrieved for a query"""
 
 
-def query_metric(openshift_url, token, metric, report_start_date, report_end_date):
-    """Queries metric from prometheus/thanos for the provided openshift_url"""
-    data = None
-    headers = {"Authorization": f"Bearer {token}"}
-    day_url_vars = f"start={report_start_date}T00:00:00Z&end={report_end_date}T23:59:59Z"
-    print(f"Retrieving metric: {metric}")
-    for _ in range(3):
-        url = f"{openshift_url}/api/v1/query_range?query={metric}&{day_url_vars}&step={STEP_MIN}m"
-        response = requests.get(url, headers=headers, verify=True)
-        if response.status_code != 200:
-            print(f"{response.status_code} Response: {response.reason}")
+def get_peak_rss_mb():
+    """Returns the peak resident memory of the process so far in MiB, if it is known"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports it in KiB, macOS in bytes
+    if sys.platform == "darwin":
+        return round(max_rss / 2**20, 1)
+    return round(max_rss / 2**10, 1)
+
+
+def count_series_samples(series):
+    """Returns the number of samples in a series, whichever way it is stored"""
+    if "runs" in series:
+        return sum(duration // series["step"] for _, duration, _ in series["runs"])
+    if "timestamps" in series:
+        return memoryview(series["timestamps"]).nbytes // 8
+    return len(series["values"])
+
+
+class RunSummary:
+    """
+    Records where the time and memory of a run go
+
+    `stage` times a block of the run, adding up the time of blocks with the same name,
+    and notes the peak RSS at its end. Queries sent through a PrometheusSession given
+    the summary are recorded with their status, latency and size. `write` dumps it all
+    as JSON.
+    """
+
+    def __init__(self, command, labels=None):
+        self.command = command
+        self.labels = labels or {}
+        self.succeeded = False
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+        self.queries = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the block under `name`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                stage = self.stages.setdefault(name, {"seconds": 0, "calls": 0})
+                stage["seconds"] += seconds
+                stage["calls"] += 1
+                stage["peak_rss_mb"] = get_peak_rss_mb()
+
+    def count(self, name, value=1):
+        """Adds value to the counter name"""
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def count_series(self, metric_list):
+        """Passes the series of metric_list through, counting them and their samples"""
+        for series in metric_list:
+            self.count("series")
+            self.count("samples", count_series_samples(series))
+            yield series
+
+    def record_query(self, url, params, seconds, status=None, size=None, error=None):
+        """Records a request sent to prometheus, with its size in bytes if it is known"""
+        query = {"url": url, "seconds": round(seconds, 6)}
+        if params:
+            query.update(
+                (key, params[key]) for key in ("query", "start", "end", "step") if key in params
+            )
+        if status is not None:
+            query["status"] = status
+            query["bytes"] = size
+        if error is not None:
+            query["error"] = error
+        with self._lock:
+            self.queries.append(query)
+
+    def as_dict(self):
+        return {
+            "command": self.command,
+            "labels": self.labels,
+            "succeeded": self.succeeded,
+            "started_at": self.started_at,
+            "seconds": round(time.perf_counter() - self._started, 6),
+            "peak_rss_mb": get_peak_rss_mb(),
+            "stages": {
+                name: dict(stage, seconds=round(stage["seconds"], 6))
+                for name, stage in self.stages.items()
+            },
+            "counts": self.counts,
+            "queries": self.queries,
+        }
+
+    def write(self, file_name):
+        """Writes the summary as JSON to file_name"""
+        print(f"Writing run summary to {file_name}")
+        with open(file_name, "w") as file:
+            json.dump(self.as_dict(), file, indent=2)
+
+
+def escape_label_value(value):
+    """Escapes a label value for the prometheus text format"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_run_metrics(run_summary, last_success=None):
+    """
+    Formats a run summary as metrics in the prometheus text format
+
+    The metrics cover the whole run, its stages and the queries it sent, so that slow
+    or degraded collection can be alerted on. The last success timestamp is the end of
+    this run if it succeeded, and otherwise `last_success` if one is given.
+    """
+    summary = run_summary.as_dict()
+    labels = f'command="{escape_label_value(summary["command"])}"' + "".join(
+        f',{name}="{escape_label_value(value)}"' for name, value in summary["labels"].items()
+    )
+    if run_summary.succeeded:
+        last_success = summary["started_at"] + summary["seconds"]
+    queries = summary["queries"]
+    query_seconds = [query["seconds"] for query in queries]
+    query_failures = sum(1 for query in queries if query.get("status") != 200)
+    counts = summary["counts"]
+
+    metrics = [
+        (
+            "run_success",
+            "gauge",
+            "Whether the last run succeeded",
+            [("", int(summary["succeeded"]))],
+        ),
+        ("run_duration_seconds", "gauge", "Duration of the last run", [("", summary["seconds"])]),
+        (
+            "run_stage_duration_seconds",
+            "gauge",
+            "Duration of each stage of the last run",
+            [
+                (f',stage="{escape_label_value(name)}"', stage["seconds"])
+                for name, stage in summary["stages"].items()
+            ],
+        ),
+        (
+            "query_duration_seconds",
+            "summary",
+            "Duration of the requests sent to prometheus",
+            [("_sum", sum(query_seconds)), ("_count", len(query_seconds))],
+        ),
+        (
+            "query_max_duration_seconds",
+            "gauge",
+            "Duration of the slowest request sent to prometheus",
+            [("", max(query_seconds, default=0))],
+        ),
+        (
+            "query_response_bytes",
+            "gauge",
+            "Bytes received from prometheus",
+            [("", sum(query.get("bytes") or 0 for query in queries))],
+        ),
+        (
+            "query_failures",
+            "gauge",
+            "Requests to prometheus that failed or didn't return 200",
+            [("", query_failures)],
+        ),
+        (
+            "query_retries",
+            "gauge",
+            "Requests to prometheus that were retried",
+            [("", counts.get("retries", 0))],
+        ),
+        (
+            "query_empty_results",
+            "gauge",
+            "Queries that gave up on an empty result",
+            [("", counts.get("empty_results", 0))],
+        ),
+        ("series", "gauge", "Series collected", [("", counts.get("series", 0))]),
+        ("samples", "gauge", "Samples collected", [("", counts.get("samples", 0))]),
+        (
+            "output_bytes",
+            "gauge",
+            "Size of the file written",
+            [("", counts.get("output_bytes", 0))],
+        ),
+    ]
+    if summary["peak_rss_mb"] is not None:
+        metrics.append(
+            (
+                "peak_rss_bytes",
+                "gauge",
+                "Peak resident memory",
+                [("", int(summary["peak_rss_mb"] * 2**20))],
+            )
+        )
+    if last_success is not None:
+        metrics.append(
+            (
+                "last_success_timestamp_seconds",
+                "gauge",
+                "When the last successful run finished",
+                [("", last_success)],
+            )
+        )
+
+    lines = []
+    for name, metric_type, help_text, samples in metrics:
+        name = f"{RUN_METRICS_PREFIX}{name}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for suffix, value in samples:
+            # summaries put their suffix on the name, the others add labels
+            if suffix.startswith("_"):
+                lines.append(f"{name}{suffix}{{{labels}}} {value}")
+            else:
+                lines.append(f"{name}{{{labels}{suffix}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def read_last_success(file_name):
+    """Returns the last success timestamp from a metrics textfile, if there is one"""
+    name = f"{RUN_METRICS_PREFIX}last_success_timestamp_seconds"
+    try:
+        with open(file_name, "r") as file:
+            for line in file:
+                if line.startswith(name + "{"):
+                    return float(line.rsplit(" ", 1)[1])
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def write_metrics_textfile(run_summary, file_name):
+    """
+    Writes the run metrics to a file for the node exporter's textfile collector
+
+    The file is replaced atomically, and a failed run keeps the last success
+    timestamp of the file it replaces.
+    """
+    print(f"Writing run metrics to {file_name}")
+    text = format_run_metrics(run_summary, read_last_success(file_name))
+    temp_file_name = f"{file_name}.tmp"
+    with open(temp_file_name, "w") as file:
+        file.write(text)
+    os.replace(temp_file_name, file_name)
+
+
+def format_grouping_key(name, value):
+    """
+    Returns a label of the Pushgateway grouping key as a part of its URL path
+
+    Values that aren't plain words, like ones with a "/" or empty ones, are sent
+    base64-encoded, which the Pushgateway accepts for any value.
+    """
+    if value and all(char.isascii() and (char.isalnum() or char in "_.:-") for char in value):
+        return f"/{name}/{value}"
+    return f"/{name}@base64/{base64.urlsafe_b64encode(value.encode()).decode() or '='}"
+
+
+def push_run_metrics(run_summary, pushgateway_url, job, timeout=30):
+    """
+    Pushes the run metrics to a Pushgateway
+
+    They are POSTed, which only replaces metrics of the same name, so the last success
+    timestamp pushed by an earlier run stays when this one failed. The labels of the
+    run summary are added to the job to group the metrics by. A failed push is
+    reported but doesn't fail the run.
+    """
+    url = f"{pushgateway_url.rstrip('/')}/metrics" + "".join(
+        format_grouping_key(name, value)
+        for name, value in itertools.chain([("job", job)], run_summary.labels.items())
+    )
+    print(f"Pushing run metrics to {url}")
+    try:
+        response = requests.post(
+            url,
+            data=format_run_metrics(run_summary).encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4"},
+            timeout=timeout,
+        )
+    except requests.RequestException as e:
+        print(f"Pushing run metrics failed: {e}")
+        return False
+    if response.status_code not in (200, 202):
+        print(f"Pushing run metrics failed: {response.status_code} Response: {response.reason}")
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def profiled(file_name=None):
+    """Profiles the block with cProfile and dumps the stats to file_name, if one is given"""
+    if file_name is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        print(f"Writing profile to {file_name}")
+        profiler.dump_stats(file_name)
+
+
+class PrometheusSession:
+    """
+    HTTP session shared by all the queries sent to prometheus/thanos
+
+    Connections are pooled and kept alive between queries and their retries.
+    Failed attempts back off exponentially with jitter, or for as long as the
+    server asks with Retry-After on a 429 or 503, up to `max_backoff` seconds
+    either way. `retry_budget` caps the number
+    of retries across every query made through the session, so an overloaded
+    Thanos doesn't get retried against indefinitely. Every request is recorded
+    in `run_summary`, if one is given.
+    """
+
+    def __init__(
+        self,
+        token,
+        timeout=(10, 300),
+        max_attempts=3,
+        retry_budget=20,
+        backoff=3,
+        max_backoff=60,
+        pool_size=10,
+        run_summary=None,
+    ):
+        self.timeout = timeout
+        self.run_summary = run_summary
+        self.max_attempts = max_attempts
+        self.retry_budget = retry_budget
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        self.set_token(token)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def set_token(self, token):
+        """Replaces the token the requests are authorized with"""
+        self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def get(self, url, params=None, stream=False):
+        """Sends a single GET request"""
+        if self.run_summary is None:
+            return self.session.get(
+                url, params=params, timeout=self.timeout, verify=True, stream=stream
+            )
+        start = time.perf_counter()
+        try:
+            response = self.session.get(
+                url, params=params, timeout=self.timeout, verify=True, stream=stream
+            )
+        except requests.exceptions.RequestException as e:
+            self.run_summary.record_query(
+                url, params, time.perf_counter() - start, error=type(e).__name__
+            )
+            raise
+        seconds = time.perf_counter() - start
+        if stream:
+            # the body hasn't been read yet
+            size = response.headers.get("Content-Length")
+            size = int(size) if size is not None else None
+        else:
+            size = len(response.content)
+        self.run_summary.record_query(url, params, seconds, response.status_code, size)
+        return response
+
+    def wait_to_retry(self, attempt, response=None):
+        """
+        Sleeps before the next attempt
+
+        Returns False without sleeping when the retry budget is used up.
+        """
+        with self._lock:
+            if self.retry_budget <= 0:
+                print("Retry budget exhausted")
+                return False
+            self.retry_budget -= 1
+        if self.run_summary is not None:
+            self.run_summary.count("retries")
+        delay = get_retry_after(response)
+        if delay is None:
+            delay = min(self.max_backoff, self.backoff * 2**attempt)
+            delay = delay / 2 + random.uniform(0, delay / 2)
         else:
-            data = response.json()["data"]["result"]
-            if data:
-                break
-            print("Empty result set")
-        time.sleep(3)
+            # a server asking for a long wait mustn't stall the collection
+            delay = min(self.max_backoff, delay)
+        time.sleep(delay)
+        return True
+
+
+def get_retry_after(response):
+    """Returns the delay in seconds asked for by a 429 or 503 response, if any"""
+    if response is None or response.status_code not in (429, 503):
+        return None
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    if retry_after.isdigit():
+        return int(retry_after)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def query_metric(
+    openshift_url,
+    token,
+    metric,
+    report_start_date,
+    report_end_date,
+    shard=None,
+    shard_workers=1,
+    session=None,
+    stream=False,
+):
+    """
+    Queries metric from prometheus/thanos for the provided openshift_url
+
+    With `shard` set to "day" or "hour" the report window is split into chunks of that
+    size, which are fetched up to `shard_workers` at a time and stitched back together.
+
+    With `stream` set, an iterator is returned that parses the response one series
+    at a time as it is read, instead of a list. It can't be combined with `shard`.
+
+    Requests go through `session`, a PrometheusSession, so that they can share its
+    connections and retry budget. A new session is used if none is given.
+    """
+    if stream and shard is not None:
+        raise ValueError("Streaming can't be combined with sharding")
+    if session is None:
+        session = PrometheusSession(token)
+    start_time = f"{report_start_date}T00:00:00Z"
+    end_time = f"{report_end_date}T23:59:59Z"
+    print(f"Retrieving metric: {metric}")
+    if shard is None:
+        return query_range(
+            openshift_url, token, metric, start_time, end_time, session=session, stream=stream
+        )
+
+    shard_windows = get_shard_windows(start_time, end_time, SHARD_SECONDS[shard])
+    with ThreadPoolExecutor(max_workers=shard_workers) as executor:
+        shards = executor.map(
+            lambda window: query_range(
+                openshift_url,
+                token,
+                metric,
+                window[0],
+                window[1],
+                allow_empty=True,
+                session=session,
+            ),
+            shard_windows,
+        )
+        data = stitch_series(shards)
     if not data:
         raise EmptyResultError(f"Error retrieving metric: {metric}")
     return data
 
 
+def query_range(
+    openshift_url,
+    token,
+    metric,
+    start_time,
+    end_time,
+    allow_empty=False,
+    session=None,
+    stream=False,
+    step=STEP_MIN * 60,
+):
+    """
+    Runs a single query_range call between two RFC 3339 timestamps
+
+    An empty result set is retried like a failed request unless `allow_empty` is set.
+    Samples are `step` seconds apart.
+
+    With `stream` set, an iterator over the series is returned, which reads and parses
+    the response as it goes. Only the first series is read before returning, to tell an
+    empty result apart, so a connection failure after that isn't retried.
+    """
+    url = f"{openshift_url}/api/v1/query_range"
+    params = {"query": metric, "start": start_time, "end": end_time, "step": f"{step}s"}
+    return send_query(url, params, token, allow_empty=allow_empty, session=session, stream=stream)
+
+
+def query_instant(openshift_url, token, metric, eval_time, allow_empty=False, session=None):
+    """
+    Runs a single instant query at an RFC 3339 timestamp
+
+    Each series in the result has a single "value" sample rather than "values".
+    """
+    url = f"{openshift_url}/api/v1/query"
+    params = {"query": metric, "time": eval_time}
+    return send_query(url, params, token, allow_empty=allow_empty, session=session)
+
+
+def send_query(url, params, token, allow_empty=False, session=None, stream=False):
+    """Sends a query to prometheus/thanos with retries, see `query_range`"""
+    if session is None:
+        session = PrometheusSession(token)
+    metric = params["query"]
+    data = None
+    for attempt in range(session.max_attempts):
+        response = None
+        try:
+            response = session.get(url, params=params, stream=stream)
+        except requests.RequestException as e:
+            print(f"Request failed: {e}")
+        else:
+            if response.status_code != 200:
+                print(f"{response.status_code} Response: {response.reason}")
+                response.close()
+            elif stream:
+                series = iter_response_series(response)
+                first_series = next(series, None)
+                if first_series is not None:
+                    return itertools.chain([first_series], series)
+                data = []
+                if allow_empty:
+                    break
+                print("Empty result set")
+            else:
+                data = response.json()["data"]["result"]
+                if data or allow_empty:
+                    break
+                print("Empty result set")
+        if attempt + 1 == session.max_attempts or not session.wait_to_retry(attempt, response):
+            break
+    if data is None or not (data or allow_empty):
+        if session.run_summary is not None:
+            session.run_summary.count("empty_results")
+        raise EmptyResultError(f"Error retrieving metric: {metric}")
+    if stream:
+        return iter(data)
+    return data
+
+
+def iter_response_series(response):
+    """Yields the series of a streamed query_range response and closes it when done"""
+    with response:
+        chunks = codecs.iterdecode(response.iter_content(STREAM_CHUNK_SIZE), "utf-8")
+        yield from iter_result_series(chunks)
+
+
+def iter_result_series(chunks):
+    """
+    Incrementally parses the "result" list out of a query_range response
+
+    `chunks` is an iterable of pieces of the response text. Each series is yielded as
+    soon as it has been read in full, so only about one series worth of the response is
+    held in memory at a time.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ""
+    while True:
+        result_index = buffer.find('"result"')
+        if result_index != -1 and buffer.find("[", result_index) != -1:
+            position = buffer.find("[", result_index) + 1
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        buffer += chunk
+
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position < len(buffer) and buffer[position] == "]":
+            return
+        try:
+            series, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield series
+
+
+def dump_metrics(metrics_items, file):
+    """
+    Writes metrics to file as a JSON object, the way json.dump would
+
+    `metrics_items` is an iterable of (key, value) pairs. Values that are iterators,
+    like the ones returned by a streaming query, are written one series at a time as
+    they are consumed, so they never need to be held in memory as a whole.
+    """
+    file.write("{")
+    for index, (key, value) in enumerate(metrics_items):
+        if index:
+            file.write(", ")
+        file.write(f"{json.dumps(key)}: ")
+        if isinstance(value, (str, int, float, list, dict)) or value is None:
+            json.dump(value, file)
+            continue
+        file.write("[")
+        for series_index, series in enumerate(value):
+            if series_index:
+                file.write(", ")
+            json.dump(series, file)
+        file.write("]")
+    file.write("}")
+
+
+def write_snapshot(metrics_dict, file_name, compression="zlib"):
+    """
+    Writes collected metrics in the binary snapshot format
+
+    The samples of every series are stored as two columns, an int64 array of
+    timestamps and a float64 array of values, after a JSON header that holds the
+    other fields of metrics_dict and the labels and position of each series. With
+    `compression` set to "none" the columns can be memory-mapped when read back,
+    otherwise they are compressed with zlib.
+    """
+    fields = {}
+    series_index = {}
+    timestamps = array("q")
+    values = array("d")
+    for key, value in metrics_dict.items():
+        if not isinstance(value, list):
+            fields[key] = value
+            continue
+        entries = []
+        for series in value:
+            entries.append(
+                {"metric": series["metric"], "start": len(timestamps), "count": len(series["values"])}
+            )
+            timestamps.extend(int(sample[0]) for sample in series["values"])
+            values.extend(float(sample[1]) for sample in series["values"])
+        series_index[key] = entries
+
+    blocks = {}
+    data = []
+    offset = 0
+    for name, column in (("timestamps", timestamps), ("values", values)):
+        block = column.tobytes()
+        if compression == "zlib":
+            block = zlib.compress(block)
+        blocks[name] = [offset, len(block)]
+        # keep every block 8 byte aligned
+        block += b"\0" * (-len(block) % 8)
+        data.append(block)
+        offset += len(block)
+
+    header = json.dumps(
+        {
+            "byteorder": sys.byteorder,
+            "compression": compression,
+            "fields": fields,
+            "series": series_index,
+            "blocks": blocks,
+        }
+    ).encode()
+    header += b" " * (-len(header) % 8)
+
+    with open(file_name, "wb") as file:
+        file.write(SNAPSHOT_MAGIC)
+        file.write(struct.pack("<Q", len(header)))
+        file.write(header)
+        for block in data:
+            file.write(block)
+
+
+def read_snapshot(file_name):
+    """
+    Reads metrics written by `write_snapshot`
+
+    Returns the same dict the collector writes as JSON, except that each series has
+    "timestamps" and "values" arrays in place of a list of samples. Uncompressed
+    snapshots are memory-mapped, and their series point straight into the file.
+    """
+    with open(file_name, "rb") as file:
+        snapshot = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    if snapshot[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError(f"{file_name} is not a metrics snapshot")
+    (header_length,) = struct.unpack_from("<Q", snapshot, len(SNAPSHOT_MAGIC))
+    data_start = len(SNAPSHOT_MAGIC) + 8 + header_length
+    header = json.loads(bytes(snapshot[len(SNAPSHOT_MAGIC) + 8 : data_start]))
+
+    columns = {}
+    for name, typecode in (("timestamps", "q"), ("values", "d")):
+        offset, length = header["blocks"][name]
+        block = snapshot[data_start + offset : data_start + offset + length]
+        if header["compression"] == "zlib":
+            block = memoryview(zlib.decompress(block))
+        if header["byteorder"] != sys.byteorder:
+            column = array(typecode)
+            column.frombytes(block)
+            column.byteswap()
+            block = memoryview(column).cast("B")
+        columns[name] = block.cast(typecode)
+
+    metrics_dict = dict(header["fields"])
+    for key, entries in header["series"].items():
+        metrics_dict[key] = [
+            {
+                "metric": entry["metric"],
+                "timestamps": columns["timestamps"][entry["start"] : entry["start"] + entry["count"]],
+                "values": columns["values"][entry["start"] : entry["start"] + entry["count"]],
+            }
+            for entry in entries
+        ]
+    return metrics_dict
+
+
+def project_labels(query, labels=PROJECTED_LABELS):
+    """
+    Wraps a query so that its series only keep the given labels
+
+    Series that only differed by a dropped label, such as the scrape instance, are
+    merged into one. The pod, namespace and resource labels can't be dropped, since
+    the metrics are keyed by them.
+    """
+    missing = [label for label in PROJECTED_LABELS if label not in labels]
+    if missing:
+        raise ValueError(f"The {', '.join(missing)} labels can't be dropped")
+    return f"max by ({', '.join(labels)}) ({query})"
+
+
+def get_shard_windows(start_time, end_time, shard_seconds):
+    """
+    Splits the window between two RFC 3339 timestamps into consecutive shards
+
+    Neighbouring shards share their boundary timestamp. As long as `shard_seconds`
+    is a multiple of the query step, every shard evaluates on the same step grid as
+    a single query over the whole window would.
+    """
+    shard_start = datetime.datetime.strptime(start_time, RFC3339_FORMAT)
+    end = datetime.datetime.strptime(end_time, RFC3339_FORMAT)
+    shard_length = datetime.timedelta(seconds=shard_seconds)
+    windows = []
+    while True:
+        shard_end = min(shard_start + shard_length, end)
+        windows.append(
+            (shard_start.strftime(RFC3339_FORMAT), shard_end.strftime(RFC3339_FORMAT))
+        )
+        if shard_end >= end:
+            return windows
+        shard_start = shard_end
+
+
+def stitch_series(shards):
+    """
+    Joins the per-shard results of a range query into a single result
+
+    Series are matched on their full label set and the timestamp repeated at each
+    shard boundary is only kept once. Shards must be given in time order.
+    """
+    stitched = {}
+    for shard in shards:
+        for series in shard:
+            key = tuple(sorted(series["metric"].items()))
+            if key not in stitched:
+                stitched[key] = {"metric": series["metric"], "values": []}
+            values = stitched[key]["values"]
+            if values:
+                last_epoch_time = values[-1][0]
+                values.extend(value for value in series["values"] if value[0] > last_epoch_time)
+            else:
+                values.extend(series["values"])
+    return list(stitched.values())
+
+
+def query_metrics(
+    openshift_url,
+    token,
+    metrics,
+    report_start_date,
+    report_end_date,
+    max_workers=1,
+    optional=(),
+    **query_kwargs,
+):
+    """
+    Queries several metrics at the same time
+
+    `metrics` maps a name to the metric to query and the results are returned keyed
+    by the same names. At most `max_workers` queries are in flight at once, and each
+    one goes through `query_metric` so it keeps its own retries. An EmptyResultError
+    for a name listed in `optional` drops that name from the results instead of failing.
+
+    Any other keyword arguments are passed on to `query_metric`. All the queries share
+    one PrometheusSession unless a `session` is passed in.
+    """
+    query_kwargs.setdefault("session", PrometheusSession(token))
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            name: executor.submit(
+                query_metric,
+                openshift_url,
+                token,
+                metric,
+                report_start_date,
+                report_end_date,
+                **query_kwargs,
+            )
+            for name, metric in metrics.items()
+        }
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except EmptyResultError:
+                if name not in optional:
+                    raise
+    return results
+
+
+def query_namespace_usage(
+    openshift_url,
+    token,
+    cpu_metric,
+    memory_metric,
+    gpu_metric,
+    report_start_date,
+    report_end_date,
+    session=None,
+):
+    """
+    Queries the CPU and memory request hours of the non-gpu pods of each namespace
+
+    The samples of the report window are summed up by prometheus, with a subquery on
+    the same step grid as the range queries, so that only a number per namespace is
+    transferred. Every sample counts for one step, as it does when the samples of a
+    pod are condensed locally, and pods requesting a GPU are left out since they are
+    billed by SU. Duplicate series of a pod, such as the copies reported by several
+    scheduler instances, are collapsed with `max` before summing, as merging them
+    locally keeps a single sample per pod and timestamp. Returns a dict of the
+    "_cpu_hours" and "_memory_hours" by namespace.
+    """
+    start = datetime.datetime.strptime(report_start_date, "%Y-%m-%d")
+    end = datetime.datetime.strptime(report_end_date, "%Y-%m-%d")
+    days = (end - start).days + 1
+    step = STEP_MIN * 60
+    usage = {}
+    for name, metric, unit in (
+        ("_cpu_hours", cpu_metric, 1),
+        ("_memory_hours", memory_metric, 2**30),
+    ):
+        query = (
+            f"sum by (namespace) (sum_over_time((max by (namespace, pod) ({metric} "
+            f"unless on(pod, namespace) ({gpu_metric})))[{days}d:{STEP_MIN}m]))"
+        )
+        print(f"Retrieving namespace usage: {query}")
+        for series in query_instant(
+            openshift_url,
+            token,
+            query,
+            f"{report_end_date}T23:59:59Z",
+            allow_empty=True,
+            session=session,
+        ):
+            namespace_usage = usage.setdefault(
+                series["metric"]["namespace"], {"_cpu_hours": 0, "_memory_hours": 0}
+            )
+            namespace_usage[name] = float(series["value"][1]) / unit * step / 3600
+    return usage
+
+
+def get_adaptive_queries(metrics, report_start_date, report_end_date):
+    """
+    Returns the queries of `query_metrics_adaptive`
+
+    A pod is stable if each of its series has a sample at every step of the report
+    window, on the STEP_MIN grid, and never changes. The first queries are instant
+    queries returning the last value of each series of the stable pods, the second
+    ones range queries returning the series of all the other pods. The set of pods
+    that aren't stable is pinned to the end of the window with the @ modifier, so
+    that the range queries filter on the same set at every step.
+    """
+    start = datetime.datetime.strptime(report_start_date, "%Y-%m-%d")
+    end = datetime.datetime.strptime(report_end_date, "%Y-%m-%d")
+    days = (end - start).days + 1
+    eval_time = int(end.replace(tzinfo=datetime.timezone.utc).timestamp()) + 24 * 3600 - 1
+    steps = days * 24 * 3600 // (STEP_MIN * 60)
+
+    stable = {}
+    unstable = []
+    for name, metric in metrics.items():
+        window = f"(({metric})[{days}d:{STEP_MIN}m] @ {eval_time})"
+        stable[name] = (
+            f"(last_over_time{window} and (count_over_time{window} == {steps}) "
+            f"and (changes{window} == 0))"
+        )
+        unstable.append(f"(count_over_time{window} unless {stable[name]})")
+    unstable_pods = " or ".join(unstable)
+
+    stable_queries = {
+        name: f"{query} unless on(namespace, pod) ({unstable_pods})" for name, query in stable.items()
+    }
+    fine_queries = {
+        name: f"({metric}) and on(namespace, pod) ({unstable_pods})" for name, metric in metrics.items()
+    }
+    return stable_queries, fine_queries
+
+
+def query_metrics_adaptive(
+    openshift_url,
+    token,
+    metrics,
+    report_start_date,
+    report_end_date,
+    fine_step=60,
+    optional=(),
+    session=None,
+):
+    """
+    Queries several metrics at a resolution that depends on how much their pods change
+
+    Pods whose requests stay the same over the whole report window are found with
+    instant queries, and each of their series is returned as a single run on the
+    STEP_MIN grid without fetching any samples, which condenses to the same runs as
+    a full query would. Only the pods that start, stop or get resized during the window
+    are fetched with range queries, with samples `fine_step` seconds apart so that
+    short-lived pods are caught and billed more closely. Those are sent a day at a
+    time, as prometheus refuses range queries of more than 11,000 steps, which at a
+    minute apart is less than eight days.
+
+    The series are returned as runs like `condense_series` makes them, keyed by the
+    names in `metrics`. A name listed in `optional` is left out rather than failing
+    when nothing is found.
+    """
+    if session is None:
+        session = PrometheusSession(token)
+    stable_queries, fine_queries = get_adaptive_queries(metrics, report_start_date, report_end_date)
+    start_time = f"{report_start_date}T00:00:00Z"
+    end_time = f"{report_end_date}T23:59:59Z"
+    start = datetime.datetime.strptime(report_start_date, "%Y-%m-%d")
+    end = datetime.datetime.strptime(report_end_date, "%Y-%m-%d")
+    # stable series have a sample at every step of the window
+    window_start = int(start.replace(tzinfo=datetime.timezone.utc).timestamp())
+    window_length = ((end - start).days + 1) * 24 * 3600
+
+    results = {}
+    for name in metrics:
+        print(f"Retrieving stable series of metric: {metrics[name]}")
+        stable_series = query_instant(
+            openshift_url, token, stable_queries[name], end_time, allow_empty=True, session=session
+        )
+        print(f"Retrieving changing series of metric: {metrics[name]}")
+        fine_series = stitch_series(
+            query_range(
+                openshift_url,
+                token,
+                fine_queries[name],
+                shard_start_time,
+                shard_end_time,
+                allow_empty=True,
+                session=session,
+                step=fine_step,
+            )
+            for shard_start_time, shard_end_time in get_shard_windows(
+                start_time, end_time, SHARD_SECONDS["day"]
+            )
+        )
+        if not stable_series and not fine_series:
+            if name in optional:
+                continue
+            raise EmptyResultError(f"Error retrieving metric: {metrics[name]}")
+        results[name] = [
+            {
+                "metric": series["metric"],
+                "step": STEP_MIN * 60,
+                "runs": [[window_start, window_length, series["value"][1]]],
+            }
+            for series in stable_series
+        ]
+        results[name].extend(condense_series(fine_series, fine_step))
+    return results
+
+
+def query_metrics_window(
+    openshift_url, token, metrics, start_time, end_time, optional=(), session=None
+):
+    """
+    Queries several metrics over the window between two epoch times
+
+    Unlike `query_metrics`, the window doesn't have to cover whole days. The results
+    are keyed by the names in `metrics`, and a name listed in `optional` gets an empty
+    list rather than failing when nothing is found.
+    """
+    if session is None:
+        session = PrometheusSession(token)
+    start = epoch_to_rfc3339(start_time)
+    end = epoch_to_rfc3339(end_time)
+    return {
+        name: query_range(
+            openshift_url,
+            token,
+            metric,
+            start,
+            end,
+            allow_empty=name in optional,
+            session=session,
+        )
+        for name, metric in metrics.items()
+    }
+
+
+def epoch_to_rfc3339(epoch_time):
+    """Formats an epoch time as the RFC 3339 timestamp the queries take"""
+    return datetime.datetime.fromtimestamp(epoch_time, datetime.timezone.utc).strftime(
+        RFC3339_FORMAT
+    )
+
+
+def get_scrape_windows(watermark, now, step=STEP_MIN * 60, lag=0):
+    """
+    Returns the windows to query to catch up from the watermark to now
+
+    The watermark is the first sample time that hasn't been queried yet. Windows end
+    on the last step at least `lag` seconds before now, and are split at midnight UTC
+    so that each one belongs to a single day. Each window is returned as the day and
+    the first and last sample times to query, which fall on the same step grid as a
+    query over the whole day.
+    """
+    end = (now - lag) // step * step
+    windows = []
+    start = watermark
+    while start <= end:
+        day_start = start // (24 * 3600) * (24 * 3600)
+        window_end = min(end, day_start + 24 * 3600 - step)
+        day = datetime.datetime.fromtimestamp(day_start, datetime.timezone.utc)
+        windows.append((day.strftime("%Y-%m-%d"), start, window_end))
+        start = window_end + step
+    return windows
+
+
+def get_report_days(report_start_date, report_end_date):
+    """Returns every day from report_start_date to report_end_date included, as YYYY-MM-DD"""
+    day = datetime.datetime.strptime(report_start_date, "%Y-%m-%d")
+    end = datetime.datetime.strptime(report_end_date, "%Y-%m-%d")
+    days = []
+    while day <= end:
+        days.append(day.strftime("%Y-%m-%d"))
+        day += datetime.timedelta(days=1)
+    return days
+
+
+def iter_query_metrics(
+    openshift_url, token, metrics, report_start_date, report_end_date, optional=(), **query_kwargs
+):
+    """
+    Streaming counterpart of `query_metrics`
+
+    Yields a (name, series iterator) pair for each metric. Each query is only sent once
+    the previous pair has been asked for, so that a single response is read at a time.
+    """
+    query_kwargs.setdefault("session", PrometheusSession(token))
+    for name, metric in metrics.items():
+        try:
+            yield name, query_metric(
+                openshift_url,
+                token,
+                metric,
+                report_start_date,
+                report_end_date,
+                stream=True,
+                **query_kwargs,
+            )
+        except EmptyResultError:
+            if name not in optional:
+                raise
+
+
 def get_namespace_annotations():
     """
     Returns namespace annotations
     Used for finding coldfront pi name and id
+
+    Only the name and annotations of each namespace are asked of `oc`, rather
+    than the whole namespace objects.
     """
     token = os.environ.get("OPENSHIFT_TOKEN")
 
@@ -86,16 +1231,107 @@ def get_namespace_annotations():
         openshift.set_default_token(token)
 
     namespaces_dict = {}
-    namespaces = openshift.selector("namespaces").objects()
-    for namespace in namespaces:
-        namespace_dict = namespace.as_dict()["metadata"]
-        namespaces_dict[namespace_dict["name"]] = namespace_dict["annotations"]
+    result = openshift.invoke("get", ["namespaces", "-o", f"jsonpath={ANNOTATIONS_JSONPATH}"])
+    for line in result.out().splitlines():
+        if not line:
+            continue
+        name, _, annotations = line.partition("\t")
+        namespaces_dict[name] = json.loads(annotations) if annotations else {}
     return namespaces_dict
 
 
+def load_namespace_annotations(cache_file=None, cache_ttl=ANNOTATIONS_CACHE_TTL, offline=False):
+    """
+    Returns namespace annotations, from a cache file when possible
+
+    Annotations saved to `cache_file` less than `cache_ttl` seconds ago are used as
+    they are. Otherwise they are fetched with `get_namespace_annotations` and saved
+    to `cache_file`. With `offline` set, the annotations are always read from
+    `cache_file`, however old they are, and the API server is never contacted.
+    """
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, "r") as file:
+            cache = json.load(file)
+        if offline or time.time() - cache["fetched_at"] < cache_ttl:
+            return cache["annotations"]
+    if offline:
+        raise FileNotFoundError(f"No saved namespace annotations in {cache_file}")
+
+    namespace_annotations = get_namespace_annotations()
+    if cache_file is not None:
+        temp_cache_file = f"{cache_file}.tmp"
+        with open(temp_cache_file, "w") as file:
+            json.dump({"fetched_at": time.time(), "annotations": namespace_annotations}, file)
+        os.replace(temp_cache_file, cache_file)
+    return namespace_annotations
+
+
+def load_cluster_inventory(file_name):
+    """
+    Loads the clusters to collect the metrics of
+
+    The inventory is a JSON file with a list of clusters, each with a "name" to tag its
+    metrics with, the prometheus "url", where its token comes from ("token_env" naming
+    an environment variable or "token_file" a file) and optionally the "concurrency"
+    of its queries. Each cluster needs a token source of its own, since the token of
+    the logged in user or OPENSHIFT_TOKEN would be sent to every cluster's prometheus.
+    """
+    with open(file_name, "r") as file:
+        clusters = json.load(file)["clusters"]
+    if not clusters:
+        raise ValueError(f"No clusters are listed in {file_name}")
+    names = set()
+    for cluster in clusters:
+        if "name" not in cluster or "url" not in cluster:
+            raise ValueError(f"Each cluster in {file_name} needs a name and a url")
+        if "token_env" not in cluster and "token_file" not in cluster:
+            raise ValueError(f"Cluster {cluster['name']} in {file_name} needs a token_env or a token_file")
+        if cluster["name"] in names:
+            raise ValueError(f"Cluster {cluster['name']} is listed twice in {file_name}")
+        names.add(cluster["name"])
+    return clusters
+
+
+def get_cluster_token(cluster):
+    """Returns the token of a cluster from the inventory"""
+    if "token_env" in cluster:
+        return os.environ[cluster["token_env"]]
+    with open(cluster["token_file"], "r") as file:
+        return file.read().strip()
+
+
+def cluster_file_name(file_name, cluster):
+    """Tags a file name with a cluster, before its extension"""
+    root, extension = os.path.splitext(file_name)
+    return f"{root}-{cluster}{extension}"
+
+
+def get_pod_key(namespace, pod, cluster=None):
+    """
+    Returns what the metrics of a pod are keyed by
+
+    Pod names are only unique within a namespace, and namespaces within a cluster.
+    """
+    if cluster is None:
+        return f"{namespace}/{pod}"
+    return f"{cluster}/{namespace}/{pod}"
+
+
+def split_by_cluster(condensed_metrics_dict):
+    """Splits condensed metrics by the cluster of the pods, leaving out untagged ones"""
+    clusters = {}
+    for pod, pod_dict in condensed_metrics_dict.items():
+        if "cluster" in pod_dict:
+            clusters.setdefault(pod_dict["cluster"], {})[pod] = pod_dict
+    return clusters
+
+
+@functools.lru_cache(maxsize=65536)
 def get_service_unit(cpu_count, memory_count, gpu_count, gpu_type):
     """
     Returns the type of service unit, the count, and the determining resource
+
+    Results are memoized, since the same few pod sizes come up over and over.
     """
     su_type = SU_UNKNOWN
     su_count = 0
@@ -110,34 +1346,17 @@ def get_service_unit(cpu_count, memory_count, gpu_count, gpu_type):
     if cpu_count == 0 or memory_count == 0:
         return SU_UNKNOWN, 0, "CPU"
 
-    known_gpu_su = {
-        GPU_A100: SU_A100_GPU,
-        GPU_A2: SU_A2_GPU,
-        GPU_V100: SU_V100_GPU,
-        GPU_GENERIC: SU_UNKNOWN_GPU,
-    }
-
-    # GPU count for some configs is -1 for math reasons, in reality it is 0
-    su_config = {
-        SU_CPU: {"gpu": -1, "cpu": 1, "ram": 4},
-        SU_A100_GPU: {"gpu": 1, "cpu": 24, "ram": 96},
-        SU_V100_GPU: {"gpu": 1, "cpu": 24, "ram": 96},
-        SU_A2_GPU: {"gpu": 1, "cpu": 8, "ram": 64},
-        SU_UNKNOWN_GPU: {"gpu": 1, "cpu": 8, "ram": 64},
-        SU_UNKNOWN: {"gpu": -1, "cpu": 1, "ram": 1},
-    }
-
     if gpu_type is None and gpu_count == 0:
         su_type = SU_CPU
     else:
-        su_type = known_gpu_su.get(gpu_type, SU_UNKNOWN_GPU)
+        su_type = KNOWN_GPU_SU.get(gpu_type, SU_UNKNOWN_GPU)
 
     # because openshift offers fractional CPUs, so we round it up.
     cpu_count = math.ceil(cpu_count)
 
-    cpu_multiplier = cpu_count / su_config[su_type]["cpu"]
-    gpu_multiplier = gpu_count / su_config[su_type]["gpu"]
-    memory_multiplier = math.ceil(memory_count / su_config[su_type]["ram"])
+    cpu_multiplier = cpu_count / SU_CONFIG[su_type]["cpu"]
+    gpu_multiplier = gpu_count / SU_CONFIG[su_type]["gpu"]
+    memory_multiplier = math.ceil(memory_count / SU_CONFIG[su_type]["ram"])
 
     su_count = math.ceil(max(cpu_multiplier, gpu_multiplier, memory_multiplier))
 
@@ -151,12 +1370,445 @@ def get_service_unit(cpu_count, memory_count, gpu_count, gpu_type):
     return su_type, su_count, determining_resource
 
 
-def merge_metrics(metric_name, metric_list, output_dict):
-    """Merge metrics by pod"""
+def get_service_units(cpu_counts, memory_counts, gpu_counts, gpu_types):
+    """
+    Batch version of `get_service_unit` over aligned sequences of pod sizes
+
+    `gpu_types` can also be a single GPU type shared by every entry. Returns lists
+    of the SU types, SU counts and determining resources.
+    """
+    if gpu_types is None or isinstance(gpu_types, str):
+        gpu_types = itertools.repeat(gpu_types)
+    results = list(map(get_service_unit, cpu_counts, memory_counts, gpu_counts, gpu_types))
+    if not results:
+        return [], [], []
+    su_types, su_counts, determining_resources = zip(*results)
+    return list(su_types), list(su_counts), list(determining_resources)
+
+
+def configure_service_units(su_config=None, known_gpu_su=None):
+    """
+    Replaces the definitions of the service units
+
+    `su_config` maps an SU type to the GPU, CPU and RAM in one SU of that type, and
+    `known_gpu_su` maps a GPU type to its SU type. Memoized results are dropped.
+    """
+    if su_config is not None:
+        SU_CONFIG.clear()
+        SU_CONFIG.update(su_config)
+    if known_gpu_su is not None:
+        KNOWN_GPU_SU.clear()
+        KNOWN_GPU_SU.update(known_gpu_su)
+    get_service_unit.cache_clear()
+
+
+class SeriesIndex:
+    """
+    Assigns a compact integer ID to each pod the series belong to
+
+    Pods are identified by their namespace, name and cluster (None for metrics that
+    weren't collected with --clusters). The strings are interned, so the series of a
+    pod read from many files share them.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        # the (namespace, pod, cluster) of each ID
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_id(self, namespace, pod, cluster=None):
+        """Returns the ID of a pod, assigning the next one if it hasn't been seen yet"""
+        series_id = self.ids.get((namespace, pod, cluster))
+        if series_id is None:
+            key = (sys.intern(namespace), sys.intern(pod), cluster and sys.intern(cluster))
+            series_id = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+        return series_id
+
+
+class PodMetricsStore:
+    """
+    Columnar store for the samples of every pod
+
+    Instead of a dict per timestamp, each pod keeps a single array of timestamps and
+    one float array per metric aligned to it, with NaN where a metric has no sample.
+    Pods are numbered by a SeriesIndex, and their data is kept in a list by ID. The
+    GPU type strings are interned so that pods share them. Each pod also keeps the
+    step of its last samples, which is how long its last run lasts past them.
+    Series encoded as runs are kept as runs until a pod gets samples from another
+    series, so that pods merged only from runs never get expanded into samples.
+
+    `merge_metrics` and `condense_metrics` accept a store in place of the nested dict,
+    and condensing it produces the same condensed dict the report writers expect.
+    Timestamps are kept as whole seconds, which is what the queries ask for.
+    """
+
+    def __init__(self):
+        self.index = SeriesIndex()
+        # the data of each pod, by ID
+        self.pods = []
+        # usage of the files collected with aggregation in prometheus, by namespace
+        self.namespace_usage = {}
+        # the same for each cluster the files were collected from
+        self.cluster_namespace_usage = {}
+
+    def __len__(self):
+        return len(self.pods)
+
+    def merge(self, metric_name, metric_list, cluster=None):
+        """
+        Adds the samples of each series in metric_list under metric_name
+
+        Series can either come from a query, from `read_snapshot`, or be runs
+        from `condense_series`. Pods of a `cluster` are kept apart from those of
+        other clusters.
+        """
+        for metric in metric_list:
+            series_id = self.index.get_id(metric["metric"]["namespace"], metric["metric"]["pod"], cluster)
+            if series_id == len(self.pods):
+                self.pods.append({"gpu_type": NO_GPU, "timestamps": array("q"), "metrics": {}})
+            pod_dict = self.pods[series_id]
+
+            gpu_type = metric["metric"].get("resource", NO_GPU)
+            if gpu_type not in ["cpu", "memory"]:
+                pod_dict["gpu_type"] = sys.intern(gpu_type)
+            else:
+                pod_dict["gpu_type"] = NO_GPU
+
+            step = metric.get("step")
+            if "runs" in metric and not pod_dict["timestamps"]:
+                # kept as runs while the pod has no samples, `condense_runs` joins them
+                runs = metric["runs"]
+                pod_dict.setdefault("runs", []).append((
+                    metric_name,
+                    step,
+                    array("q", [int(run[0]) for run in runs]),
+                    array("q", [int(run[1]) for run in runs]),
+                    array("d", [float(run[2]) for run in runs]),
+                ))
+                continue
+            self.expand_pod_runs(pod_dict)
+            if "runs" in metric:
+                timestamps, values = expand_runs(metric["runs"], step)
+            elif "timestamps" in metric:
+                # series read from a snapshot are already binary
+                timestamps = array("q")
+                timestamps.frombytes(memoryview(metric["timestamps"]).cast("B"))
+                values = array("d")
+                values.frombytes(memoryview(metric["values"]).cast("B"))
+            else:
+                timestamps = array("q", [int(value[0]) for value in metric["values"]])
+                values = array("d", [float(value[1]) for value in metric["values"]])
+            self.add_samples(pod_dict, metric_name, timestamps, values, step)
+
+    @classmethod
+    def add_samples(cls, pod_dict, metric_name, timestamps, values, step=None):
+        """Merges the samples of a series into a pod, along with the step of the series"""
+        cls.merge_samples(pod_dict, metric_name, timestamps, values)
+        if timestamps and timestamps[-1] == pod_dict["timestamps"][-1]:
+            # the last samples of a pod last for their own step, which only runs
+            # record, otherwise find_runs guesses it from the samples
+            if step is None:
+                pod_dict.pop("step", None)
+            else:
+                pod_dict["step"] = step
+
+    @classmethod
+    def expand_pod_runs(cls, pod_dict):
+        """Turns the runs kept for a pod into samples, in the order they were merged"""
+        for metric_name, step, starts, durations, values in pod_dict.pop("runs", ()):
+            timestamps, values = expand_runs(zip(starts, durations, values), step)
+            cls.add_samples(pod_dict, metric_name, timestamps, values, step)
+
+    @staticmethod
+    def merge_samples(pod_dict, metric_name, timestamps, values):
+        """Merges aligned timestamp and value arrays into the columns of a pod"""
+        pod_timestamps = pod_dict["timestamps"]
+        columns = pod_dict["metrics"]
+
+        if pod_timestamps == timestamps:
+            columns[metric_name] = values
+            return
+
+        # the usual case when merging files in order: the samples go at the end, and
+        # once the first metric of a file has been merged, the next ones overlap the
+        # samples it added at the end
+        start = bisect.bisect_left(pod_timestamps, timestamps[0]) if timestamps else 0
+        overlap = len(pod_timestamps) - start
+        if pod_timestamps[start:] == timestamps[:overlap]:
+            if metric_name not in columns:
+                columns[metric_name] = array("d", [math.nan]) * len(pod_timestamps)
+            columns[metric_name][start:] = values[:overlap]
+            if len(timestamps) > overlap:
+                padding = array("d", [math.nan]) * (len(timestamps) - overlap)
+                for name, column in columns.items():
+                    column.extend(values[overlap:] if name == metric_name else padding)
+                pod_timestamps.extend(timestamps[overlap:])
+            return
+
+        merged_timestamps = array("q", sorted(set(pod_timestamps).union(timestamps)))
+        index = {epoch_time: i for i, epoch_time in enumerate(merged_timestamps)}
+        for name, column in columns.items():
+            merged_column = array("d", [math.nan]) * len(merged_timestamps)
+            for epoch_time, value in zip(pod_timestamps, column):
+                merged_column[index[epoch_time]] = value
+            columns[name] = merged_column
+        if metric_name not in columns:
+            columns[metric_name] = array("d", [math.nan]) * len(merged_timestamps)
+        column = columns[metric_name]
+        for epoch_time, value in zip(timestamps, values):
+            column[index[epoch_time]] = value
+        pod_dict["timestamps"] = merged_timestamps
+
+    def update(self, other):
+        """
+        Merges another store into this one
+
+        The result is the same as if the series merged into `other` had been merged
+        into this store directly, after the ones already in it.
+        """
+        add_namespace_usage(self.namespace_usage, other.namespace_usage)
+        for cluster, namespace_usage in other.cluster_namespace_usage.items():
+            add_namespace_usage(self.cluster_namespace_usage.setdefault(cluster, {}), namespace_usage)
+        for key, other_pod_dict in zip(other.index.keys, other.pods):
+            series_id = self.index.get_id(*key)
+            if series_id == len(self.pods):
+                other_pod_dict["gpu_type"] = sys.intern(other_pod_dict["gpu_type"])
+                self.pods.append(other_pod_dict)
+                continue
+            pod_dict = self.pods[series_id]
+            pod_dict["gpu_type"] = sys.intern(other_pod_dict["gpu_type"])
+            if "runs" in other_pod_dict and not pod_dict["timestamps"] and not other_pod_dict["timestamps"]:
+                pod_dict.setdefault("runs", []).extend(other_pod_dict["runs"])
+                continue
+            self.expand_pod_runs(pod_dict)
+            self.expand_pod_runs(other_pod_dict)
+            for metric_name, column in other_pod_dict["metrics"].items():
+                # only the actual samples, missing ones must not overwrite anything
+                present = list(map(operator.eq, column, column))
+                self.merge_samples(
+                    pod_dict,
+                    metric_name,
+                    array("q", itertools.compress(other_pod_dict["timestamps"], present)),
+                    array("d", itertools.compress(column, present)),
+                )
+            other_timestamps = other_pod_dict["timestamps"]
+            if other_timestamps and other_timestamps[-1] == pod_dict["timestamps"][-1]:
+                if "step" in other_pod_dict:
+                    pod_dict["step"] = other_pod_dict["step"]
+                else:
+                    pod_dict.pop("step", None)
+
+    @staticmethod
+    def condense_samples(pod_dict, metrics_to_check):
+        """Condenses the samples of a pod like `condense_metrics` does"""
+        timestamps = pod_dict["timestamps"]
+        columns = pod_dict["metrics"]
+        # compare the raw bits, so that NaN (a missing sample) equals itself
+        check_columns = [
+            memoryview(columns[metric]).cast("B").cast("q")
+            for metric in metrics_to_check
+            if metric in columns
+        ]
+
+        new_metrics_dict = {}
+        for index, duration in find_runs(timestamps, check_columns, pod_dict.get("step")):
+            metric_dict = {}
+            for name, column in columns.items():
+                if not math.isnan(column[index]):
+                    metric_dict[name] = format_sample_value(column[index])
+            metric_dict["duration"] = duration
+            new_metrics_dict[timestamps[index]] = metric_dict
+        return new_metrics_dict
+
+    def condense(self, metrics_to_check):
+        """
+        Condenses each pod like `condense_metrics` does
+
+        Pods merged only from runs are condensed from their runs directly, the others
+        from their samples.
+        """
+        condensed_dict = {}
+        for (namespace, pod, cluster), pod_dict in zip(self.index.keys, self.pods):
+            new_metrics_dict = None
+            if "runs" in pod_dict:
+                new_metrics_dict = condense_runs(pod_dict["runs"], metrics_to_check)
+                if new_metrics_dict is None:
+                    self.expand_pod_runs(pod_dict)
+            if new_metrics_dict is None:
+                new_metrics_dict = self.condense_samples(pod_dict, metrics_to_check)
+
+            pod_key = get_pod_key(namespace, pod, cluster)
+            condensed_dict[pod_key] = {
+                "namespace": namespace,
+                "pod": pod,
+                "gpu_type": pod_dict["gpu_type"],
+                "metrics": new_metrics_dict,
+            }
+            if cluster is not None:
+                condensed_dict[pod_key]["cluster"] = cluster
+        return condensed_dict
+
+
+def condense_series(metric_list, step=STEP_MIN * 60):
+    """
+    Encodes each series as runs of identical samples
+
+    Consecutive samples `step` seconds apart with the same value are collapsed into
+    a [start, duration, value] run. A gap in the samples always ends a run, so the
+    samples can be recovered exactly with `expand_runs`.
+    """
+    for series in metric_list:
+        runs = []
+        for epoch_time, value in series["values"]:
+            if runs and runs[-1][2] == value and runs[-1][0] + runs[-1][1] == epoch_time:
+                runs[-1][1] += step
+            else:
+                runs.append([epoch_time, step, value])
+        yield {"metric": series["metric"], "step": step, "runs": runs}
+
+
+def expand_runs(runs, step):
+    """Turns runs from `condense_series` back into timestamp and value arrays"""
+    timestamps = array("q")
+    values = array("d")
+    for start, duration, value in runs:
+        timestamps.extend(range(int(start), int(start) + duration, step))
+        values.extend(array("d", [float(value)]) * (duration // step))
+    return timestamps, values
+
+
+def condense_runs(series_runs, metrics_to_check):
+    """
+    Condenses the runs of the series of a pod like `find_runs` does their samples
+
+    `series_runs` holds a (metric name, step, starts, durations, values) tuple for
+    each series. The runs of all the metrics are cut where any of them starts or
+    ends, and consecutive pieces over which none of `metrics_to_check` change are
+    joined, a gap with no runs at all going to the piece before it. Returns None if
+    runs of the same metric overlap, which only merging their samples sorts out.
+    """
+    runs_by_metric = {}
+    for metric_name, _, starts, durations, values in series_runs:
+        runs_by_metric.setdefault(metric_name, []).extend(zip(starts, durations, values))
+    bounds = set()
+    for runs in runs_by_metric.values():
+        runs.sort(key=operator.itemgetter(0))
+        end = None
+        for start, duration, _ in runs:
+            if end is not None and start < end:
+                return None
+            end = start + duration
+            bounds.add(start)
+            bounds.add(end)
+    bounds = sorted(bounds)
+
+    names = list(runs_by_metric)
+    check_indexes = [index for index, name in enumerate(names) if name in metrics_to_check]
+    positions = [0] * len(names)
+    condensed_runs = {}
+    run_start = run_end = run_key = None
+    for start, end in zip(bounds, bounds[1:]):
+        values = []
+        for index, name in enumerate(names):
+            runs = runs_by_metric[name]
+            position = positions[index]
+            while position < len(runs) and runs[position][0] + runs[position][1] <= start:
+                position += 1
+            positions[index] = position
+            if position < len(runs) and runs[position][0] <= start:
+                values.append(runs[position][2])
+            else:
+                values.append(None)
+        if values.count(None) == len(values):
+            continue
+        key = [values[index] for index in check_indexes]
+        if run_start is None or key != run_key:
+            if run_start is not None:
+                condensed_runs[run_start]["duration"] = start - run_start
+            metric_dict = {
+                name: format_sample_value(value)
+                for name, value in zip(names, values)
+                if value is not None
+            }
+            condensed_runs[start] = metric_dict
+            run_start, run_key = start, key
+        run_end = end
+    if run_start is not None:
+        condensed_runs[run_start]["duration"] = run_end - run_start
+    return condensed_runs
+
+
+def find_runs(timestamps, columns, step=None):
+    """
+    Finds the runs of samples over which none of the columns change
+
+    `timestamps` and each of `columns` are aligned sequences. Each sample is compared
+    with the previous one across all the columns at once, and for every run the index
+    of its first sample and its duration are returned. A run lasts until the next one
+    starts, and the last one lasts for `step` past its final sample. If the step isn't
+    known, the interval between the first two samples is used, or the STEP_MIN from
+    the query as best guess if there is a single sample.
+    """
+    keys = columns[0] if len(columns) == 1 else list(zip(*columns))
+    change_points = itertools.compress(
+        range(1, len(timestamps)), map(operator.ne, keys, itertools.islice(keys, 1, None))
+    )
+    starts = [0, *change_points]
+
+    if step is not None:
+        interval = step
+    elif len(timestamps) > 1:
+        interval = timestamps[1] - timestamps[0]
+    else:
+        interval = STEP_MIN * 60
+
+    ends = [timestamps[start] for start in starts[1:]]
+    ends.append(timestamps[-1] + interval)
+    return [(start, end - timestamps[start]) for start, end in zip(starts, ends)]
+
+
+def format_sample_value(value):
+    """
+    Formats a float the way prometheus writes sample values
+
+    That is the shortest decimal that round-trips, never in exponent notation,
+    so that values read back from a PodMetricsStore match the original strings.
+    """
+    if value.is_integer():
+        return str(int(value))
+    return format(decimal.Decimal(repr(value)).normalize(), "f")
+
+
+def merge_metrics(metric_name, metric_list, output_dict, cluster=None):
+    """
+    Merge metrics by pod
+
+    `metric_list` can be any iterable of series, including the iterator returned by a
+    streaming query, in which case each series is merged as soon as it is parsed.
+
+    `output_dict` can also be a PodMetricsStore, which holds the same data in much
+    less memory.
+
+    Pods are keyed by their namespace and name, and by the `cluster` the metrics were
+    collected from if one is given, which are also kept as "pod" and "cluster".
+    """
+    if isinstance(output_dict, PodMetricsStore):
+        output_dict.merge(metric_name, metric_list, cluster)
+        return output_dict
     for metric in metric_list:
-        pod = metric["metric"]["pod"]
+        pod = get_pod_key(metric["metric"]["namespace"], metric["metric"]["pod"], cluster)
         if pod not in output_dict:
-            output_dict[pod] = {"namespace": metric["metric"]["namespace"], "metrics": {}}
+            output_dict[pod] = {
+                "namespace": metric["metric"]["namespace"],
+                "pod": metric["metric"]["pod"],
+                "metrics": {},
+            }
+            if cluster is not None:
+                output_dict[pod]["cluster"] = cluster
 
         gpu_type = metric["metric"].get("resource", NO_GPU)
         if gpu_type not in ["cpu", "memory"]:
@@ -177,37 +1829,24 @@ def condense_metrics(input_metrics_dict, metrics_to_check):
     Checks if the value of metrics is the same, and removes redundant
     metrics while updating the duration
     """
+    if isinstance(input_metrics_dict, PodMetricsStore):
+        return input_metrics_dict.condense(metrics_to_check)
+
     condensed_dict = {}
     for pod, pod_dict in input_metrics_dict.items():
         metrics_dict = pod_dict["metrics"]
         new_metrics_dict = {}
         epoch_times_list = sorted(metrics_dict.keys())
+        columns = [
+            [metrics_dict[epoch_time].get(metric, 0) for epoch_time in epoch_times_list]
+            for metric in metrics_to_check
+        ]
 
-        start_epoch_time = epoch_times_list[0]
-
-        # calculate the interval if we have more than 1 measurement, otherwise
-        # use the STEP_MIN from the query as best guess
-        if len(epoch_times_list) > 1:
-            interval = epoch_times_list[1] - epoch_times_list[0]
-        else:
-            interval = STEP_MIN * 60
-
-        start_metric_dict = metrics_dict[start_epoch_time].copy()
-        for epoch_time in epoch_times_list:
-            same_metrics = True
-            for metric in metrics_to_check:
-                if metrics_dict[start_epoch_time].get(metric, 0) != metrics_dict[epoch_time].get(metric, 0):  # fmt: skip
-                    same_metrics = False
-
-            if not same_metrics:
-                duration = epoch_time - start_epoch_time
-                start_metric_dict["duration"] = duration
-                new_metrics_dict[start_epoch_time] = start_metric_dict
-                start_epoch_time = epoch_time
-                start_metric_dict = metrics_dict[start_epoch_time].copy()
-        duration = epoch_time - start_epoch_time + interval
-        start_metric_dict["duration"] = duration
-        new_metrics_dict[start_epoch_time] = start_metric_dict
+        for index, duration in find_runs(epoch_times_list, columns):
+            start_epoch_time = epoch_times_list[index]
+            start_metric_dict = metrics_dict[start_epoch_time].copy()
+            start_metric_dict["duration"] = duration
+            new_metrics_dict[start_epoch_time] = start_metric_dict
 
         new_pod_dict = pod_dict.copy()
         new_pod_dict["metrics"] = new_metrics_dict
@@ -216,15 +1855,163 @@ def condense_metrics(input_metrics_dict, metrics_to_check):
     return condensed_dict
 
 
+def fold_condensed_metrics(condensed_metrics_dict, new_condensed_metrics_dict, metrics_to_check):
+    """
+    Extends condensed metrics with condensed metrics from a later period
+
+    The last run of each pod is still open: it is extended if the pod's first new
+    run has the same values, and otherwise lasts until that run starts, just as if
+    the samples of both periods had been condensed together. condensed_metrics_dict
+    is updated in place.
+
+    Returns a condensed metrics dictionary of the runs that got closed, meaning
+    every run except each pod's last one that wasn't closed before.
+    """
+    closed_metrics_dict = {}
+    for pod, new_pod_dict in new_condensed_metrics_dict.items():
+        new_runs = sorted(new_pod_dict["metrics"].items())
+        if pod not in condensed_metrics_dict:
+            condensed_metrics_dict[pod] = dict(new_pod_dict, metrics=dict(new_runs))
+            closed_runs = new_runs[:-1]
+        else:
+            pod_dict = condensed_metrics_dict[pod]
+            pod_dict["gpu_type"] = new_pod_dict["gpu_type"]
+            metrics_dict = pod_dict["metrics"]
+            last_epoch_time = max(metrics_dict)
+            last_metric_dict = metrics_dict[last_epoch_time]
+            first_epoch_time, first_metric_dict = new_runs[0]
+            if first_epoch_time < last_epoch_time + last_metric_dict["duration"]:
+                raise ValueError(f"New metrics for pod {pod} overlap the ones already condensed")
+
+            same_metrics = all(
+                last_metric_dict.get(metric, 0) == first_metric_dict.get(metric, 0)
+                for metric in metrics_to_check
+            )
+            if same_metrics:
+                last_metric_dict["duration"] = (
+                    first_epoch_time + first_metric_dict["duration"] - last_epoch_time
+                )
+                new_runs = new_runs[1:]
+            else:
+                last_metric_dict["duration"] = first_epoch_time - last_epoch_time
+
+            if new_runs:
+                closed_runs = [(last_epoch_time, last_metric_dict)] + new_runs[:-1]
+            else:
+                closed_runs = []
+            metrics_dict.update(new_runs)
+
+        if closed_runs:
+            closed_metrics_dict[pod] = dict(condensed_metrics_dict[pod], metrics=dict(closed_runs))
+    return closed_metrics_dict
+
+
 def csv_writer(rows, file_name):
-    """Writes rows as csv to file_name"""
+    """
+    Writes rows as csv to file_name
+
+    `rows` can be any iterable, including a generator, in which case each row is
+    written out as soon as it is produced and the report is never held in memory.
+    The file is gzip-compressed if its name ends with `.gz`.
+    """
     print(f"Writing csv to {file_name}")
-    with open(file_name, "w") as csvfile:
+    if file_name.endswith(".gz"):
+        csvfile = gzip.open(file_name, "wt")
+    else:
+        csvfile = open(file_name, "w", buffering=CSV_BUFFER_SIZE)
+    with csvfile:
         csvwriter = csv.writer(csvfile)
         csvwriter.writerows(rows)
 
 
-def write_metrics_by_namespace(condensed_metrics_dict, file_name, report_month):
+def new_namespace_metrics():
+    """Returns the usage of a namespace before anything is added to it"""
+    return {
+        "_cpu_hours": 0,
+        "_memory_hours": 0,
+        "SU_CPU_HOURS": 0,
+        "SU_A100_GPU_HOURS": 0,
+        "SU_A2_GPU_HOURS": 0,
+        "SU_V100_GPU_HOURS": 0,
+        "SU_UNKNOWN_GPU_HOURS": 0,
+        "total_cost": 0,
+    }
+
+
+def add_namespace_usage(metrics_by_namespace, namespace_usage):
+    """
+    Adds usage summed up by namespace elsewhere, like by `query_namespace_usage`
+
+    `namespace_usage` maps namespaces to any of the fields of the namespace metrics.
+    """
+    for namespace, usage in namespace_usage.items():
+        if namespace not in metrics_by_namespace:
+            metrics_by_namespace[namespace] = new_namespace_metrics()
+        namespace_metrics = metrics_by_namespace[namespace]
+        for name, value in usage.items():
+            namespace_metrics[name] += value
+    return metrics_by_namespace
+
+
+def aggregate_metrics_by_namespace(condensed_metrics_dict, metrics_by_namespace=None):
+    """
+    Sums up the usage of the pods in a condensed metrics dictionary by namespace
+
+    CPU and memory hours are summed up for non-gpu pods, while GPU pods get their
+    SU hours from `get_service_unit`. When `metrics_by_namespace` is passed in the
+    usage is added to it, so that it can be accumulated over several calls.
+
+    The GPU type puts all the intervals of a pod in the same bucket of its namespace,
+    so each pod's requests are pulled out as columns and reduced into that bucket at
+    once. The sums are still added up in the same order as interval by interval.
+    """
+    if metrics_by_namespace is None:
+        metrics_by_namespace = {}
+
+    for pod, pod_dict in condensed_metrics_dict.items():
+        namespace = pod_dict["namespace"]
+        gpu_type = pod_dict["gpu_type"]
+
+        if namespace not in metrics_by_namespace:
+            metrics_by_namespace[namespace] = new_namespace_metrics()
+        namespace_metrics = metrics_by_namespace[namespace]
+
+        intervals = pod_dict["metrics"].values()
+        durations_in_hours = [float(interval["duration"]) / 3600 for interval in intervals]
+        cpu_requests = [float(interval.get("cpu_request", 0)) for interval in intervals]
+        memory_requests = [
+            float(interval.get("memory_request", 0)) / 2**30 for interval in intervals
+        ]
+
+        su_hours_key = GPU_SU_HOURS.get(gpu_type)
+        if su_hours_key is not None:
+            gpu_requests = [float(interval.get("gpu_request", 0)) for interval in intervals]
+            _, su_counts, _ = get_service_units(
+                cpu_requests, memory_requests, gpu_requests, gpu_type
+            )
+            namespace_metrics[su_hours_key] = functools.reduce(
+                operator.add,
+                map(operator.mul, su_counts, durations_in_hours),
+                namespace_metrics[su_hours_key],
+            )
+        else:
+            namespace_metrics["_cpu_hours"] = functools.reduce(
+                operator.add,
+                map(operator.mul, cpu_requests, durations_in_hours),
+                namespace_metrics["_cpu_hours"],
+            )
+            namespace_metrics["_memory_hours"] = functools.reduce(
+                operator.add,
+                map(operator.mul, memory_requests, durations_in_hours),
+                namespace_metrics["_memory_hours"],
+            )
+
+    return metrics_by_namespace
+
+
+def write_metrics_by_namespace(
+    condensed_metrics_dict, file_name, report_month, namespace_annotations=None
+):
     """
     Process metrics dictionary to aggregate usage by namespace and then write that to a file
 
@@ -232,10 +2019,29 @@ def write_metrics_by_namespace(condensed_metrics_dict, file_name, report_month):
     service units on the total.
 
     For GPU resources, it relies on the `get_service_unit` method to get the SU count.
+
+    The namespace annotations are fetched unless they are passed in.
     """
-    metrics_by_namespace = {}
-    rows = []
-    namespace_annotations = get_namespace_annotations()
+    metrics_by_namespace = aggregate_metrics_by_namespace(condensed_metrics_dict)
+    write_namespace_report(metrics_by_namespace, file_name, report_month, namespace_annotations)
+
+
+def write_namespace_report(metrics_by_namespace, file_name, report_month, namespace_annotations=None):
+    """
+    Writes the usage summed up by `aggregate_metrics_by_namespace` to a file
+
+    The service units for CPU and memory are calculated here, on the totals.
+    """
+    if namespace_annotations is None:
+        namespace_annotations = get_namespace_annotations()
+    csv_writer(
+        namespace_report_rows(metrics_by_namespace, report_month, namespace_annotations),
+        file_name,
+    )
+
+
+def namespace_report_rows(metrics_by_namespace, report_month, namespace_annotations):
+    """Yields the rows of the namespace report, starting with the headers"""
     headers = [
         "Invoice Month",
         "Project - Allocation",
@@ -251,54 +2057,7 @@ def write_metrics_by_namespace(condensed_metrics_dict, file_name, report_month):
         "Cost",
     ]
 
-    rows.append(headers)
-
-    for pod, pod_dict in condensed_metrics_dict.items():
-        namespace = pod_dict["namespace"]
-        pod_metrics_dict = pod_dict["metrics"]
-        namespace_annotation_dict = namespace_annotations.get(namespace, {})
-        cf_pi = namespace_annotation_dict.get("cf_pi", namespace)
-        gpu_type = pod_dict["gpu_type"]
-
-        if namespace not in metrics_by_namespace:
-            metrics_by_namespace[namespace] = {
-                "pi": cf_pi,
-                "_cpu_hours": 0,
-                "_memory_hours": 0,
-                "SU_CPU_HOURS": 0,
-                "SU_A100_GPU_HOURS": 0,
-                "SU_A2_GPU_HOURS": 0,
-                "SU_V100_GPU_HOURS": 0,
-                "SU_UNKNOWN_GPU_HOURS": 0,
-                "total_cost": 0,
-            }
-
-        for epoch_time, pod_metric_dict in pod_metrics_dict.items():
-            duration_in_hours = float(pod_metric_dict["duration"]) / 3600
-            cpu_request = float(pod_metric_dict.get("cpu_request", 0))
-            gpu_request = float(pod_metric_dict.get("gpu_request", 0))
-            memory_request = float(pod_metric_dict.get("memory_request", 0)) / 2**30
-
-            if gpu_type == GPU_A100:
-                _, su_count, _ = get_service_unit(
-                    float(cpu_request), memory_request, float(gpu_request), gpu_type
-                )
-                metrics_by_namespace[namespace]["SU_A100_GPU_HOURS"] += su_count * duration_in_hours
-            elif gpu_type == GPU_A2:
-                _, su_count, _ = get_service_unit(
-                    float(cpu_request), memory_request, float(gpu_request), gpu_type
-                )
-                metrics_by_namespace[namespace]["SU_A2_GPU_HOURS"] += su_count * duration_in_hours
-            elif gpu_type == GPU_GENERIC:
-                _, su_count, _ = get_service_unit(
-                    float(cpu_request), memory_request, float(gpu_request), gpu_type
-                )
-                metrics_by_namespace[namespace]["SU_UNKNOWN_GPU_HOURS"] += su_count * duration_in_hours
-            else:
-                metrics_by_namespace[namespace]["_cpu_hours"] += cpu_request * duration_in_hours
-                metrics_by_namespace[namespace]["_memory_hours"] += (
-                    memory_request * duration_in_hours
-                )
+    yield headers
 
     for namespace, metrics in metrics_by_namespace.items():
         cpu_multiplier = metrics["_cpu_hours"] / 1
@@ -306,104 +2065,75 @@ def write_metrics_by_namespace(condensed_metrics_dict, file_name, report_month):
 
         su_count_hours = math.ceil(max(cpu_multiplier, memory_multiplier))
 
-        metrics["SU_CPU_HOURS"] += su_count_hours
+        su_cpu_hours = metrics["SU_CPU_HOURS"] + su_count_hours
+        cf_pi = namespace_annotations.get(namespace, {}).get("cf_pi", namespace)
 
-        if metrics["SU_CPU_HOURS"] != 0:
+        if su_cpu_hours != 0:
             row = [
                 report_month,
                 namespace,
                 namespace,
-                metrics["pi"],
+                cf_pi,
                 "", #Invoice Email
                 "", #Invoice Address
                 "", #Institution
                 "", #Institution - Specific Code
-                str(metrics["SU_CPU_HOURS"]),
+                str(su_cpu_hours),
                 SU_CPU,
                 str(RATE.get(SU_CPU)),
-                str(RATE.get(SU_CPU) * metrics["SU_CPU_HOURS"])
+                str(RATE.get(SU_CPU) * su_cpu_hours)
             ]
-            rows.append(row)
-
-        if metrics["SU_A100_GPU_HOURS"] != 0:
-            row = [
-                report_month,
-                namespace,
-                namespace,
-                metrics["pi"],
-                "", #Invoice Email
-                "", #Invoice Address
-                "", #Institution
-                "", #Institution - Specific Code
-                str(math.ceil(metrics["SU_A100_GPU_HOURS"])),
-                SU_A100_GPU,
-                str(RATE.get(SU_A100_GPU)),
-                str(RATE.get(SU_A100_GPU) * math.ceil(metrics["SU_A100_GPU_HOURS"]))
-            ]
-            rows.append(row)
-
-        if metrics["SU_A2_GPU_HOURS"] != 0:
-            row = [
-                report_month,
-                namespace,
-                namespace,
-                metrics["pi"],
-                "", #Invoice Email
-                "", #Invoice Address
-                "", #Institution
-                "", #Institution - Specific Code
-                str(math.ceil(metrics["SU_A2_GPU_HOURS"])),
-                SU_A2_GPU,
-                str(RATE.get(SU_A2_GPU)),
-                str(RATE.get(SU_A2_GPU) * math.ceil(metrics["SU_A2_GPU_HOURS"]))
-            ]
-            rows.append(row)
-
-        if metrics["SU_V100_GPU_HOURS"] != 0:
-            row = [
-                report_month,
-                namespace,
-                namespace,
-                metrics["pi"],
-                "", #Invoice Email
-                "", #Invoice Address
-                "", #Institution
-                "", #Institution - Specific Code
-                str(match.ceil(metrics["SU_V100_GPU_HOURS"])),
-                SU_V100_GPU,
-                str(RATE.get(SU_V100_GPU)),
-                str(RATE.get(SU_V100_GPU) * match.ceil(metrics["SU_V100_GPU_HOURS"])) #Cost
-            ]
-            rows.append(row)
+            yield row
+
+        for su_hours_key, su_type in GPU_SU_HOURS_TYPES:
+            if metrics[su_hours_key] != 0:
+                su_hours = math.ceil(metrics[su_hours_key])
+                row = [
+                    report_month,
+                    namespace,
+                    namespace,
+                    cf_pi,
+                    "", #Invoice Email
+                    "", #Invoice Address
+                    "", #Institution
+                    "", #Institution - Specific Code
+                    str(su_hours),
+                    su_type,
+                    str(RATE.get(su_type)),
+                    str(RATE.get(su_type) * su_hours) #Cost
+                ]
+                yield row
+
+
+@functools.lru_cache(maxsize=65536)
+def format_timestamp(epoch_time):
+    """
+    Formats an epoch time as a UTC time for the reports
 
-        if metrics["SU_UNKNOWN_GPU_HOURS"] != 0:
-            row = [
-                report_month,
-                namespace,
-                namespace,
-                metrics["pi"],
-                "", #Invoice Email
-                "", #Invoice Address
-                "", #Institution
-                "", #Institution - Specific Code
-                str(math.ceil(metrics["SU_UNKNOWN_GPU_HOURS"])),
-                SU_UNKNOWN_GPU,
-                str(RATE.get(SU_UNKNOWN_GPU)),
-                str(RATE.get(SU_UNKNOWN_GPU) * math.ceil(metrics["SU_UNKNOWN_GPU_HOURS"])) #Cost
-            ]
-            rows.append(row)
-    csv_writer(rows, file_name)
+    Intervals start and end on the query steps, so the same few thousand times
+    come up for every pod and the formatted strings are memoized.
+    """
+    return datetime.datetime.fromtimestamp(float(epoch_time), datetime.timezone.utc).strftime(
+        REPORT_TIME_FORMAT
+    )
 
 
-def write_metrics_by_pod(metrics_dict, file_name):
+def write_metrics_by_pod(metrics_dict, file_name, namespace_annotations=None):
     """
     Generates metrics report by pod
 
     It currently includes service units for each pod, but that doesn't make sense
     as we are calculating the CPU/Memory service units at the project level
+
+    The namespace annotations are fetched unless they are passed in.
     """
-    rows = []
-    namespace_annotations = get_namespace_annotations()
+    if namespace_annotations is None:
+        namespace_annotations = get_namespace_annotations()
+    csv_writer(pod_report_rows(metrics_dict, namespace_annotations), file_name)
+
+
+def pod_report_rows(metrics_dict, namespace_annotations):
+    """Yields the rows of the pod report, starting with the headers"""
     headers = [
         "Namespace",
         "Coldfront_PI Name",
@@ -420,7 +2150,7 @@ def write_metrics_by_pod(metrics_dict, file_name):
         "SU Type",
         "SU Count",
     ]
-    rows.append(headers)
+    yield headers
 
     for pod, pod_dict in metrics_dict.items():
         namespace = pod_dict["namespace"]
@@ -431,12 +2161,8 @@ def write_metrics_by_pod(metrics_dict, file_name):
         cf_project_id = namespace_annotation_dict.get("cf_project_id", 1)
 
         for epoch_time, pod_metric_dict in pod_metrics_dict.items():
-            start_time = datetime.datetime.utcfromtimestamp(float(epoch_time)).strftime(
-                "%Y-%m-%dT%H:%M:%S"
-            )
-            end_time = datetime.datetime.utcfromtimestamp(
-                float(epoch_time + pod_metric_dict["duration"])
-            ).strftime("%Y-%m-%dT%H:%M:%S")
+            start_time = format_timestamp(epoch_time)
+            end_time = format_timestamp(epoch_time + pod_metric_dict["duration"])
             duration = round(float(pod_metric_dict["duration"]) / 3600, 4)
             cpu_request = pod_metric_dict.get("cpu_request", 0)
             gpu_request = pod_metric_dict.get("gpu_request", 0)
@@ -452,7 +2178,7 @@ def write_metrics_by_pod(metrics_dict, file_name):
                 start_time,
                 end_time,
                 duration,
-                pod,
+                pod_dict.get("pod", pod),
                 cpu_request,
                 gpu_request,
                 gpu_type,
@@ -462,6 +2188,4 @@ def write_metrics_by_pod(metrics_dict, file_name):
                 su_count,
             ]
 
-            rows.append(info_list)
-
-    csv_writer(rows, file_name)
+            yield info_list